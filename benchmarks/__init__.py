@@ -0,0 +1,5 @@
+"""Benchmarks for pywaschedv
+
+Run from the top level project folder, e. g.
+python -m benchmarks.sqlite_writers --compare
+"""
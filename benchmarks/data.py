@@ -0,0 +1,137 @@
+"""Synthetic dorm-scale data for benchmarks
+
+generate() fills a new database with residents, washing machines and weeks
+of booking history shaped like in a dorm: most washing in the evening and
+on weekends, some cancellations and no-shows, and the coming week already
+partly booked. The same seed gives the same data, relative to the current
+week.
+"""
+import collections
+import datetime
+import random
+from django.db import transaction
+from django.utils import timezone
+
+SLOT_WEIGHTS = (
+    0.3, 0.1, 0.05, 0.05, 0.2, 0.5, 0.8, 1.0,
+    1.1, 1.2, 1.3, 1.5, 1.8, 1.9, 1.6, 0.9,
+)
+"""relative demand for the appointments of a day, starting at 0:00"""
+WEEKDAY_WEIGHTS = (0.9, 0.9, 0.9, 0.95, 1.0, 1.2, 1.3)
+"""relative demand from Monday to Sunday"""
+WASHES_PER_WEEK = 0.9
+"""average appointments of a resident per week"""
+CANCEL_RATE = 0.12
+NO_SHOW_RATE = 0.08
+INACTIVE_RATE = 0.05
+UPCOMING_FILL = 0.5
+"""part of the demand for the coming week that's booked already"""
+MAX_MACHINES = 255
+"""appointment references support machines up to 255"""
+
+Dataset = collections.namedtuple(
+    'Dataset', 'residents machines appointments canceled weeks seed')
+
+
+def _weight(time):
+    local = timezone.localtime(time)
+    slot = (60 * local.hour + local.minute) // (24 * 60 // len(SLOT_WEIGHTS))
+    return (
+        SLOT_WEIGHTS[slot] / (sum(SLOT_WEIGHTS) / len(SLOT_WEIGHTS))
+        * WEEKDAY_WEIGHTS[local.weekday()]
+        / (sum(WEEKDAY_WEIGHTS) / len(WEEKDAY_WEIGHTS)))
+
+
+def _past_times(weeks, now):
+    from wasch.models import AppointmentManager
+    today = timezone.localtime(now).date()
+    day = today - datetime.timedelta(days=today.weekday() + 7 * weeks)
+    while day <= today:
+        for number in range(AppointmentManager.appointments_per_day):
+            time = timezone.make_aware(datetime.datetime.combine(
+                day, AppointmentManager.time_of_appointment_number(number)))
+            if time >= now:
+                return
+            yield time
+        day += datetime.timedelta(days=1)
+
+
+def _appointments(times, machines, residents, fill, used, rng):
+    """Appointments for slots at times, each taken with a probability of
+    fill times the slot's weight"""
+    from wasch.models import Appointment
+    appointments = []
+    for time in times:
+        weight = _weight(time)
+        for machine in machines:
+            if rng.random() < CANCEL_RATE * fill * weight:
+                appointments.append(Appointment(
+                    time=time, machine=machine, user=rng.choice(residents),
+                    wasUsed=False, canceled=True))
+            if rng.random() < fill * weight:
+                appointments.append(Appointment(
+                    time=time, machine=machine, user=rng.choice(residents),
+                    wasUsed=used and rng.random() >= NO_SHOW_RATE))
+    return appointments
+
+
+def generate(residents=300, machines=3, weeks=12, seed=0, ration=None,
+             rooms=1):
+    """Fill the (new) database with synthetic data
+
+    :param residents int: number of end users
+    :param machines int: number of washing machines, at most MAX_MACHINES
+    :param rooms int: number of rooms, machines are spread over them
+    :param weeks int: weeks of history before the current week
+    :param ration int: set the ration parameter; it limits appointments of a
+        user over all time, which history would use up otherwise; defaults
+        to being unlimited in practice
+    :return Dataset: residents are auth Users, the last ones inactive
+    """
+    from wasch import tvkutils
+    from wasch.models import (
+        Appointment, Room, WashingMachine, WashParameters, WashUser,
+    )
+    if not 1 <= machines <= MAX_MACHINES:
+        raise ValueError('machines must be 1 to {}'.format(MAX_MACHINES))
+    if not 1 <= rooms <= machines:
+        raise ValueError('rooms must be 1 to machines')
+    rng = random.Random(seed)
+    with transaction.atomic():
+        tvkutils.setup()
+        if ration is None:
+            ration = 1000000
+        WashParameters.objects.update_value('ration', str(ration))
+        WashingMachine.objects.all().delete()
+        room_objects = [Room.objects.get_default()] + [
+            Room.objects.create(name='Room {}'.format(i + 1))
+            for i in range(1, rooms)]
+        machine_objects = WashingMachine.objects.bulk_create([
+            WashingMachine(
+                number=number, room=room_objects[(number - 1) % rooms],
+                isAvailable=True, notes='')
+            for number in range(1, machines + 1)])
+        inactive = int(residents * INACTIVE_RATE)
+        users = [
+            WashUser.objects.create_enduser(
+                'resident{:04d}'.format(i),
+                isActivated=i < residents - inactive).user
+            for i in range(residents)]
+        active_users = users[:residents - inactive]
+        capacity = machines * Appointment.manager.appointments_per_day * 7
+        fill = min(1, residents * WASHES_PER_WEEK / capacity)
+        now = timezone.now()
+        appointments = _appointments(
+            _past_times(weeks, now), machine_objects, active_users, fill,
+            True, rng)
+        appointments += _appointments(
+            Appointment.manager.scheduled_appointment_times(),
+            machine_objects, active_users, fill * UPCOMING_FILL, False, rng)
+        Appointment.objects.bulk_create(appointments, batch_size=500)
+    # bulk operations send no signals, which would invalidate caches
+    Appointment.manager.clear_cache()
+    return Dataset(
+        residents=users, machines=machine_objects,
+        appointments=len(appointments),
+        canceled=sum(a.canceled for a in appointments),
+        weeks=weeks, seed=seed)
@@ -0,0 +1,29 @@
+import os
+import django
+from django.core.management import call_command
+
+
+def setup_django(
+        settings_module='pywaschedv.settings', database_path=None,
+        **overrides):
+    """Set up Django with a separate (fresh) database for benchmarking
+
+    :param database_path str: SQLite database file to use instead of the
+        configured one
+    :param overrides: settings to change, e. g. DEBUG=False
+    """
+    os.environ['DJANGO_SETTINGS_MODULE'] = settings_module
+    from django.conf import settings
+    if database_path is not None:
+        settings.DATABASES['default']['NAME'] = database_path
+    for name, value in overrides.items():
+        setattr(settings, name, value)
+    django.setup()
+    call_command('migrate', verbosity=0)
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
@@ -0,0 +1,264 @@
+"""Booking rush: many residents racing for the same new slots
+
+Like right after midnight, when a new day opens at the end of the booking
+horizon, simulated residents log in, fetch the book page all at once and
+try to book one of the last (newest) slots on it; some cancel again. They
+talk HTTP to the WSGI application served by a threaded server in this
+process, on a new database with synthetic data (see benchmarks.data).
+
+Prints JSON with throughput, latency percentiles per request kind, rates
+of conflicts (slot taken meanwhile) and errors, and double bookings found
+in the database afterwards.
+"""
+import argparse
+import collections
+import html
+import json
+import os
+import random
+import re
+import socketserver
+import tempfile
+import threading
+import time
+from wsgiref import simple_server
+import requests
+from benchmarks.environment import percentile, setup_django
+
+PASSWORD = 'rush-password'
+BOOK_LINK = re.compile(r'<a href="([^"]+)">Book now</a>')
+CANCEL_LINK = re.compile(r'<a href="([^"]+)"[^>]*>Cancel appointment</a>')
+
+
+class QuietHandler(simple_server.WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class ThreadedServer(socketserver.ThreadingMixIn, simple_server.WSGIServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def handle_error(self, request, client_address):
+        pass  # e. g. client timed out; counted as error by the client
+
+
+def serve(application):
+    """Serve application on a free port in a background thread
+
+    :return: server, base URL
+    """
+    server = simple_server.make_server(
+        '127.0.0.1', 0, application, server_class=ThreadedServer,
+        handler_class=QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:{}'.format(server.server_port)
+
+
+class Resident:
+    def __init__(self, base_url, username, stats, rng, timeout=60):
+        self.base_url = base_url
+        self.timeout = timeout
+        self.username = username
+        self.stats = stats
+        self.rng = rng
+        self.session = requests.Session()
+
+    def get(self, kind, path):
+        begin = time.monotonic()
+        try:
+            response = self.session.get(
+                self.base_url + path, timeout=self.timeout)
+        except requests.RequestException:
+            self.stats.record(kind, time.monotonic() - begin, 'error')
+            return None
+        outcome = 'ok' if response.status_code == 200 else 'error'
+        self.stats.record(kind, time.monotonic() - begin, outcome)
+        return response if outcome == 'ok' else None
+
+    def login(self):
+        self.session.get(self.base_url + '/wasch/login/')
+        response = self.session.post(self.base_url + '/wasch/login/', data={
+            'username': self.username,
+            'password': PASSWORD,
+            'csrfmiddlewaretoken': self.session.cookies['csrftoken'],
+        })
+        if 'sessionid' not in self.session.cookies:
+            raise RuntimeError('login of {} failed: {}'.format(
+                self.username, response.status_code))
+
+    def rush(self, contested, cancel_rate):
+        """Fetch the book page, try to book one of the last contested slots
+        and maybe cancel it"""
+        page = self.get('book_page', '/wasch/book/')
+        if page is None:
+            return
+        links = BOOK_LINK.findall(page.text)[-contested:]
+        if not links:
+            self.stats.count('sold_out')
+            return
+        link = html.unescape(self.rng.choice(links)).split('?')[0]
+        response = self.get('book', link)
+        if response is None:
+            return
+        if 'You just booked' in response.text:
+            self.stats.count('booked')
+        elif 'no longer available' in response.text:
+            self.stats.outcome('book', 'conflict')
+            return
+        else:
+            self.stats.outcome('book', 'error')
+            return
+        if self.rng.random() < cancel_rate:
+            cancel_links = CANCEL_LINK.findall(response.text)
+            if cancel_links:
+                response = self.get(
+                    'cancel', html.unescape(self.rng.choice(cancel_links)))
+                if response is not None and 'canceled' in response.text:
+                    self.stats.count('canceled')
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = collections.defaultdict(list)
+        self.outcomes = collections.defaultdict(collections.Counter)
+        self.counts = collections.Counter()
+
+    def record(self, kind, seconds, outcome):
+        with self.lock:
+            self.latencies[kind].append(seconds)
+            self.outcomes[kind][outcome] += 1
+
+    def outcome(self, kind, outcome):
+        """Correct the outcome of the last request of kind (from ok)"""
+        with self.lock:
+            self.outcomes[kind]['ok'] -= 1
+            self.outcomes[kind][outcome] += 1
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+
+def _prepare(residents, machines, seed):
+    from benchmarks.data import generate
+    dataset = generate(residents, machines, weeks=2, seed=seed)
+    from wasch.models import WashUser
+    users = []
+    for user in dataset.residents:
+        if WashUser.objects.get(pk=user).isActivated:
+            user.set_password(PASSWORD)
+            user.save()
+            users.append(user.username)
+    return users
+
+
+def double_bookings():
+    """(time, machine number, count) of slots booked more than once"""
+    from django.db.models import Count
+    from wasch.models import Appointment
+    return [
+        (row['time'].isoformat(), row['machine'], row['count'])
+        for row in Appointment.objects.filter(canceled=False)
+        .values('time', 'machine').annotate(count=Count('id'))
+        .filter(count__gt=1).order_by('time', 'machine')]
+
+
+def run(users, machines, rounds, contested, cancel_rate, seed, timeout=60):
+    from django.core.wsgi import get_wsgi_application
+    usernames = _prepare(users, machines, seed)
+    server, base_url = serve(get_wsgi_application())
+    stats = Stats()
+    rng = random.Random(seed)
+    residents = [
+        Resident(
+            base_url, username, stats, random.Random(rng.random()), timeout)
+        for username in usernames]
+    for resident in residents:
+        resident.login()
+    barrier = threading.Barrier(len(residents))
+
+    def simulate(resident):
+        barrier.wait()
+        for _ in range(rounds):
+            resident.rush(contested, cancel_rate)
+
+    threads = [
+        threading.Thread(target=simulate, args=(resident, ))
+        for resident in residents]
+    begin = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.monotonic() - begin
+    server.shutdown()
+    requests_count = sum(len(values) for values in stats.latencies.values())
+    attempts = sum(stats.outcomes['book'].values())
+    errors = sum(
+        outcomes['error'] for outcomes in stats.outcomes.values())
+    doubles = double_bookings()
+    return {
+        'users': len(residents),
+        'rounds': rounds,
+        'contested': contested,
+        'seconds': round(seconds, 3),
+        'requests': requests_count,
+        'requests_per_second': round(requests_count / seconds, 1),
+        'bookings_per_second': round(stats.counts['booked'] / seconds, 1),
+        'booked': stats.counts['booked'],
+        'canceled': stats.counts['canceled'],
+        'sold_out': stats.counts['sold_out'],
+        'conflict_rate': round(
+            stats.outcomes['book']['conflict'] / attempts, 3)
+        if attempts else None,
+        'error_rate': round(errors / requests_count, 3)
+        if requests_count else None,
+        'latency_ms': {
+            kind: {
+                'p50': round(percentile(values, 0.5) * 1000, 1),
+                'p95': round(percentile(values, 0.95) * 1000, 1),
+                'p99': round(percentile(values, 0.99) * 1000, 1),
+            } for kind, values in sorted(stats.latencies.items())},
+        'outcomes': {
+            kind: dict(outcomes)
+            for kind, outcomes in sorted(stats.outcomes.items())},
+        'double_bookings': len(doubles),
+        'double_booked_slots': doubles[:20],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--machines', type=int, default=3)
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument(
+        '--contested', type=int, default=12,
+        help='choose among the last that many bookable slots')
+    parser.add_argument('--cancel-rate', type=float, default=0.2)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument(
+        '--timeout', type=float, default=60,
+        help='seconds until a request counts as error')
+    parser.add_argument(
+        '--settings', default='pywaschedv.settings',
+        help='settings module, e. g. pywaschedv.settings_production')
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        setup_django(
+            args.settings, os.path.join(tmpdir, 'rush.sqlite3'),
+            DEBUG=False,
+            # fast logins; passwords are not what's measured here
+            PASSWORD_HASHERS=[
+                'django.contrib.auth.hashers.MD5PasswordHasher'])
+        results = run(
+            args.users, args.machines, args.rounds, args.contested,
+            args.cancel_rate, args.seed, args.timeout)
+    results['settings'] = args.settings
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
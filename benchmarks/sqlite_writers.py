@@ -0,0 +1,142 @@
+"""Booking throughput with concurrent writers on SQLite
+
+Every writer thread books and cancels appointments of its own, so there is
+no conflict about slots, only about the database write lock.
+With --queue, the writers submit to wasch.bookingqueue, whose writer
+thread applies them in grouped transactions, instead of booking directly.
+--compare runs the benchmark for the default and the production settings
+(pywaschedv.settings_production), each directly and through the queue, in
+a subprocess with a new database, and prints all results.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from benchmarks.environment import percentile, setup_django
+
+PROFILES = {
+    'default': 'pywaschedv.settings',
+    'production': 'pywaschedv.settings_production',
+}
+
+
+def _seed(writers):
+    from wasch import tvkutils
+    from wasch.models import WashingMachine, WashParameters, WashUser
+    tvkutils.setup()
+    WashParameters.objects.update_value('ration', '1000000')
+    WashingMachine.objects.update(isAvailable=True)
+    WashingMachine.objects.clear_cache()
+    return [
+        WashUser.objects.create_enduser(
+            'writer{}'.format(i), isActivated=True).user
+        for i in range(writers)]
+
+
+def run(writers, operations, use_queue=False):
+    from django.db import OperationalError, connection
+    from wasch.bookingqueue import BookingQueue
+    from wasch.models import Appointment, AppointmentError, WashingMachine
+    users = _seed(writers)
+    queue = BookingQueue() if use_queue else None
+
+    def make_appointment(*args):
+        if queue is None:
+            return Appointment.manager.make_appointment(*args)
+        return queue.submit(
+            Appointment.manager.make_appointment, *args).result()
+
+    def cancel(appointment):
+        if queue is None:
+            return appointment.cancel()
+        return queue.submit(appointment.cancel).result()
+
+    machines = list(WashingMachine.objects.order_by('number'))
+    times = Appointment.manager.scheduled_appointment_times()
+    slots = [(time, machine) for time in times for machine in machines]
+    results = {'ok': 0, 'locked': 0, 'conflicts': 0}
+    latencies = []
+    lock = threading.Lock()
+
+    def writer(i):
+        try:
+            for n in range(operations):
+                time_, machine = slots[(i + writers * n) % len(slots)]
+                begin = time.monotonic()
+                try:
+                    appointment = make_appointment(time_, machine, users[i])
+                    cancel(appointment)
+                    outcome = 'ok'
+                except OperationalError:  # database is locked
+                    outcome = 'locked'
+                except AppointmentError:
+                    outcome = 'conflicts'
+                with lock:
+                    results[outcome] += 1
+                    latencies.append(time.monotonic() - begin)
+        finally:
+            connection.close()
+
+    threads = [
+        threading.Thread(target=writer, args=(i, )) for i in range(writers)]
+    begin = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.monotonic() - begin
+    results.update({
+        'queue': use_queue,
+        'writers': writers,
+        'operations': writers * operations,
+        'seconds': round(seconds, 3),
+        'ok_per_second': round(results['ok'] / seconds, 1),
+        'latency_p50': round(percentile(latencies, 0.5), 4),
+        'latency_p95': round(percentile(latencies, 0.95), 4),
+    })
+    return results
+
+
+def compare(writers, operations):
+    results = {}
+    for profile in PROFILES:
+        for path, options in (('direct', []), ('queue', ['--queue'])):
+            output = subprocess.check_output([
+                sys.executable, '-m', 'benchmarks.sqlite_writers',
+                '--profile', profile, '--writers', str(writers),
+                '--operations', str(operations),
+            ] + options)
+            results['{}-{}'.format(profile, path)] = json.loads(
+                output.decode())
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--profile', choices=PROFILES, default='default')
+    parser.add_argument('--compare', action='store_true')
+    parser.add_argument(
+        '--queue', action='store_true', help='book through the booking queue')
+    parser.add_argument('--writers', type=int, default=8)
+    parser.add_argument(
+        '--operations', type=int, default=25,
+        help='book and cancel operations per writer')
+    args = parser.parse_args()
+    if args.compare:
+        print(json.dumps(
+            compare(args.writers, args.operations), indent=2, sort_keys=True))
+        return
+    with tempfile.TemporaryDirectory() as tmpdir:
+        setup_django(
+            PROFILES[args.profile], os.path.join(tmpdir, 'bench.sqlite3'))
+        results = run(args.writers, args.operations, args.queue)
+    results['profile'] = args.profile
+    print(json.dumps(results, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,245 @@
+"""Timed scenarios on synthetic dorm-scale data
+
+Generates data (see benchmarks.data) in a new SQLite database, runs each
+scenario repeatedly and prints JSON results: time percentiles and queries
+per run. Save results of two versions and compare them, e. g.
+
+python -m benchmarks.suite --output before.json
+python -m benchmarks.suite --output after.json
+python -m benchmarks.suite --compare before.json after.json
+"""
+import argparse
+import collections
+import itertools
+import json
+import os
+import platform
+import sqlite3
+import subprocess
+import sys
+import tempfile
+from benchmarks.environment import percentile, setup_django
+
+SCENARIOS = collections.OrderedDict()
+
+
+def scenario(function):
+    """Register function(runner, repeat) as scenario, which calls
+    runner.timed for the part to measure"""
+    SCENARIOS[function.__name__] = function
+    return function
+
+
+class Runner:
+    def __init__(self, dataset):
+        from wasch.models import WashUser
+        self.dataset = dataset
+        self.active = [
+            user for user in dataset.residents
+            if WashUser.objects.get(pk=user).isActivated]
+        self.users = itertools.cycle(self.active)
+        self.clients = {}
+        self.samples = []
+
+    def client(self, user):
+        from django.test import Client
+        if user not in self.clients:
+            self.clients[user] = Client(HTTP_HOST='localhost')
+            self.clients[user].force_login(user)
+        return self.clients[user]
+
+    def free_slot(self):
+        """An upcoming (time, machine) nobody has booked"""
+        from wasch.models import Appointment
+        times = Appointment.manager.scheduled_appointment_times()
+        taken = set(Appointment.objects.filter(
+            time__in=times, canceled=False).values_list('time', 'machine'))
+        for time in times:
+            for machine in self.dataset.machines:
+                if (time, machine.number) not in taken:
+                    return time, machine
+        raise RuntimeError('no free slot left')
+
+    def book(self, user):
+        from wasch.models import Appointment
+        return Appointment.manager.make_appointment(
+            *self.free_slot(), user=user)
+
+    def timed(self, function, *args, **kwargs):
+        from wasch import instrumentation
+        with instrumentation.measure() as measurement:
+            result = function(*args, **kwargs)
+        self.samples.append(measurement)
+        return result
+
+    def run(self, name, repeat, warmup=1):
+        for _ in range(warmup):
+            SCENARIOS[name](self, 1)
+        self.samples = []
+        SCENARIOS[name](self, repeat)
+        times = [sample.total_time * 1000 for sample in self.samples]
+        return {
+            'runs': len(times),
+            'mean_ms': round(sum(times) / len(times), 3),
+            'p50_ms': round(percentile(times, 0.5), 3),
+            'p95_ms': round(percentile(times, 0.95), 3),
+            'max_ms': round(max(times), 3),
+            'queries': round(
+                sum(sample.queries for sample in self.samples)
+                / len(self.samples), 1),
+        }
+
+
+@scenario
+def book_page(runner, repeat):
+    from django.urls import reverse
+    for _ in range(repeat):
+        client = runner.client(next(runner.users))
+        runner.timed(client.get, reverse('wasch:book'))
+
+
+@scenario
+def make_appointment(runner, repeat):
+    for _ in range(repeat):
+        user = next(runner.users)
+        runner.timed(runner.book, user)
+
+
+@scenario
+def cancel(runner, repeat):
+    for _ in range(repeat):
+        appointment = runner.book(next(runner.users))
+        runner.timed(appointment.cancel)
+
+
+@scenario
+def activate(runner, repeat):
+    for _ in range(repeat):
+        user = next(runner.users)
+        appointment = runner.book(user)
+        response = runner.timed(
+            runner.client(user).post,
+            '/enteapi/v1/appointment/{}/activate/'.format(appointment.pk),
+            json.dumps({'enteId': 1}), content_type='application/json')
+        if response.status_code != 200:
+            raise RuntimeError('activate failed: {}'.format(
+                response.content))
+
+
+@scenario
+def remaining_ration(runner, repeat):
+    from wasch.models import WashUser
+    for _ in range(repeat):
+        washuser = WashUser.objects.get(pk=next(runner.users))
+        runner.timed(lambda: washuser.remaining_ration)
+
+
+def _get(name):
+    def get(runner, repeat):
+        from django.urls import reverse
+        for _ in range(repeat):
+            client = runner.client(next(runner.users))
+            runner.timed(client.get, reverse(name))
+    get.__name__ = name.split(':')[-1]
+    return get
+
+
+for _name in (
+        'wasch:stats', 'wasch:statsapi_appointments_per_day',
+        'wasch:statsapi_appointments_per_floor',
+        'wasch:statsapi_appointments_heatmap'):
+    scenario(_get(_name))
+
+
+def _revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'],
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(residents, machines, weeks, seed, repeat, names, rooms=1):
+    import django
+    from benchmarks.data import generate
+    dataset = generate(residents, machines, weeks, seed, rooms=rooms)
+    runner = Runner(dataset)
+    return {
+        'meta': {
+            'residents': residents,
+            'machines': machines,
+            'rooms': rooms,
+            'weeks': weeks,
+            'seed': seed,
+            'repeat': repeat,
+            'appointments': dataset.appointments,
+            'canceled': dataset.canceled,
+            'revision': _revision(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'sqlite': sqlite3.sqlite_version,
+        },
+        'scenarios': collections.OrderedDict(
+            (name, runner.run(name, repeat)) for name in names),
+    }
+
+
+def compare(before, after):
+    """Lines comparing the median times of two results"""
+    yield '{:40} {:>10} {:>10} {:>7} {:>13}'.format(
+        'scenario', 'before ms', 'after ms', 'ratio', 'queries')
+    for name, result in after['scenarios'].items():
+        previous = before['scenarios'].get(name)
+        if previous is None:
+            continue
+        yield '{:40} {:10.2f} {:10.2f} {:7.2f} {:>13}'.format(
+            name, previous['p50_ms'], result['p50_ms'],
+            result['p50_ms'] / previous['p50_ms'],
+            '{:g} -> {:g}'.format(previous['queries'], result['queries']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--residents', type=int, default=300)
+    parser.add_argument('--machines', type=int, default=3)
+    parser.add_argument('--rooms', type=int, default=1)
+    parser.add_argument('--weeks', type=int, default=12)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument(
+        '--scenario', action='append', choices=list(SCENARIOS),
+        help='run only this one, can be given several times')
+    parser.add_argument(
+        '--settings', default='pywaschedv.settings',
+        help='settings module, e. g. pywaschedv.settings_production')
+    parser.add_argument('--output', help='write results to this file')
+    parser.add_argument(
+        '--compare', nargs=2, metavar=('BEFORE', 'AFTER'),
+        help='compare two saved results instead of running')
+    args = parser.parse_args()
+    if args.compare:
+        results = []
+        for path in args.compare:
+            with open(path) as f:
+                results.append(json.load(f))
+        for line in compare(*results):
+            print(line)
+        return
+    with tempfile.TemporaryDirectory() as tmpdir:
+        setup_django(
+            args.settings, os.path.join(tmpdir, 'bench.sqlite3'),
+            DEBUG=False)
+        results = run(
+            args.residents, args.machines, args.weeks, args.seed,
+            args.repeat, args.scenario or list(SCENARIOS), args.rooms)
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        sys.stdout.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,90 @@
-from django.test import TestCase
+import datetime
+import json
+from django.test import SimpleTestCase, TestCase
+import peewee
+import legacymodels
+from enteapi.views import legacy_zeit_window
+from wasch.models import Appointment, WashingMachine, WashUser
+from wasch import tvkutils
 
-# Create your tests here.
+
+class LegacyListTestCase(SimpleTestCase):
+    def test_zeit_window(self):
+        day = datetime.date(2018, 1, 1)
+
+        def at(hour, minute):
+            return datetime.datetime.combine(day, datetime.time(hour, minute))
+
+        # 10:30 is the beginning of zeit 7
+        self.assertEqual(legacy_zeit_window(at(10, 20), at(10, 35)), [
+            (day, 7, 7)])
+        self.assertEqual(legacy_zeit_window(at(10, 30), at(10, 45)), [])
+        self.assertEqual(legacy_zeit_window(at(10, 15), at(10, 30)), [])
+        self.assertEqual(
+            legacy_zeit_window(at(23, 50), at(23, 50) + datetime.timedelta(
+                minutes=15)),
+            [(day + datetime.timedelta(days=1), 0, 0)])
+
+    def test_create_indexes(self):
+        database = peewee.SqliteDatabase(':memory:')
+        with database.bind_ctx([legacymodels.Termine]):
+            database.execute_sql(
+                'CREATE TABLE termine (bonus INTEGER, datum DATE, '
+                'maschine INTEGER, user INTEGER, wochentag INTEGER, '
+                'zeit INTEGER)')
+            legacymodels.create_indexes()
+            legacymodels.create_indexes()  # safe to repeat
+            indexes = database.get_indexes('termine')
+        self.assertEqual(
+            [index.columns for index in indexes],
+            [['datum', 'zeit', 'maschine']])
+
+
+class BookWindowTestCase(TestCase):
+    url = '/enteapi/v1/appointment/book_window/'
+
+    def setUp(self):
+        WashUser.objects.clear_cache()
+        Appointment.manager.clear_cache()
+        tvkutils.setup()
+        self.machine = tvkutils.get_or_create_machines()[0][0]
+        self.machine.isAvailable = True
+        self.machine.save()
+        self.user = WashUser.objects.create_enduser(
+            'apiexample', isActivated=True).user
+        self.time = Appointment.manager.scheduled_appointment_times()[-1]
+
+    def _post(self, data, **extra):
+        return self.client.post(
+            self.url, json.dumps(data), content_type='application/json',
+            **extra)
+
+    def test_book_window(self):
+        window = {
+            'earliest': self.time.isoformat(),
+            'latest': self.time.isoformat(),
+            'kind': 'washer',
+        }
+        self.assertEqual(self._post(window).status_code, 401)
+        self.client.force_login(self.user)
+        response = self._post(window, HTTP_IDEMPOTENCY_KEY='retry')
+        self.assertEqual(response.status_code, 201)
+        retried = self._post(window, HTTP_IDEMPOTENCY_KEY='retry')
+        self.assertEqual(retried.json()['pk'], response.json()['pk'])
+        appointment = Appointment.objects.get(pk=response.json()['pk'])
+        self.assertEqual(appointment.user, self.user)
+        self.assertEqual(appointment.time, self.time)
+        for machine in WashingMachine.objects.status().available:
+            if machine != appointment.machine:
+                Appointment.manager.make_appointment(
+                    self.time, machine, self.user)
+        response = self._post(window)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['error'], 42)
+        response = self.client.post(
+            '/enteapi/v1/appointment/waitlist/', json.dumps(window),
+            content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['kind'], 'washer')
+        self.assertEqual(
+            self._post({'earliest': 'soon'}).status_code, 400)
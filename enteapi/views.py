@@ -1,3 +1,4 @@
+import concurrent.futures
 import datetime
 import json
 import traceback
@@ -9,11 +10,17 @@ from rest_framework.decorators import detail_route, list_route
 from rest_framework.parsers import JSONParser
 from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
-from rest_framework.permissions import BasePermission
+from rest_framework.permissions import BasePermission, IsAuthenticated
 from wasch.models import (
-    Appointment, STATUS_CHOICES, WashingMachine, WashUser, AppointmentError,
+    Appointment, STATUS_CHOICES, WaitlistEntry, WashingMachine, WashUser,
+    AppointmentError, AppointmentManager,
 )
-from wasch.serializers import AppointmentSerializer
+from wasch.serializers import (
+    AppointmentSerializer, BookingWindowSerializer, WaitlistEntrySerializer,
+)
+from wasch import bookingqueue, metrics, payment
+from wasch.legacydb import retry_on_disconnect
+from wasch.routers import reading_replica
 if settings.WASCH_USE_LEGACY:
     from legacymodels import (
         Termine, DoesNotExist, Waschmaschinen, Users as LegacyUser,
@@ -27,7 +34,7 @@ def machine_ready(machineId):
     if settings.WASCH_USE_LEGACY:
         state = Waschmaschinen.get(Waschmaschinen.id == machineId).status
         return state == 1
-    return WashingMachine.objects.get(number=machineId).isAvailable
+    return WashingMachine.objects.status().get(int(machineId)).isAvailable
 
 
 def time_from_legacy_zeit(zeit):
@@ -36,15 +43,19 @@ def time_from_legacy_zeit(zeit):
     return datetime.time(hour, minute)
 
 
-def appointment_from_legacy(termine):
+def appointment_from_legacy(termine, legacy_user=None):
+    """
+    :param legacy_user legacymodels.Users: user of termine, if already
+        fetched; otherwise it's queried
+    """
     time = datetime.datetime.combine(
             termine.datum, time_from_legacy_zeit(termine.zeit))
     # time = datetime.datetime(
     #        termine.year, termine.month, termine.day, hour, minute)
-    print('Termin found at {}'.format(time))
     # not reading from or writing to django database since id's might be
     # assigned differently
-    legacy_user = LegacyUser.get(LegacyUser.id == termine.user)
+    if legacy_user is None:
+        legacy_user = LegacyUser.get(LegacyUser.id == termine.user)
     user = WashUser(
         user=User(username=legacy_user.login),
         isActivated=not legacy_user.gesperrt,
@@ -59,6 +70,30 @@ def appointment_from_legacy(termine):
     return appointment
 
 
+def legacy_zeit_window(start, end):
+    """Legacy appointments beginning after start and before end
+
+    :return list(tuple): datum, first and last zeit for each day
+    """
+    interval = datetime.timedelta(
+        minutes=AppointmentManager.interval_minutes)
+    last_zeit = AppointmentManager.appointments_per_day - 1
+    window = []
+    datum = start.date()
+    while datum <= end.date():
+        day_begin = datetime.datetime.combine(datum, datetime.time())
+        first = 0
+        if datum == start.date():
+            first = (start - day_begin) // interval + 1
+        last = last_zeit
+        if datum == end.date():
+            last = min(last, -((day_begin - end) // interval) - 1)
+        if first <= last:
+            window.append((datum, first, last))
+        datum += datetime.timedelta(days=1)
+    return window
+
+
 def _legacy_use(reference):
     '''
     :param int bookingId:
@@ -129,6 +164,8 @@ def _use(reference, enteId, user=None):
     return 'OK'
 
 
+IDEMPOTENCY_KEY_LENGTH = 64
+
 ACTIVATE_PERIOD = datetime.timedelta(seconds=15*60)
 # ACTIVATE_PERIOD = datetime.timedelta(days=27)  # XXX easy testing!
 
@@ -169,6 +206,7 @@ class AppointmentViewSet(viewsets.ReadOnlyModelViewSet):
         enteId = reqdata['enteId']
         reference = Appointment.objects.get(pk=pk).reference
         error = _use(reference, enteId, request.user)
+        metrics.ENTE_ACTIVATIONS.inc(result=error)
         print('activated appointment {} from ente {}@{} --> {}'.format(
             reference, enteId, request.META['REMOTE_ADDR'], error))
         return Response({
@@ -178,31 +216,69 @@ class AppointmentViewSet(viewsets.ReadOnlyModelViewSet):
             'error': error,
             }, status=200 if error == 'OK' else 400)
 
+    @list_route(methods=['POST'], permission_classes=[IsAuthenticated])
+    def book_window(self, request):
+        """Book any free machine beginning between earliest and latest"""
+        window = BookingWindowSerializer(data=request.data)
+        window.is_valid(raise_exception=True)
+        key = request.META.get('HTTP_IDEMPOTENCY_KEY')
+        if key is not None:
+            if not 0 < len(key) <= IDEMPOTENCY_KEY_LENGTH:
+                return Response({
+                    'error': 'Idempotency-Key has to have 1 to {} '
+                    'characters'.format(IDEMPOTENCY_KEY_LENGTH),
+                    }, status=400)
+            # keys of different users don't collide
+            key = 'enteapi:{}:{}'.format(request.user.pk, key)
+        try:
+            appointment = bookingqueue.book_window(
+                request.user, idempotency_key=key, **window.validated_data)
+        except AppointmentError as error:
+            return Response({
+                'error': error.reason,
+                'reason': str(error),
+                }, status=409)
+        except payment.PaymentError:
+            return Response({'error': 'PAYMENT_FAILED'}, status=402)
+        except concurrent.futures.TimeoutError:
+            return Response({'error': 'BUSY'}, status=503)
+        return Response(self.get_serializer(appointment).data, status=201)
+
+    @list_route(methods=['POST'], permission_classes=[IsAuthenticated])
+    def waitlist(self, request):
+        """Wait for an appointment beginning between earliest and latest to
+        be canceled, which is then booked for the user"""
+        entry = WaitlistEntrySerializer(data=request.data)
+        entry.is_valid(raise_exception=True)
+        try:
+            entry = WaitlistEntry.objects.join(
+                request.user, **entry.validated_data)
+        except AppointmentError as error:
+            return Response({
+                'error': error.reason,
+                'reason': str(error),
+                }, status=409)
+        return Response(WaitlistEntrySerializer(entry).data, status=201)
+
     @list_route()
+    @retry_on_disconnect
     def legacy_list(self, request):
         end = datetime.datetime.now()
         start = end - ACTIVATE_PERIOD
-        # endzeit = (end.hour * 2 + start.minute // 30) // 3
-        # startzeit = (start.hour * 2 + start.minute // 30) // 3
-        # aday = datetime.timedelta(days=1)
-        termine = Termine.select().where(
-                Termine.datum.between(start.date(), end.date())
-                # | (
-                #     Termine.datum.between(start.date(), end.date() - aday)
-                #     & Termine.zeit > startzeit
-                # ) | (
-                #     Termine.datum.between(start.date() + aday, end.date())
-                #     & Termine.zeit < endzeit
-                # ) | (
-                #     Termine.datum.between(start.date(), end.date())
-                #     & Termine.zeit.between(startzeit, endzeit)
-                # )
-                ).execute()
-        appomts = [appointment_from_legacy(a) for a in termine if (
-            (datetime.datetime.combine(
-                a.datum, time_from_legacy_zeit(a.zeit)) < end)
-            and (datetime.datetime.combine(
-                a.datum, time_from_legacy_zeit(a.zeit)) > start))]
+        condition = None
+        for datum, first, last in legacy_zeit_window(start, end):
+            term = (Termine.datum == datum) & Termine.zeit.between(
+                first, last)
+            condition = term if condition is None else condition | term
+        if condition is None:  # no appointment can begin in between
+            return Response([])
+        termine = list(Termine.select().where(condition).execute())
+        legacy_users = {
+            legacy_user.id: legacy_user for legacy_user in LegacyUser.select()
+            .where(LegacyUser.id.in_(list({a.user for a in termine})))}
+        appomts = [
+            appointment_from_legacy(a, legacy_users[a.user]) for a in termine
+            if a.user in legacy_users]
         return Response(self.get_serializer(appomts, many=True).data)
 
     def get_queryset(self):
@@ -210,18 +286,23 @@ class AppointmentViewSet(viewsets.ReadOnlyModelViewSet):
         start = end - ACTIVATE_PERIOD
         return Appointment.objects.filter(time__range=(start, end))
 
+    def list(self, request, *args, **kwargs):
+        with reading_replica(request):
+            return super().list(request, *args, **kwargs)
+
     @list_route()
     def last_used_for_each_machine(self, request):
         now = datetime.datetime.now()
-        machines = WashingMachine.objects.all()
         appomts = []
-        for machine in machines:
-            try:
-                appomts.append(
-                        Appointment.objects
-                        .filter(machine=machine, wasUsed=True, time__lt=now)
-                        .latest('time'),
-                        )
-            except Appointment.DoesNotExist:
-                pass
-        return Response(self.get_serializer(appomts, many=True).data)
+        with reading_replica(request):
+            for machine in WashingMachine.objects.all():
+                try:
+                    appomts.append(
+                            Appointment.objects
+                            .filter(
+                                machine=machine, wasUsed=True, time__lt=now)
+                            .latest('time'),
+                            )
+                except Appointment.DoesNotExist:
+                    pass
+            return Response(self.get_serializer(appomts, many=True).data)
@@ -1,6 +1,32 @@
 from peewee import *
-
-database = MySQLDatabase('anonwaschag', **{'password': 'waschagpassword', 'user': 'waschag'})
+from playhouse.pool import PooledMySQLDatabase, PooledSqliteDatabase
+
+# initialized by init_database
+database = DatabaseProxy()
+
+
+def init_database(config):
+    """Initialize the legacy database as a connection pool
+
+    :param config dict: like a Django DATABASES entry with ENGINE (mysql
+        or sqlite), NAME, USER, PASSWORD, HOST, PORT and additionally
+        MAX_CONNECTIONS and STALE_TIMEOUT (seconds) for the pool
+    """
+    pool_kwargs = {
+        'max_connections': config.get('MAX_CONNECTIONS', 8),
+        'stale_timeout': config.get('STALE_TIMEOUT', 300),
+    }
+    if config.get('ENGINE', 'mysql') == 'sqlite':
+        pooled = PooledSqliteDatabase(config['NAME'], **pool_kwargs)
+    else:
+        connect_kwargs = {
+            key.lower(): config[key]
+            for key in ('USER', 'PASSWORD', 'HOST', 'PORT') if config.get(key)
+        }
+        connect_kwargs.update(pool_kwargs)
+        pooled = PooledMySQLDatabase(config['NAME'], **connect_kwargs)
+    database.initialize(pooled)
+    return pooled
 
 class UnknownField(object):
     def __init__(self, *_, **__): pass
@@ -79,6 +105,9 @@ class Termine(BaseModel):
 
     class Meta:
         db_table = 'termine'
+        indexes = (
+            (('datum', 'zeit', 'maschine'), False),
+        )
         primary_key = False
 
 class Users(BaseModel):
@@ -121,3 +150,9 @@ class Waschmaschinen(BaseModel):
         db_table = 'waschmaschinen'
         primary_key = False
 
+
+def create_indexes(safe=True):
+    """Create indexes missing in the legacy schema (only declared here),
+    i. e. termine (datum, zeit, maschine) for appointments in a time range
+    """
+    Termine._schema.create_indexes(safe=safe)
@@ -51,13 +51,17 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'wasch.instrumentation.InstrumentationMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'wasch.profiling.ProfilingMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'wasch.legacydb.LegacyConnectionMiddleware',
+    'wasch.routers.ReadReplicaMiddleware',
 ]
 
 ROOT_URLCONF = 'pywaschedv.urls'
@@ -91,6 +95,19 @@ DATABASES = {
     }
 }
 
+# read-only pages may read from a replica, a copy of the default database
+# refreshed by `manage.py snapshot_replica --interval 60` (see wasch.routers);
+# e. g. DATABASES['replica'] = {'ENGINE': ..., 'NAME': '.../replica.sqlite3'}
+# and WASCH_READ_REPLICA = 'replica'
+
+DATABASE_ROUTERS = ['wasch.routers.ReadReplicaRouter']
+
+WASCH_READ_REPLICA = None
+
+# after writing, a session reads from the default database for this long
+# (seconds), so it doesn't miss its own writes on the replica
+
+WASCH_READ_REPLICA_PIN = 120
 
 AUTHENTICATION_BACKENDS = [
     'wasch.auth.GodOnlyBackend',
@@ -158,6 +175,75 @@ REST_FRAMEWORK = {
 
 WASCH_USE_LEGACY = False
 
+# legacy database, used as connection pool; ENGINE is mysql or sqlite
+
+WASCH_LEGACY_DATABASE = {
+    'ENGINE': 'mysql',
+    'NAME': os.environ.get('WASCH_LEGACY_NAME', 'anonwaschag'),
+    'USER': os.environ.get('WASCH_LEGACY_USER', 'waschag'),
+    'PASSWORD': os.environ.get('WASCH_LEGACY_PASSWORD', 'waschagpassword'),
+    'HOST': os.environ.get('WASCH_LEGACY_HOST', ''),
+    'PORT': int(os.environ.get('WASCH_LEGACY_PORT', 3306)),
+    'MAX_CONNECTIONS': 8,
+    'STALE_TIMEOUT': 300,  # seconds
+}
+
+# directory for archived appointments (see wasch.archive)
+
+WASCH_ARCHIVE_DIR = os.path.join(BASE_DIR, 'archive')
+
+# measure queries, time and cache hits of requests (see wasch.instrumentation)
+
+WASCH_INSTRUMENTATION = True
+
+# also count the queries of every request (always with DEBUG), which makes
+# the connections log them; needed for WASCH_QUERY_BUDGETS
+
+WASCH_INSTRUMENTATION_QUERIES = False
+
+# maximum number of queries per request by URL name; exceeding requests are
+# logged or, if strict, fail
+
+WASCH_QUERY_BUDGETS = {
+    'wasch:index': 7,
+    'wasch:book': 13,
+    'wasch:status': 4,
+    'wasch:do_book': 30,
+    'wasch:do_book_window': 31,
+    'wasch:do_cancel': 19,
+    'wasch:stats': 5,
+    'wasch:statsapi_appointments_per_day': 62,
+    'wasch:statsapi_appointments_per_floor': 4,
+    'wasch:statsapi_appointments_heatmap': 4,
+    'appointment-list': 6,
+    'appointment-last-used-for-each-machine': 9,
+}
+
+WASCH_QUERY_BUDGETS_STRICT = False
+
+# apply bookings and cancellations of a process by one writer thread, in
+# transactions of up to WASCH_BOOKING_QUEUE_BATCH of them; requests wait up
+# to WASCH_BOOKING_QUEUE_TIMEOUT seconds (see wasch.bookingqueue)
+
+WASCH_BOOKING_QUEUE = False
+
+WASCH_BOOKING_QUEUE_BATCH = 16
+
+WASCH_BOOKING_QUEUE_TIMEOUT = 10
+
+# threads of a process running outbox tasks (e. g. refunds) after commit;
+# with 0, only the run_outbox command runs them (see wasch.outbox)
+
+WASCH_OUTBOX_WORKERS = 0
+
+# profile requests of staff sending the header X-Wasch-Profile and this
+# share of all requests, saving results in WASCH_PROFILE_DIR
+# (see wasch.profiling)
+
+WASCH_PROFILE_SAMPLE_RATE = 0.0
+
+WASCH_PROFILE_DIR = os.path.join(BASE_DIR, 'profiles')
+
 # For KasseBackend, please start vereinskassensystem here
 
 KASSE_TOKEN_URL = 'http://localhost:9889/api/get_token/'
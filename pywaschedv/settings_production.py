@@ -0,0 +1,39 @@
+"""
+Django settings for running pywaschedv on SQLite in production.
+
+Use by setting DJANGO_SETTINGS_MODULE=pywaschedv.settings_production.
+"""
+
+from pywaschedv.settings import *  # noqa: F401,F403
+
+# SQLite tuned for concurrent booking: WAL lets readers continue while one
+# writer commits, booking transactions take the write lock at once (see
+# wasch.db.immediate_atomic) and wait up to timeout seconds for it.
+
+DATABASES['default'].update({  # noqa: F405
+    'ENGINE': 'wasch.backends.sqlite3',
+    'CONN_MAX_AGE': 600,  # seconds
+    'OPTIONS': {
+        'timeout': 20,  # seconds, busy timeout
+        'pragmas': {
+            'journal_mode': 'WAL',
+            'synchronous': 'NORMAL',  # durable enough with WAL
+            'cache_size': -16000,  # KiB
+            'temp_store': 'MEMORY',
+        },
+    },
+})
+
+# one JSON line per request with queries, time and cache hits
+# (see wasch.instrumentation)
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'wasch.instrumentation': {'handlers': ['console'], 'level': 'INFO'},
+    },
+}
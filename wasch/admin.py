@@ -1,5 +1,5 @@
 from django.contrib import admin
-from wasch.models import WashUser, WashingMachine, WashParameters
+from wasch.models import Room, WashUser, WashingMachine, WashParameters
 
 
 @admin.register(WashUser)
@@ -8,9 +8,16 @@ class WashUserAdmin(admin.ModelAdmin):
     ordering = ['user']
 
 
+@admin.register(Room)
+class RoomAdmin(admin.ModelAdmin):
+    list_display = ['name']
+    ordering = ['name']
+
+
 @admin.register(WashingMachine)
 class WashingMachineAdmin(admin.ModelAdmin):
-    list_display = ['__str__', 'isAvailable', 'notes']
+    list_display = ['__str__', 'room', 'kind', 'isAvailable', 'notes']
+    list_filter = ['room', 'kind']
     ordering = ['number']
 
 
@@ -1,4 +1,12 @@
 from django.apps import AppConfig
+from django.conf import settings
+
 
 class WaschConfig(AppConfig):
     name = 'wasch'
+
+    def ready(self):
+        from wasch import outbox  # noqa: F401, connects its receiver
+        if settings.WASCH_USE_LEGACY:
+            from wasch import legacydb
+            legacydb.configure()
@@ -0,0 +1,427 @@
+"""Cold archive of old appointments and their transactions
+
+Appointments older than a number of months are moved, together with
+their transactions, from the database to gzip compressed JSON lines files,
+one per month (by local time of the appointment), which are only ever
+appended to. Counts per day are kept in a small summary file, so stats
+can include archived appointments without reading the archive. With the
+counts of each month the size of its file is kept, and a month whose file
+changed is counted again, so the summary follows the archive files even
+if the process stopped between archiving and counting.
+
+Appointments with unfinished outbox tasks or with idempotency keys which
+may still be retried with stay in the database until these are done.
+
+Archived appointments are subject to retention time, too: those expired
+when archived are written anonymized, like retention.purge anonymizes
+their transactions, and anonymize_expired() rewrites the months holding
+appointments which expired later. Appending and rewriting lock the
+archive directory against each other.
+"""
+import contextlib
+import datetime
+import fcntl
+import gzip
+import json
+import os
+import re
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from wasch import retention
+from wasch.db import immediate_atomic
+from wasch.models import (
+    Appointment, IdempotencyKey, OutboxTask, Transaction, UpcomingAppointment,
+    WashUser,
+)
+
+BATCH_SIZE = 1000
+
+# idempotency keys younger than this may still be retried with
+KEY_LIFETIME = datetime.timedelta(days=1)
+
+SUMMARY_NAME = 'summary.json'
+LOCK_NAME = 'archive.lock'
+MONTH_TEMPLATE = 'appointments-{:04d}-{:02d}.jsonl.gz'
+MONTH_PATTERN = re.compile(r'^appointments-(\d{4})-(\d{2})\.jsonl\.gz$')
+
+TRANSACTION_FIELDS = (
+    'id', 'fromUser_id', 'toUser_id', 'value', 'isBonus', 'notes', 'method',
+    'methodReference',
+)
+
+
+def archive_dir():
+    return settings.WASCH_ARCHIVE_DIR
+
+
+def cutoff(months, now=None):
+    """beginning of the month months before the month of now"""
+    if now is None:
+        now = timezone.now()
+    local = timezone.localtime(now)
+    month_index = local.year * 12 + local.month - 1 - months
+    return timezone.make_aware(datetime.datetime(
+        month_index // 12, month_index % 12 + 1, 1))
+
+
+def _records(rows):
+    """archive records for rows of appointment values"""
+    appointment_ids = [row['id'] for row in rows]
+    transaction_ids = {}
+    for appointment_id, transaction_id in (
+            Appointment.transactions.through.objects
+            .filter(appointment_id__in=appointment_ids)
+            .values_list('appointment_id', 'transaction_id')):
+        transaction_ids.setdefault(appointment_id, []).append(transaction_id)
+    transactions = {
+        row['id']: row for row in Transaction.objects.filter(pk__in=[
+            pk for pks in transaction_ids.values() for pk in pks
+        ]).values(*TRANSACTION_FIELDS)}
+    user_ids = {row['user_id'] for row in rows}
+    for row in transactions.values():
+        user_ids.update((row['fromUser_id'], row['toUser_id']))
+    usernames = dict(
+        User.objects.filter(pk__in=user_ids).values_list('pk', 'username'))
+    for row in rows:
+        yield {
+            'id': row['id'],
+            'time': row['time'].isoformat(),
+            'user': usernames.get(row['user_id']),
+            'machine': row['machine_id'],
+            'wasUsed': row['wasUsed'],
+            'canceled': row['canceled'],
+            'refundableTransaction': row['refundableTransaction_id'],
+            'transactions': [
+                {
+                    'id': t['id'],
+                    'fromUser': usernames.get(t['fromUser_id']),
+                    'toUser': usernames.get(t['toUser_id']),
+                    'value': t['value'],
+                    'isBonus': t['isBonus'],
+                    'notes': t['notes'],
+                    'method': t['method'],
+                    'methodReference': t['methodReference'],
+                }
+                for t in (
+                    transactions[pk] for pk in transaction_ids.get(
+                        row['id'], []))
+            ],
+        }
+
+
+def _anonymize(record, anonymous_name):
+    """Replace the user of record by anonymous_name in the record and its
+    transactions, removing their notes"""
+    name = record['user']
+    record['user'] = anonymous_name
+    for t in record['transactions']:
+        for role in ('fromUser', 'toUser'):
+            if t[role] == name:
+                t[role] = anonymous_name
+                t['notes'] = ''
+
+
+@contextlib.contextmanager
+def _locked(directory):
+    with open(os.path.join(directory, LOCK_NAME), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _append(directory, records_by_month):
+    """:return dict: size of each file before appending, by path"""
+    sizes = {}
+    for (year, month), records in records_by_month.items():
+        path = os.path.join(directory, MONTH_TEMPLATE.format(year, month))
+        sizes[path] = os.path.getsize(path) if os.path.exists(path) else 0
+        # every append is a gzip member of its own, which gzip reads as one
+        with open(path, 'ab') as raw:
+            with gzip.GzipFile(fileobj=raw, mode='ab') as archive_file:
+                for record in records:
+                    archive_file.write(
+                        (json.dumps(record) + '\n').encode())
+            raw.flush()
+            os.fsync(raw.fileno())
+    return sizes
+
+
+def _truncate(sizes):
+    """undo _append"""
+    for path, size in sizes.items():
+        if size:
+            os.truncate(path, size)
+        else:
+            os.remove(path)
+
+
+def archive_batch(before, batch_size=BATCH_SIZE, directory=None):
+    """Move up to batch_size appointments before the given time to the
+    archive
+
+    :return int: number of archived appointments
+    """
+    if directory is None:
+        directory = archive_dir()
+    os.makedirs(directory, exist_ok=True)
+    with _locked(directory):
+        count = _archive_batch(before, batch_size, directory)
+    if count:
+        summary(directory)  # counts the appended months
+    return count
+
+
+def _archive_batch(before, batch_size, directory):
+    sizes = {}
+    try:
+        with immediate_atomic():
+            rows = list(
+                Appointment.objects.filter(time__lt=before)
+                .exclude(transactions__outbox_tasks__state__in=[
+                    'pending', 'failed'])
+                .exclude(transactions__idempotency_key__created__gte=(
+                    timezone.now() - KEY_LIFETIME))
+                .order_by('pk').values(
+                    'id', 'time', 'user_id', 'machine_id', 'wasUsed',
+                    'canceled', 'refundableTransaction_id')[:batch_size])
+            if not rows:
+                return 0
+            records = list(_records(rows))
+            expired = set(retention.expired_appointments().filter(
+                pk__in=[row['id'] for row in rows]).values_list(
+                    'pk', flat=True))
+            if expired:
+                anonymous, _ = WashUser.objects.get_or_create_anonymous_user()
+                for record in records:
+                    if record['id'] in expired:
+                        _anonymize(record, anonymous.user.username)
+            records_by_month = {}
+            for row, record in zip(rows, records):
+                local = timezone.localtime(row['time'])
+                records_by_month.setdefault(
+                    (local.year, local.month), []).append(record)
+            # written before deleting; if deleting fails, appending is
+            # undone
+            sizes = _append(directory, records_by_month)
+            _delete(rows, records)
+    except BaseException:
+        _truncate(sizes)
+        raise
+    return len(rows)
+
+
+def _delete(rows, records):
+    appointment_ids = [row['id'] for row in rows]
+    transaction_ids = [
+        t['id'] for record in records for t in record['transactions']]
+    Appointment.transactions.through.objects.filter(
+        appointment_id__in=appointment_ids).delete()
+    # no need for cascading in Python, which would create (and check)
+    # every instance
+    UpcomingAppointment.objects.filter(
+        appointment_id__in=appointment_ids)._raw_delete(
+            UpcomingAppointment.objects.db)
+    Appointment.objects.filter(pk__in=appointment_ids)._raw_delete(
+        Appointment.objects.db)
+    # tasks are done and keys expired, see archive_batch
+    for model in (IdempotencyKey, OutboxTask):
+        model.objects.filter(
+            transaction_id__in=transaction_ids)._raw_delete(
+                model.objects.db)
+    Transaction.objects.filter(pk__in=transaction_ids)._raw_delete(
+        Transaction.objects.db)
+
+
+def archive(months, batch_size=BATCH_SIZE, directory=None, report=None):
+    """Move all appointments from before the month months ago to the
+    archive
+
+    :return int: number of archived appointments
+    """
+    before = cutoff(months)
+    archived = 0
+    while True:
+        count = archive_batch(before, batch_size, directory)
+        if not count:
+            return archived
+        archived += count
+        if report is not None:
+            report('archived {} appointments'.format(archived))
+
+
+def _anonymize_month(path, cutoff, waschag_cutoff, anonymous_name):
+    with gzip.open(path, 'rt') as archive_file:
+        records = [json.loads(line) for line in archive_file]
+    waschag = set(User.objects.filter(
+        username__in={record['user'] for record in records},
+        washuser__status__gte=retention.WASCHAG_STATUS,
+    ).values_list('username', flat=True))
+    anonymized = 0
+    for record in records:
+        if record['user'] in (None, anonymous_name):
+            continue
+        expires = waschag_cutoff if record['user'] in waschag else cutoff
+        if parse_datetime(record['time']) < expires:
+            _anonymize(record, anonymous_name)
+            anonymized += 1
+    if not anonymized:
+        return 0
+    with open(path + '.tmp', 'wb') as raw:
+        with gzip.GzipFile(fileobj=raw, mode='wb') as archive_file:
+            for record in records:
+                archive_file.write((json.dumps(record) + '\n').encode())
+        raw.flush()
+        os.fsync(raw.fileno())
+    os.replace(path + '.tmp', path)
+    return anonymized
+
+
+def anonymize_expired(now=None, directory=None):
+    """Anonymize archived appointments past retention time (see
+    retention.cutoffs), rewriting the months holding them
+
+    :return int: number of anonymized appointments
+    """
+    if directory is None:
+        directory = archive_dir()
+    cutoff, waschag_cutoff = retention.cutoffs(now)
+    latest = timezone.localtime(max(cutoff, waschag_cutoff)).date()
+    anonymous, _ = WashUser.objects.get_or_create_anonymous_user()
+    anonymized = 0
+    for name, year, month in _month_files(directory):
+        if datetime.date(year, month, 1) > latest:
+            break  # nothing expired yet
+        with _locked(directory):
+            anonymized += _anonymize_month(
+                os.path.join(directory, name), cutoff, waschag_cutoff,
+                anonymous.user.username)
+    return anonymized
+
+
+_summary_cache = {}
+
+
+def _month_files(directory):
+    """(name, year, month) of the archive files in directory, by month"""
+    try:
+        names = sorted(os.listdir(directory))
+    except FileNotFoundError:
+        return []
+    return [
+        (name, int(match.group(1)), int(match.group(2)))
+        for name, match in ((name, MONTH_PATTERN.match(name))
+                            for name in names)
+        if match is not None]
+
+
+def _month_records(path):
+    seen = set()  # in case a batch was archived but not deleted
+    with gzip.open(path, 'rt') as archive_file:
+        for line in archive_file:
+            record = json.loads(line)
+            if record['id'] in seen:
+                continue
+            seen.add(record['id'])
+            record['time'] = parse_datetime(record['time'])
+            yield record
+
+
+def _count(path):
+    """counts (all, used, canceled) per day (ISO format) in archive file"""
+    days = {}
+    for record in _month_records(path):
+        day = timezone.localtime(record['time']).date()
+        counts = days.setdefault(day.isoformat(), [0, 0, 0])
+        counts[0] += 1
+        counts[1] += int(record['wasUsed'])
+        counts[2] += int(record['canceled'])
+    return days
+
+
+def _read_summary(directory, sizes):
+    """counts per day of the archive files of sizes (by name), counting
+    those which the summary file doesn't have in their size again"""
+    path = os.path.join(directory, SUMMARY_NAME)
+    try:
+        with open(path) as summary_file:
+            months = json.load(summary_file)
+    except FileNotFoundError:
+        months = {}
+    changed = set(months) != set(sizes)
+    for name, size in sizes.items():
+        if months.get(name, {}).get('size') != size:
+            months[name] = {
+                'size': size, 'days': _count(os.path.join(directory, name))}
+            changed = True
+    if changed:
+        months = {name: months[name] for name in sizes}
+        with open(path + '.tmp', 'w') as summary_file:
+            json.dump(months, summary_file, sort_keys=True)
+        os.replace(path + '.tmp', path)
+    days = {}
+    for month in months.values():
+        days.update(month['days'])
+    return days
+
+
+def summary(directory=None):
+    """counts (all, used, canceled) of archived appointments per day
+    (ISO format)"""
+    if directory is None:
+        directory = archive_dir()
+    sizes = {
+        name: os.path.getsize(os.path.join(directory, name))
+        for name, _, _ in _month_files(directory)}
+    cached = _summary_cache.get(directory)
+    if cached is None or cached[0] != sizes:
+        cached = sizes, _read_summary(directory, sizes)
+        _summary_cache[directory] = cached
+    return cached[1]
+
+
+def appointments_per_day(day, used=None, directory=None):
+    counts = summary(directory).get(day.isoformat())
+    if counts is None:
+        return 0
+    if used is None:
+        return counts[0]
+    return counts[1] if used else counts[0] - counts[1]
+
+
+def appointments_count(used=None, canceled=None, directory=None):
+    """number of archived appointments, optionally only (not) used or
+    (not) canceled ones"""
+    total = used_count = canceled_count = 0
+    for counts in summary(directory).values():
+        total += counts[0]
+        used_count += counts[1]
+        canceled_count += counts[2]
+    if used is not None:
+        return used_count if used else total - used_count
+    if canceled is not None:
+        return canceled_count if canceled else total - canceled_count
+    return total
+
+
+def iter_archived(start=None, end=None, directory=None):
+    """archived appointment records from start to end (dates, inclusive),
+    with time as aware datetime"""
+    if directory is None:
+        directory = archive_dir()
+    for name, year, month in _month_files(directory):
+        first = datetime.date(year, month, 1)
+        if start is not None and first < start.replace(day=1):
+            continue
+        if end is not None and first > end:
+            continue
+        for record in _month_records(os.path.join(directory, name)):
+            day = timezone.localtime(record['time']).date()
+            if start is not None and day < start:
+                continue
+            if end is not None and day > end:
+                continue
+            yield record
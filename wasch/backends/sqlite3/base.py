@@ -0,0 +1,30 @@
+"""SQLite backend for production use
+
+Like django.db.backends.sqlite3, with two additions:
+
+ - OPTIONS may contain 'pragmas', a dict of PRAGMAs set on every new
+   connection, e. g. {'journal_mode': 'WAL'}
+ - transactions of wasch.db.immediate_atomic begin with BEGIN IMMEDIATE,
+   i. e. take the write lock right away instead of failing with "database
+   is locked" when upgrading from a read lock
+"""
+from django.db.backends.sqlite3 import base
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    begin_immediate = False
+
+    def get_connection_params(self):
+        kwargs = super().get_connection_params()
+        self.pragmas = kwargs.pop('pragmas', {})
+        return kwargs
+
+    def get_new_connection(self, conn_params):
+        conn = super().get_new_connection(conn_params)
+        for name, value in self.pragmas.items():
+            conn.execute('PRAGMA {} = {}'.format(name, value))
+        return conn
+
+    def _start_transaction_under_autocommit(self):
+        self.cursor().execute(
+            'BEGIN IMMEDIATE' if self.begin_immediate else 'BEGIN')
@@ -0,0 +1,45 @@
+"""Cache of the rendered grid of the book page
+
+The grid of upcoming appointments looks the same for everyone who may
+book: free slots link to booking, taken ones are not available. It is
+rendered once per room, availability version, first scheduled time (i. e.
+until the clock crosses a slot boundary) and whether the user may book at
+all, and kept in django.core.cache; the book view then only overlays the
+appointments of the user. Saving or deleting appointments calls
+invalidate() for the room of their machine, saving or deleting machines
+for all rooms (see the receivers in wasch.models).
+
+With several processes, configure a cache shared by all of them in
+settings.CACHES, otherwise each one only sees its own invalidations.
+"""
+from django.core.cache import cache
+from wasch import stamps
+from wasch.instrumentation import record_cache
+
+STAMP = 'bookgrid'
+TIMEOUT = 90 * 60  # seconds, a grid is outdated after one slot anyway
+
+
+def _room_stamp(room_id):
+    return '{}:{}'.format(STAMP, room_id)
+
+
+def version(room_id):
+    return '{}.{}'.format(stamps.get(STAMP), stamps.get(_room_stamp(room_id)))
+
+
+def invalidate(room_id=None):
+    """Make the grids of the room stale, of all rooms without room_id"""
+    stamps.bump(STAMP if room_id is None else _room_stamp(room_id))
+
+
+def grid(room_id, first_time, can_book, render):
+    """Cached HTML of the grid, from render() on a miss"""
+    key = 'wasch:bookgrid:{}:{}:{}:{:d}'.format(
+        room_id, version(room_id), first_time.isoformat(), can_book)
+    html = cache.get(key)
+    record_cache('bookgrid', html is not None)
+    if html is None:
+        html = render()
+        cache.set(key, html, TIMEOUT)
+    return html
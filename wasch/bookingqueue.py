@@ -0,0 +1,180 @@
+"""Optional booking pipeline with a single writer
+
+With settings.WASCH_BOOKING_QUEUE, bookings and cancellations of this
+process are enqueued instead of run by the requesting thread. One writer
+thread takes up to WASCH_BOOKING_QUEUE_BATCH queued requests at a time and
+applies them in one transaction, each in a savepoint of its own, so a
+failing request doesn't affect the others of its group. Callers wait for
+their result on a concurrent.futures.Future, which is resolved after the
+group committed. If the group fails as a whole, every caller of it gets
+the error, and the payments its requests made, which happened outside of
+the database, are refunded.
+
+As only the writer thread writes, threads of the process no longer
+contend for the SQLite write lock (nor hold it while waiting for each
+other's payments). Run one process for booking or expect contention
+between processes, as before. Requests see what was committed before
+they were applied, not an open transaction of their caller.
+"""
+import concurrent.futures
+import logging
+import queue
+import threading
+from django.conf import settings
+from django.db import connection
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from wasch import metrics, payment
+from wasch.db import immediate_atomic
+from wasch.models import Appointment, Transaction
+
+logger = logging.getLogger(__name__)
+
+_group = threading.local()
+
+
+@receiver(post_save, sender=Transaction)
+def _collect_payment(sender, instance, created, **kwargs):
+    payments = getattr(_group, 'payments', None)
+    if created and payments is not None:
+        payments.append(instance)
+
+
+def _refund_rolled_back(payments):
+    for paid in payments:
+        try:
+            payment.refund(
+                paid.method, paid.methodReference,
+                idempotency_key='bookingqueue-rollback:{}:{}'.format(
+                    paid.method, paid.methodReference))
+        except Exception:
+            logger.exception(
+                'refund of rolled back payment %s %s failed', paid.method,
+                paid.methodReference)
+
+
+class BookingQueue:
+    def __init__(self, batch_size=16, start=True):
+        """
+        :param start bool: start the writer thread; if False, call
+            run_pending() to apply queued requests in the current thread
+        """
+        self.batch_size = batch_size
+        self._requests = queue.Queue()
+        self._thread = None
+        if start:
+            self._thread = threading.Thread(
+                target=self._run, name='wasch-booking-writer', daemon=True)
+            self._thread.start()
+
+    def submit(self, function, *args, **kwargs):
+        """Enqueue function(*args, **kwargs)
+
+        :return concurrent.futures.Future: of its result
+        """
+        future = concurrent.futures.Future()
+        self._requests.put((future, function, args, kwargs))
+        return future
+
+    def _next_batch(self, block):
+        batch = []
+        try:
+            batch.append(self._requests.get(block))
+            while len(batch) < self.batch_size:
+                batch.append(self._requests.get_nowait())
+        except queue.Empty:
+            pass
+        return batch
+
+    def _apply(self, batch):
+        outcomes = []
+        payments = []  # of requests whose savepoint was released
+        try:
+            with immediate_atomic():
+                for future, function, args, kwargs in batch:
+                    if not future.set_running_or_notify_cancel():
+                        continue
+                    _group.payments = []
+                    try:
+                        with immediate_atomic():
+                            result = function(*args, **kwargs)
+                    except Exception as error:
+                        outcomes.append((future, False, error))
+                    else:
+                        outcomes.append((future, True, result))
+                        payments.extend(_group.payments)
+                    finally:
+                        _group.payments = None
+        except BaseException as error:  # the group was rolled back
+            _refund_rolled_back(payments)
+            for future, _, _, _ in batch:
+                if not future.done():
+                    future.set_exception(error)
+            if not isinstance(error, Exception):
+                raise
+            return
+        metrics.BOOKING_QUEUE_BATCH.observe(len(outcomes))
+        for future, ok, value in outcomes:
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+    def run_pending(self):
+        """Apply all queued requests in the current thread"""
+        while True:
+            batch = self._next_batch(block=False)
+            if not batch:
+                return
+            self._apply(batch)
+
+    def _run(self):
+        try:
+            while True:
+                self._apply(self._next_batch(block=True))
+        finally:
+            connection.close()
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_queue():
+    """The booking queue of this process, started on first use"""
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = BookingQueue(settings.WASCH_BOOKING_QUEUE_BATCH)
+        return _queue
+
+
+def _call(function, *args, **kwargs):
+    if not settings.WASCH_BOOKING_QUEUE:
+        return function(*args, **kwargs)
+    return get_queue().submit(function, *args, **kwargs).result(
+        settings.WASCH_BOOKING_QUEUE_TIMEOUT)
+
+
+def make_appointment(time, machine, user, idempotency_key=None):
+    """Appointment.manager.make_appointment, through the queue if enabled
+
+    :raises concurrent.futures.TimeoutError: if the queue didn't apply it
+        within WASCH_BOOKING_QUEUE_TIMEOUT seconds; it may still be applied
+    """
+    return _call(
+        Appointment.manager.make_appointment, time, machine, user,
+        idempotency_key=idempotency_key)
+
+
+def book_window(user, earliest, latest, kind=None, room=None,
+                idempotency_key=None):
+    """Appointment.manager.book_window, through the queue if enabled"""
+    return _call(
+        Appointment.manager.book_window, user, earliest, latest, kind, room,
+        idempotency_key=idempotency_key)
+
+
+def cancel(appointment):
+    """appointment.cancel(), through the queue if enabled"""
+    return _call(appointment.cancel)
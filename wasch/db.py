@@ -0,0 +1,27 @@
+import contextlib
+from django.db import transaction
+
+
+@contextlib.contextmanager
+def immediate_atomic(using=None):
+    """transaction.atomic for transactions that are going to write
+
+    With wasch.backends.sqlite3, an outermost block begins the transaction
+    with BEGIN IMMEDIATE, so concurrent writers wait for each other (up to
+    the timeout) at the beginning instead of failing in the middle.
+    Otherwise, it's the same as transaction.atomic.
+    Can be used as decorator, too: @immediate_atomic()
+    """
+    connection = transaction.get_connection(using)
+    immediate = (
+        hasattr(connection, 'begin_immediate')
+        and not connection.in_atomic_block)
+    with contextlib.ExitStack() as stack:
+        if immediate:
+            connection.begin_immediate = True
+        try:
+            stack.enter_context(transaction.atomic(using=using))
+        finally:
+            if immediate:
+                connection.begin_immediate = False
+        yield
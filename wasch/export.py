@@ -0,0 +1,188 @@
+"""Streaming export of appointments and transactions, e. g. for accounting
+
+Rows are read from the database in chunks by primary key (keyset
+pagination) as plain values, i. e. without creating model instances, and
+related users are resolved for the whole chunk at once. Thus memory usage
+only depends on the chunk size and not on the size of the tables.
+"""
+import csv
+import datetime
+import json
+from django.contrib.auth.models import User
+from django.utils import timezone
+from wasch.models import Appointment, Transaction
+
+CHUNK_SIZE = 2000
+
+APPOINTMENT_FIELDS = (
+    'id', 'time', 'user', 'machine', 'wasUsed', 'canceled',
+    'refundableTransaction', 'transactions',
+)
+
+TRANSACTION_FIELDS = (
+    'id', 'fromUser', 'toUser', 'value', 'isBonus', 'method',
+    'methodReference', 'notes',
+)
+
+FORMATS = {
+    'csv': 'text/csv',
+    'jsonl': 'application/x-ndjson',
+}
+
+
+def _time_range(start, end):
+    """aware begin and stop for local dates start and end (inclusive)"""
+    begin = stop = None
+    if start is not None:
+        begin = timezone.make_aware(
+            datetime.datetime.combine(start, datetime.time()))
+    if end is not None:
+        stop = timezone.make_aware(datetime.datetime.combine(
+            end + datetime.timedelta(days=1), datetime.time()))
+    return begin, stop
+
+
+def _iter_chunks(queryset, fields, since_id=None, chunk_size=CHUNK_SIZE):
+    last_id = since_id or 0
+    while True:
+        chunk = list(
+            queryset.filter(pk__gt=last_id).order_by('pk')
+            .values(*fields)[:chunk_size])
+        if not chunk:
+            return
+        yield chunk
+        last_id = chunk[-1]['id']
+
+
+def _usernames(user_ids):
+    return dict(
+        User.objects.filter(pk__in=set(user_ids))
+        .values_list('pk', 'username'))
+
+
+def iter_appointments(
+        start=None, end=None, since_id=None, chunk_size=CHUNK_SIZE):
+    """Appointments as dicts with APPOINTMENT_FIELDS
+
+    :param start datetime.date: first day of appointments to export
+    :param end datetime.date: last day of appointments to export
+    :param since_id int: only export appointments with a greater id, e. g.
+        the last id of a previous export
+    """
+    begin, stop = _time_range(start, end)
+    queryset = Appointment.objects.all()
+    if begin is not None:
+        queryset = queryset.filter(time__gte=begin)
+    if stop is not None:
+        queryset = queryset.filter(time__lt=stop)
+    through = Appointment.transactions.through.objects
+    for chunk in _iter_chunks(
+            queryset,
+            ('id', 'time', 'user_id', 'machine_id', 'wasUsed', 'canceled',
+             'refundableTransaction_id'),
+            since_id, chunk_size):
+        usernames = _usernames(row['user_id'] for row in chunk)
+        transactions = {}
+        for appointment_id, transaction_id in through.filter(
+                appointment_id__in=[row['id'] for row in chunk],
+        ).order_by('transaction_id').values_list(
+                'appointment_id', 'transaction_id'):
+            transactions.setdefault(appointment_id, []).append(transaction_id)
+        for row in chunk:
+            yield {
+                'id': row['id'],
+                'time': row['time'],
+                'user': usernames.get(row['user_id']),
+                'machine': row['machine_id'],
+                'wasUsed': row['wasUsed'],
+                'canceled': row['canceled'],
+                'refundableTransaction': row['refundableTransaction_id'],
+                'transactions': transactions.get(row['id'], []),
+            }
+
+
+def iter_transactions(
+        start=None, end=None, since_id=None, chunk_size=CHUNK_SIZE):
+    """Transactions as dicts with TRANSACTION_FIELDS
+
+    Transactions carry no time, so start and end refer to the time of the
+    appointment they belong to.
+    """
+    begin, stop = _time_range(start, end)
+    queryset = Transaction.objects.all()
+    if begin is not None or stop is not None:
+        appointments = Appointment.objects.all()
+        if begin is not None:
+            appointments = appointments.filter(time__gte=begin)
+        if stop is not None:
+            appointments = appointments.filter(time__lt=stop)
+        queryset = queryset.filter(pk__in=(
+            Appointment.transactions.through.objects
+            .filter(appointment__in=appointments)
+            .values('transaction_id')))
+    for chunk in _iter_chunks(
+            queryset,
+            ('id', 'fromUser_id', 'toUser_id', 'value', 'isBonus', 'method',
+             'methodReference', 'notes'),
+            since_id, chunk_size):
+        usernames = _usernames(
+            user_id for row in chunk
+            for user_id in (row['fromUser_id'], row['toUser_id']))
+        for row in chunk:
+            row['fromUser'] = usernames.get(row.pop('fromUser_id'))
+            row['toUser'] = usernames.get(row.pop('toUser_id'))
+            yield row
+
+
+TABLES = {
+    'appointments': (iter_appointments, APPOINTMENT_FIELDS),
+    'transactions': (iter_transactions, TRANSACTION_FIELDS),
+}
+
+
+class _Echo:
+    """file-like object for csv.writer just returning what's written"""
+
+    def write(self, value):
+        return value
+
+
+def _jsonable(value):
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    if isinstance(value, list):
+        return ' '.join(str(v) for v in value)
+    return value
+
+
+def render_csv(rows, fields):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(fields)
+    for row in rows:
+        yield writer.writerow([_jsonable(row[field]) for field in fields])
+
+
+def render_jsonl(rows, fields):
+    for row in rows:
+        yield json.dumps(
+            {field: row[field] for field in fields},
+            default=_jsonable) + '\n'
+
+
+RENDERERS = {
+    'csv': render_csv,
+    'jsonl': render_jsonl,
+}
+
+
+def export(table, fmt='csv', **kwargs):
+    """Lines of the exported table
+
+    :param table str: one of TABLES
+    :param fmt str: one of FORMATS
+    :param kwargs: passed to the iter function of the table, i. e. start,
+        end, since_id and chunk_size
+    :raises KeyError: when table or fmt is unknown
+    """
+    iter_rows, fields = TABLES[table]
+    return RENDERERS[fmt](iter_rows(**kwargs), fields)
@@ -0,0 +1,197 @@
+"""Per-request instrumentation: database queries, time and cache hits
+
+InstrumentationMiddleware measures every request, logs a JSON line to the
+logger wasch.instrumentation and sets X-Wasch-* response headers.
+Queries are counted from the query log of the connections, which is only
+kept with DEBUG or a forced debug cursor, so requests' queries are counted
+with DEBUG or settings.WASCH_INSTRUMENTATION_QUERIES only.
+settings.WASCH_QUERY_BUDGETS maps URL names (e. g. 'wasch:book') to the
+number of queries a request may take; exceeding requests are logged as
+warning or, with WASCH_QUERY_BUDGETS_STRICT, fail with QueryBudgetExceeded.
+Outside of requests, use measure() or query_budget(), which always count
+queries.
+
+Code with a cache calls record_cache(name, hit) on every lookup.
+"""
+import collections
+import contextlib
+import itertools
+import json
+import logging
+import threading
+import time
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from wasch import metrics
+
+logger = logging.getLogger(__name__)
+
+_state = threading.local()
+
+
+class QueryBudgetExceeded(AssertionError):
+    def __init__(self, name, budget, measurement):
+        self.name = name
+        self.budget = budget
+        self.measurement = measurement
+        super().__init__('{} took {} queries, budget is {}'.format(
+            name, measurement.queries, budget))
+
+
+class Measurement:
+    def __init__(self):
+        self.queries = 0  # None if not counted
+        self.db_time = 0.0  # seconds
+        self.total_time = 0.0  # seconds
+        self.cache = {}  # name -> [hits, misses]
+        self.sql = []
+
+    @property
+    def cache_hits(self):
+        return sum(hits for hits, _ in self.cache.values())
+
+    @property
+    def cache_lookups(self):
+        return sum(hits + misses for hits, misses in self.cache.values())
+
+    @property
+    def cache_hit_rate(self):
+        """Ratio of cache hits, None if no lookups"""
+        lookups = self.cache_lookups
+        return self.cache_hits / lookups if lookups else None
+
+    def as_dict(self):
+        values = {
+            'total_ms': round(self.total_time * 1000, 1),
+            'cache': {
+                name: {'hits': hits, 'misses': misses}
+                for name, (hits, misses) in sorted(self.cache.items())},
+        }
+        if self.queries is not None:
+            values['queries'] = self.queries
+            values['db_ms'] = round(self.db_time * 1000, 1)
+        return values
+
+
+def _active():
+    if not hasattr(_state, 'measurements'):
+        _state.measurements = []
+    return _state.measurements
+
+
+def record_cache(name, hit):
+    """Count a lookup in the cache name for the active measurements and
+    the metrics"""
+    metrics.CACHE_LOOKUPS.inc(cache=name, result='hit' if hit else 'miss')
+    for measurement in _active():
+        counts = measurement.cache.setdefault(name, [0, 0])
+        counts[0 if hit else 1] += 1
+
+
+class _CountingLog(collections.deque):
+    """Query log counting all entries, also those it no longer keeps"""
+
+    appended = 0
+
+    def append(self, entry):
+        self.appended += 1
+        super().append(entry)
+
+
+def _counting_log(connection):
+    queries_log = connection.queries_log
+    if not isinstance(queries_log, _CountingLog):
+        queries_log = _CountingLog(queries_log, queries_log.maxlen)
+        connection.queries_log = queries_log
+    return queries_log
+
+
+@contextlib.contextmanager
+def measure(keep_sql=False, queries=True):
+    """Measure queries (on all databases), time and cache hits of a block
+
+    Yields a Measurement, which is complete at the end of the block.
+    :param keep_sql bool: keep the queries in Measurement.sql
+    :param queries bool: count queries, forcing the debug cursor of the
+        connections meanwhile
+    """
+    measurement = Measurement()
+    active = _active()
+    watched = []
+    if queries:
+        for connection in connections.all():
+            watched.append((
+                connection, connection.force_debug_cursor,
+                _counting_log(connection).appended))
+            connection.force_debug_cursor = True
+    else:
+        measurement.queries = None
+    active.append(measurement)
+    started = time.perf_counter()
+    try:
+        yield measurement
+    finally:
+        measurement.total_time = time.perf_counter() - started
+        active.remove(measurement)
+        for connection, force_debug_cursor, appended in watched:
+            queries_log = connection.queries_log
+            count = queries_log.appended - appended
+            # the log keeps the last queries_limit entries, and is cleared
+            # when a request starts
+            entries = list(itertools.islice(
+                reversed(queries_log), min(count, len(queries_log))))
+            entries.reverse()
+            measurement.queries += count
+            measurement.db_time += sum(
+                float(entry['time']) for entry in entries)
+            if keep_sql:
+                measurement.sql.extend(entry['sql'] for entry in entries)
+            connection.force_debug_cursor = force_debug_cursor
+            if not (active or force_debug_cursor or settings.DEBUG):
+                connection.queries_log.clear()  # nobody else needs it
+
+
+@contextlib.contextmanager
+def query_budget(budget, name='block'):
+    """Fail with QueryBudgetExceeded if the block takes more queries"""
+    with measure(keep_sql=True) as measurement:
+        yield measurement
+    if measurement.queries > budget:
+        raise QueryBudgetExceeded(name, budget, measurement)
+
+
+class InstrumentationMiddleware:
+    def __init__(self, get_response):
+        if not settings.WASCH_INSTRUMENTATION:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        counted = settings.DEBUG or settings.WASCH_INSTRUMENTATION_QUERIES
+        with measure(queries=counted) as measurement:
+            response = self.get_response(request)
+        match = getattr(request, 'resolver_match', None)
+        name = match.view_name if match is not None else None
+        if measurement.queries is not None:
+            response['X-Wasch-Queries'] = str(measurement.queries)
+            response['X-Wasch-DB-Time'] = '{:.1f}ms'.format(
+                measurement.db_time * 1000)
+        response['X-Wasch-Time'] = '{:.1f}ms'.format(
+            measurement.total_time * 1000)
+        if measurement.cache_lookups:
+            response['X-Wasch-Cache-Hit-Rate'] = '{:.2f}'.format(
+                measurement.cache_hit_rate)
+        line = dict(
+            measurement.as_dict(), view=name, method=request.method,
+            path=request.path, status=response.status_code)
+        logger.info(json.dumps(line, sort_keys=True))
+        budget = settings.WASCH_QUERY_BUDGETS.get(name)
+        if measurement.queries is None:
+            budget = None  # not counted
+        if budget is not None and measurement.queries > budget:
+            if settings.WASCH_QUERY_BUDGETS_STRICT:
+                raise QueryBudgetExceeded(name, budget, measurement)
+            logger.warning('%s took %d queries, budget is %d', name,
+                           measurement.queries, budget)
+        return response
@@ -0,0 +1,80 @@
+"""Connection handling for the legacy database (see legacymodels)
+
+Connections come from a pool (checked with a ping before reuse), are
+scoped to a request by LegacyConnectionMiddleware and reads wrapped with
+retry_on_disconnect survive a dropped connection.
+"""
+import functools
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+import peewee
+import legacymodels
+
+DISCONNECT_ERRORS = (peewee.OperationalError, peewee.InterfaceError)
+
+
+def configure(config=None):
+    """Initialize the legacy database from settings.WASCH_LEGACY_DATABASE
+    unless it's already initialized
+
+    :param config dict: use this instead of the settings
+    """
+    if legacymodels.database.obj is not None and config is None:
+        return legacymodels.database.obj
+    if config is None:
+        config = settings.WASCH_LEGACY_DATABASE
+    return legacymodels.init_database(config)
+
+
+def retry_on_disconnect(method=None, attempts=2):
+    """Decorator for idempotent reads from the legacy database
+
+    When the connection is lost, it's discarded from the pool and method
+    is called again with a new connection, up to attempts times in total.
+    """
+    if method is None:
+        return functools.partial(retry_on_disconnect, attempts=attempts)
+
+    @functools.wraps(method)
+    def retrying_method(*args, **kwargs):
+        for attempt in range(1, attempts + 1):
+            try:
+                return method(*args, **kwargs)
+            except DISCONNECT_ERRORS:
+                if attempt == attempts:
+                    raise
+                discard_connection()
+    return retrying_method
+
+
+def discard_connection():
+    """Close the connection of this thread without returning it to the
+    pool"""
+    database = legacymodels.database.obj
+    if database is None or database.is_closed():
+        return
+    try:
+        database.manual_close()
+    except DISCONNECT_ERRORS:
+        pass  # it's gone anyway
+
+
+class LegacyConnectionMiddleware:
+    """Return the legacy connection of a request to the pool afterwards
+
+    Connections are opened lazily by the first query, so requests not
+    reading legacy data don't take one.
+    """
+
+    def __init__(self, get_response):
+        if not settings.WASCH_USE_LEGACY:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        try:
+            return self.get_response(request)
+        finally:
+            database = legacymodels.database.obj
+            if database is not None and not database.is_closed():
+                database.close()
@@ -0,0 +1,358 @@
+"""Import of the legacy waschedv database described by legacymodels
+
+Legacy rows are read in chunks ordered by a key of each table (keyset
+pagination, as some legacy tables lack a primary key) and written with
+bulk_create, one transaction per chunk. Tables without a primary key are
+ordered by all their columns; of rows equal in all of them, the number
+already read is kept with the key, so none are skipped at chunk borders.
+After each chunk the last key is saved to a checkpoint file, so an
+interrupted import continues where it stopped. Rows already imported
+(e. g. when the checkpoint wasn't saved after the last transaction) are
+skipped.
+Receivers keeping e. g. UpcomingAppointment up to date don't get signals
+from bulk_create, so the import updates what they would.
+"""
+import datetime
+import json
+import os
+import time
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import Group, User
+from django.db import transaction
+from django.utils import timezone
+import legacymodels
+from enteapi.views import time_from_legacy_zeit
+from wasch import bookgrid
+from wasch.models import (
+    STATUS_CHOICES, STATUS_RIGHTS, Appointment, Room, Transaction,
+    UpcomingAppointment, WashingMachine, WashUser,
+)
+
+CHUNK_SIZE = 1000
+
+LEGACY_METHOD = 'legacy'
+
+
+def _equal(field, value):
+    return field.is_null() if value is None else field == value
+
+
+def _greater(field, value):
+    # NULL comes first in ascending order in MySQL and SQLite
+    return field.is_null(False) if value is None else field > value
+
+
+def _at_or_after(fields, key):
+    """peewee condition for rows ordered by fields at or after key"""
+    condition = None
+    for i, field in enumerate(fields):
+        term = _greater(field, key[i])
+        for previous, value in zip(fields[:i], key):
+            term &= _equal(previous, value)
+        condition = term if condition is None else condition | term
+    at = None
+    for field, value in zip(fields, key):
+        term = _equal(field, value)
+        at = term if at is None else at & term
+    return condition | at
+
+
+def _key(row, fields):
+    """key of row as saved in the checkpoint"""
+    return json.loads(json.dumps(
+        [row[field.name] for field in fields], default=str))
+
+
+def _legacy_users(legacy_ids):
+    """django users (with washuser) for legacy user ids"""
+    logins = dict(
+        legacymodels.Users
+        .select(legacymodels.Users.id, legacymodels.Users.login)
+        .where(legacymodels.Users.id.in_(list(set(legacy_ids))))
+        .tuples())
+    users = {
+        user.username: user for user in
+        User.objects.select_related('washuser')
+        .filter(username__in=list(logins.values()))}
+    return {
+        legacy_id: users[login]
+        for legacy_id, login in logins.items() if login in users}
+
+
+def import_waschmaschinen(rows):
+    existing = set(
+        WashingMachine.objects.filter(number__in=[row['id'] for row in rows])
+        .values_list('number', flat=True))
+    room = Room.objects.get_default()  # legacy waschedv has one room
+    machines = [
+        WashingMachine(
+            number=row['id'], room=room, isAvailable=row['status'] == 1,
+            notes=(row['bemerkung'] or '')[:500])
+        for row in rows if row['id'] not in existing]
+    WashingMachine.objects.bulk_create(machines)
+    WashingMachine.objects.clear_cache()  # no signals for bulk_create
+    return {'written': len(machines)}
+
+
+def _status(legacy_status):
+    if any(legacy_status == choice for choice, _ in STATUS_CHOICES):
+        return legacy_status
+    return 1  # enduser
+
+
+def import_users(rows):
+    logins = set()
+    # logins are not unique in the legacy table, first one wins
+    rows = [
+        row for row in rows
+        if row['login'] and not (row['login'] in logins or logins.add(
+            row['login']))]
+    existing = set(
+        User.objects.filter(username__in=[row['login'] for row in rows])
+        .values_list('username', flat=True))
+    rows = [row for row in rows if row['login'] not in existing]
+    if not rows:
+        return {'written': 0}
+    unusable_password = make_password(None)
+    for row in rows:
+        row['status'] = _status(row['status'])
+        row['isActivated'] = not row['gesperrt']
+    User.objects.bulk_create([
+        User(
+            username=row['login'][:150],
+            first_name=row['name'][:30],
+            last_name=row['nachname'][:30],
+            password=unusable_password,
+            is_staff=row['isActivated'] and STATUS_RIGHTS[row['status']][1],
+            is_superuser=(
+                row['isActivated'] and STATUS_RIGHTS[row['status']][2]),
+        ) for row in rows])
+    # bulk_create doesn't set primary keys for every database
+    user_ids = dict(
+        User.objects.filter(username__in=[row['login'] for row in rows])
+        .values_list('username', 'pk'))
+    WashUser.objects.bulk_create([
+        WashUser(
+            user_id=user_ids[row['login']],
+            isActivated=row['isActivated'],
+            status=row['status'],
+        ) for row in rows])
+    # like WashUser.activate, but for all users at once
+    groups = {}
+    memberships = []
+    for row in rows:
+        if not row['isActivated']:
+            continue
+        for group_name in STATUS_RIGHTS[row['status']][0]:
+            if group_name not in groups:
+                groups[group_name], _ = Group.objects.get_or_create(
+                    name=group_name)
+            memberships.append(User.groups.through(
+                user_id=user_ids[row['login']],
+                group_id=groups[group_name].pk))
+    User.groups.through.objects.bulk_create(memberships)
+    return {'written': len(rows)}
+
+
+def _appointment_time(termine):
+    return timezone.make_aware(datetime.datetime.combine(
+        termine['datum'], time_from_legacy_zeit(termine['zeit'])))
+
+
+def import_termine(rows):
+    """Appointments; of legacy appointments of different users at the same
+    time and machine, only the first one (in key order) is imported, the
+    others are counted as duplicates"""
+    users = _legacy_users(row['user'] for row in rows)
+    machines = set(WashingMachine.objects.values_list('number', flat=True))
+    appointments = []
+    for row in rows:
+        user = users.get(row['user'])
+        if user is None or row['maschine'] not in machines:
+            continue  # unknown user or machine
+        appointments.append(Appointment(
+            time=_appointment_time(row),
+            user=user,
+            machine_id=row['maschine'],
+            wasUsed=row['wochentag'] >= 8,
+        ))
+    if not appointments:
+        return {'written': 0}
+    # user of each booked slot, including those imported before
+    booked = {
+        (time, machine_id): user_id
+        for time, machine_id, user_id in Appointment.objects.filter(
+            canceled=False, time__range=(
+                min(a.time for a in appointments),
+                max(a.time for a in appointments)),
+        ).values_list('time', 'machine_id', 'user_id')}
+    new_appointments = []
+    duplicates = 0
+    for appointment in appointments:
+        slot = appointment.time, appointment.machine_id
+        user_id = booked.get(slot)
+        if user_id is None:
+            booked[slot] = appointment.user_id
+            new_appointments.append(appointment)
+        elif user_id != appointment.user_id:
+            duplicates += 1  # a double booking, which booking forbids
+        # else imported before
+    Appointment.objects.bulk_create(new_appointments)
+    # no signals for bulk_create
+    UpcomingAppointment.objects.add_missing()
+    bookgrid.invalidate()
+    return {'written': len(new_appointments), 'duplicates': duplicates}
+
+
+def _transaction_reference(row):
+    return 'waschagtransaktionen {} {} {}'.format(
+        row['datum'], row['user'], row['bestand'])
+
+
+def import_waschagtransaktionen(rows):
+    """Transactions between waschag members and the service user,
+    credits of legacy aktion in EUR become transactions to the member"""
+    users = _legacy_users(row['user'] for row in rows)
+    service_washuser, _ = WashUser.objects.get_or_create_service_user()
+    service = service_washuser.user
+    existing = set(
+        Transaction.objects.filter(
+            method=LEGACY_METHOD,
+            methodReference__in=[_transaction_reference(r) for r in rows],
+        ).values_list('methodReference', flat=True))
+    transactions = []
+    for row in rows:
+        user = users.get(row['user'])
+        reference = _transaction_reference(row)
+        value = int(round(abs(row['aktion']) * 100))
+        if user is None or value == 0 or reference in existing:
+            continue
+        fromUser, toUser = (
+            (service, user) if row['aktion'] > 0 else (user, service))
+        transactions.append(Transaction(
+            fromUser=fromUser,
+            toUser=toUser,
+            value=value,
+            notes=row['bemerkung'][:159],
+            method=LEGACY_METHOD,
+            methodReference=reference,
+        ))
+    Transaction.objects.bulk_create(transactions)
+    return {'written': len(transactions)}
+
+
+def _tables():
+    """(name, legacy model, key fields, import function) in import order
+
+    Import functions return counts by name, at least 'written', which are
+    added up in the checkpoint. Key fields of tables without a primary key are all of their columns.
+    """
+    lm = legacymodels
+    return (
+        ('waschmaschinen', lm.Waschmaschinen, (lm.Waschmaschinen.id, ),
+         import_waschmaschinen),
+        ('users', lm.Users, (lm.Users.id, ), import_users),
+        ('termine', lm.Termine,
+         (lm.Termine.datum, lm.Termine.zeit, lm.Termine.maschine,
+          lm.Termine.user, lm.Termine.wochentag, lm.Termine.bonus),
+         import_termine),
+        ('waschagtransaktionen', lm.Waschagtransaktionen,
+         (lm.Waschagtransaktionen.datum, lm.Waschagtransaktionen.user,
+          lm.Waschagtransaktionen.bestand, lm.Waschagtransaktionen.aktion,
+          lm.Waschagtransaktionen.bemerkung),
+         import_waschagtransaktionen),
+    )
+
+
+TABLES = tuple(name for name, _, _, _ in _tables())
+
+
+def legacy_models():
+    return [model for _, model, _, _ in _tables()]
+
+
+class Checkpoint:
+    """Progress of an import, saved as JSON in path (if not None)"""
+
+    def __init__(self, path=None):
+        self.path = path
+        self.tables = {}
+        if path is not None and os.path.exists(path):
+            with open(path) as checkpoint_file:
+                self.tables = json.load(checkpoint_file)
+
+    def get(self, table):
+        return self.tables.setdefault(
+            table, {
+                'key': None, 'ties': 0, 'read': 0, 'written': 0,
+                'done': False})
+
+    def save(self):
+        if self.path is None:
+            return
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as checkpoint_file:
+            json.dump(self.tables, checkpoint_file, default=str)
+        os.replace(tmp_path, self.path)
+
+
+def duplicates_note(progress):
+    """text reporting the duplicates skipped in progress, if any"""
+    if not progress.get('duplicates'):
+        return ''
+    return ', {} duplicates skipped'.format(progress['duplicates'])
+
+
+def import_legacy(
+        checkpoint=None, tables=TABLES, chunk_size=CHUNK_SIZE, report=None):
+    """Import legacy tables into the native models
+
+    :param checkpoint Checkpoint: progress to continue from and to update
+    :param tables iterable(str): names of legacy tables to import
+    :param report callable: called with a progress message after each chunk
+    :return Checkpoint: progress
+    """
+    if checkpoint is None:
+        checkpoint = Checkpoint()
+    for name, model, key_fields, import_rows in _tables():
+        if name not in tables:
+            continue
+        progress = checkpoint.get(name)
+        begin = time.monotonic()
+        read = 0
+        while not progress['done']:
+            query = model.select()
+            if progress['key'] is not None:
+                # skip the rows at the key which were read
+                query = query.where(
+                    _at_or_after(key_fields, progress['key'])).offset(
+                        progress.get('ties', 0))
+            rows = list(
+                query.order_by(*key_fields).limit(chunk_size).dicts())
+            if not rows:
+                progress['done'] = True
+                checkpoint.save()
+                break
+            with transaction.atomic():
+                counts = import_rows(rows)
+            read += len(rows)
+            progress['read'] += len(rows)
+            for count_name, count in counts.items():
+                progress[count_name] = progress.get(count_name, 0) + count
+            key = _key(rows[-1], key_fields)
+            ties = 0
+            for row in reversed(rows):
+                if _key(row, key_fields) != key:
+                    break
+                ties += 1
+            if ties == len(rows) and key == progress['key']:
+                ties += progress.get('ties', 0)
+            progress['key'] = key
+            progress['ties'] = ties
+            checkpoint.save()
+            if report is not None:
+                report('{}: read {}, written {}{} ({:.0f} rows/s)'.format(
+                    name, progress['read'], progress['written'],
+                    duplicates_note(progress),
+                    read / max(time.monotonic() - begin, 1e-6)))
+    return checkpoint
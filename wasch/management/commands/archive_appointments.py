@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+from wasch import archive
+
+
+class Command(BaseCommand):
+    help = (
+        'Move appointments and their transactions older than the given '
+        'number of months to the archive')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--months', type=int, default=6,
+            help='keep appointments of this many months before the current '
+            'one in the database')
+        parser.add_argument(
+            '--batch-size', type=int, default=archive.BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        report = self.stdout.write if options['verbosity'] > 1 else None
+        archived = archive.archive(
+            options['months'], batch_size=options['batch_size'],
+            report=report)
+        self.stdout.write('archived {} appointments to {}'.format(
+            archived, archive.archive_dir()))
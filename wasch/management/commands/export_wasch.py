@@ -0,0 +1,58 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+from wasch import export
+
+
+def _date(value):
+    date = parse_date(value)
+    if date is None:
+        raise ValueError('not a date: {}'.format(value))
+    return date
+
+
+class Command(BaseCommand):
+    help = (
+        'Export appointments or transactions as CSV or JSON lines, '
+        'streaming in chunks')
+
+    def add_arguments(self, parser):
+        parser.add_argument('table', choices=sorted(export.TABLES))
+        parser.add_argument(
+            '--format', choices=sorted(export.FORMATS), default='csv')
+        parser.add_argument(
+            '--start', type=_date, help='first day (YYYY-MM-DD)')
+        parser.add_argument(
+            '--end', type=_date, help='last day (YYYY-MM-DD)')
+        parser.add_argument(
+            '--since-id', type=int,
+            help='only rows after this id, e. g. last id of previous export')
+        parser.add_argument(
+            '--chunk-size', type=int, default=export.CHUNK_SIZE)
+        parser.add_argument(
+            '-o', '--output', help='file to write to; defaults to stdout')
+
+    def handle(self, *args, **options):
+        iter_rows, fields = export.TABLES[options['table']]
+        exported = {'count': 0, 'last_id': options['since_id']}
+
+        def counted(rows):
+            for row in rows:
+                exported['count'] += 1
+                exported['last_id'] = row['id']
+                yield row
+
+        rows = counted(iter_rows(
+            start=options['start'], end=options['end'],
+            since_id=options['since_id'], chunk_size=options['chunk_size']))
+        lines = export.RENDERERS[options['format']](rows, fields)
+        if options['output']:
+            try:
+                with open(options['output'], 'w', newline='') as output:
+                    output.writelines(lines)
+            except OSError as e:
+                raise CommandError(e)
+        else:
+            for line in lines:
+                self.stdout.write(line, ending='')
+        self.stderr.write('exported {} {}, last id {}'.format(
+            exported['count'], options['table'], exported['last_id']))
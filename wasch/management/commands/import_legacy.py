@@ -0,0 +1,43 @@
+import contextlib
+from django.core.management.base import BaseCommand
+from peewee import SqliteDatabase
+from wasch import legacydb, legacyimport
+
+
+class Command(BaseCommand):
+    help = (
+        'Import the legacy waschedv tables in chunks, continuing from the '
+        'checkpoint file if it exists')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'tables', nargs='*', choices=legacyimport.TABLES,
+            help='tables to import; defaults to all in required order')
+        parser.add_argument(
+            '--checkpoint', default='legacy-import.json',
+            help='file to save progress to and resume from')
+        parser.add_argument(
+            '--chunk-size', type=int, default=legacyimport.CHUNK_SIZE)
+        parser.add_argument(
+            '--sqlite', metavar='PATH',
+            help='read from a SQLite copy of the legacy database instead')
+
+    def handle(self, *args, **options):
+        if options['sqlite']:
+            database = SqliteDatabase(options['sqlite'])
+            context = database.bind_ctx(legacyimport.legacy_models())
+        else:
+            legacydb.configure()
+            context = contextlib.ExitStack()  # nothing to do
+        with context:
+            checkpoint = legacyimport.import_legacy(
+                legacyimport.Checkpoint(options['checkpoint']),
+                tables=options['tables'] or legacyimport.TABLES,
+                chunk_size=options['chunk_size'],
+                report=self.stdout.write)
+        for table in legacyimport.TABLES:
+            progress = checkpoint.get(table)
+            self.stdout.write('{}: {}read {}, written {}{}'.format(
+                table, '' if progress['done'] else 'not finished, ',
+                progress['read'], progress['written'],
+                legacyimport.duplicates_note(progress)))
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+from wasch import archive, retention
+
+
+class Command(BaseCommand):
+    help = (
+        'Delete appointments older than retention time and anonymize their '
+        'transactions and archived appointments; safe to be run regularly, '
+        'e. g. by cron')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=retention.BATCH_SIZE)
+        parser.add_argument(
+            '--pause', type=float, default=0.1,
+            help='seconds to wait between batches')
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='only count expired appointments')
+
+    def handle(self, *args, **options):
+        if options['dry_run']:
+            self.stdout.write('{} appointments expired'.format(
+                retention.expired_appointments().count()))
+            return
+        report = self.stdout.write if options['verbosity'] > 1 else None
+        purged = retention.purge(
+            batch_size=options['batch_size'], pause=options['pause'],
+            report=report)
+        self.stdout.write('purged {} appointments'.format(purged))
+        self.stdout.write('anonymized {} archived appointments'.format(
+            archive.anonymize_expired()))
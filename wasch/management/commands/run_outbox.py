@@ -0,0 +1,25 @@
+import time
+from django.core.management.base import BaseCommand
+from wasch import outbox
+
+
+class Command(BaseCommand):
+    help = (
+        'Run due outbox tasks (e. g. refunds) left by the server processes, '
+        'once or periodically')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--interval', type=float, default=None,
+            help='repeat every that many seconds until interrupted')
+
+    def handle(self, *args, **options):
+        while True:
+            started = time.monotonic()
+            count = outbox.run_due()
+            if options['verbosity'] > 1:
+                self.stdout.write('ran {} tasks'.format(count))
+            if options['interval'] is None:
+                return
+            time.sleep(max(
+                0, options['interval'] - (time.monotonic() - started)))
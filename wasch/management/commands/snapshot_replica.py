@@ -0,0 +1,26 @@
+import time
+from django.core.management.base import BaseCommand
+from wasch import routers
+
+
+class Command(BaseCommand):
+    help = (
+        'Copy the default database to the read replica '
+        '(settings.WASCH_READ_REPLICA), once or periodically')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--interval', type=float, default=None,
+            help='repeat every that many seconds until interrupted')
+
+    def handle(self, *args, **options):
+        while True:
+            started = time.monotonic()
+            routers.snapshot()
+            if options['verbosity'] > 1:
+                self.stdout.write('snapshot took {:.2f}s'.format(
+                    time.monotonic() - started))
+            if options['interval'] is None:
+                return
+            time.sleep(max(
+                0, options['interval'] - (time.monotonic() - started)))
@@ -0,0 +1,171 @@
+"""In-process metrics in Prometheus exposition format
+
+Counters and histograms aggregate in memory of this process, each behind
+its own lock, so they are safe to update from any thread; render() returns
+all of them for the staff-only metrics view. With several processes,
+every one has its own values.
+"""
+import contextlib
+import threading
+import time
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+DEFAULT_BUCKETS = (
+    .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, float('inf'))
+
+REGISTRY = []
+
+
+def _escape(value):
+    return (
+        str(value).replace('\\', r'\\').replace('\n', r'\n')
+        .replace('"', r'\"'))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(name, _escape(value))
+        for name, value in labels) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError('{} needs labels {}'.format(
+                self.name, ', '.join(self.labelnames)))
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _samples(self):
+        raise NotImplementedError
+
+    def render(self):
+        lines = [
+            '# HELP {} {}'.format(self.name, self.documentation),
+            '# TYPE {} {}'.format(self.name, self.kind),
+        ]
+        for name, labels, value in self._samples():
+            lines.append('{}{} {}'.format(
+                name, _format_labels(labels), _format_value(value)))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def _samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            yield self.name, zip(self.labelnames, key), value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        if self.buckets[-1] != float('inf'):
+            self.buckets += (float('inf'), )
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * len(self.buckets) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-1] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Observe the duration of the block in seconds, also when it
+        raises"""
+        begin = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - begin, **labels)
+
+    def count(self, **labels):
+        counts = self._values.get(self._key(labels))
+        return counts[-2] if counts else 0
+
+    def _samples(self):
+        with self._lock:
+            values = sorted(
+                (key, list(counts)) for key, counts in self._values.items())
+        for key, counts in values:
+            labels = list(zip(self.labelnames, key))
+            for bound, count in zip(self.buckets, counts):
+                yield (
+                    self.name + '_bucket',
+                    labels + [('le', _format_value(float(bound)))], count)
+            yield self.name + '_count', labels, counts[-2]
+            yield self.name + '_sum', labels, counts[-1]
+
+
+def render():
+    return '\n'.join(metric.render() for metric in REGISTRY) + '\n'
+
+
+MAKE_APPOINTMENT = Counter(
+    'wasch_make_appointment_total',
+    'Booking attempts by outcome: ok, payment_error or the reason code of '
+    'APPOINTMENT_ERROR_REASONS',
+    ('outcome', ))
+MAKE_APPOINTMENT_SECONDS = Histogram(
+    'wasch_make_appointment_seconds', 'Duration of booking attempts')
+PAYMENT_SECONDS = Histogram(
+    'wasch_payment_seconds',
+    'Duration of payments and refunds by payment method',
+    ('method', 'operation'))
+PAYMENT_FAILURES = Counter(
+    'wasch_payment_failures_total',
+    'Failed payments and refunds by payment method',
+    ('method', 'operation'))
+BOOKING_QUEUE_BATCH = Histogram(
+    'wasch_booking_queue_batch_size',
+    'Requests applied per transaction of the booking queue',
+    buckets=(1, 2, 4, 8, 16, 32, 64))
+OUTBOX_TASKS = Counter(
+    'wasch_outbox_tasks_total', 'Runs of outbox tasks by kind and result',
+    ('kind', 'result'))
+WAITLIST_PROMOTIONS = Counter(
+    'wasch_waitlist_promotions_total',
+    'Canceled appointments booked for a waiting user')
+ENTE_ACTIVATIONS = Counter(
+    'wasch_ente_activations_total', 'Ente activations by result',
+    ('result', ))
+CACHE_LOOKUPS = Counter(
+    'wasch_cache_lookups_total', 'Cache lookups by cache and hit or miss',
+    ('cache', 'result'))
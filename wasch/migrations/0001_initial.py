@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-19 17:20
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('auth', '0008_alter_user_username_max_length'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Appointment',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('time', models.DateTimeField()),
+                ('wasUsed', models.BooleanField()),
+                ('canceled', models.BooleanField(default=False)),
+            ],
+            options={
+                'db_table': 'appointments',
+            },
+        ),
+        migrations.CreateModel(
+            name='Transaction',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('value', models.PositiveIntegerField()),
+                ('isBonus', models.BooleanField(default=False)),
+                ('notes', models.CharField(default='', max_length=159)),
+                ('method', models.CharField(default='', max_length=39)),
+                ('methodReference', models.CharField(default='', max_length=159)),
+            ],
+            options={
+                'db_table': 'transaction',
+            },
+        ),
+        migrations.CreateModel(
+            name='WashingMachine',
+            fields=[
+                ('number', models.SmallIntegerField(primary_key=True, serialize=False)),
+                ('isAvailable', models.BooleanField(verbose_name='available')),
+                ('notes', models.CharField(max_length=500)),
+            ],
+            options={
+                'db_table': 'washingmachines',
+            },
+        ),
+        migrations.CreateModel(
+            name='WashParameters',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(choices=[('payment-method', 'payment method name'), ('bonus-method', 'bonus payment method name'), ('price', 'price in EUR Cent to be paid by user per wash'), ('ration', 'allowed use per month per user'), ('bonus-waschag', 'bonus for waschag members in EUR Cent per month'), ('retention-time', 'days to keep user data'), ('retention-time-waschag', 'days to keep waschag user data'), ('cancel-period', 'minimum minutes prior to appointment to allow cancellation')], max_length=20, unique=True)),
+                ('value', models.CharField(max_length=20)),
+            ],
+            options={
+                'db_table': 'washparameters',
+            },
+        ),
+        migrations.CreateModel(
+            name='WashUser',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('isActivated', models.BooleanField()),
+                ('status', models.SmallIntegerField(choices=[(1, 'enduser'), (3, 'exWaschag'), (5, 'waschag'), (7, 'admin'), (9, 'god')])),
+            ],
+            options={
+                'db_table': 'washuser',
+            },
+        ),
+        migrations.AddField(
+            model_name='transaction',
+            name='fromUser',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='outgoing_transaction', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='transaction',
+            name='toUser',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='incoming_transaction', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='appointment',
+            name='machine',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='wasch.WashingMachine'),
+        ),
+        migrations.AddField(
+            model_name='appointment',
+            name='refundableTransaction',
+            field=models.OneToOneField(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='refundable_appointment', to='wasch.Transaction'),
+        ),
+        migrations.AddField(
+            model_name='appointment',
+            name='transactions',
+            field=models.ManyToManyField(to='wasch.Transaction'),
+        ),
+        migrations.AddField(
+            model_name='appointment',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+    ]
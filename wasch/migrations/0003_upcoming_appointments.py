@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-19 17:50
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+from django.utils import timezone
+
+
+def fill_upcoming_appointments(apps, schema_editor):
+    Appointment = apps.get_model('wasch', 'Appointment')
+    UpcomingAppointment = apps.get_model('wasch', 'UpcomingAppointment')
+    UpcomingAppointment.objects.bulk_create(
+        UpcomingAppointment(
+            appointment_id=pk, user_id=user_id, time=time,
+            machine_id=machine_id)
+        for pk, user_id, time, machine_id in Appointment.objects.filter(
+            time__gte=timezone.now(), canceled=False,
+        ).values_list('pk', 'user_id', 'time', 'machine_id'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('wasch', '0002_appointment_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UpcomingAppointment',
+            fields=[
+                ('appointment', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='upcoming', serialize=False, to='wasch.Appointment')),
+                ('time', models.DateTimeField()),
+            ],
+            options={
+                'db_table': 'upcoming_appointments',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='appointment',
+            index=models.Index(fields=['user', 'time'], name='appointment_user_id_3f0043_idx'),
+        ),
+        migrations.AddField(
+            model_name='upcomingappointment',
+            name='machine',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='wasch.WashingMachine'),
+        ),
+        migrations.AddField(
+            model_name='upcomingappointment',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='upcomingappointment',
+            index=models.Index(fields=['user', 'time'], name='upcoming_ap_user_id_f9eca8_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='upcomingappointment',
+            index=models.Index(fields=['time'], name='upcoming_ap_time_2a579f_idx'),
+        ),
+        migrations.RunPython(
+            fill_upcoming_appointments, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-19 18:10
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def put_machines_in_default_room(apps, schema_editor):
+    Room = apps.get_model('wasch', 'Room')
+    WashingMachine = apps.get_model('wasch', 'WashingMachine')
+    if WashingMachine.objects.exists():
+        room, _ = Room.objects.get_or_create(name='Laundry')
+        WashingMachine.objects.update(room=room)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wasch', '0003_upcoming_appointments'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Room',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+            ],
+            options={
+                'db_table': 'rooms',
+            },
+        ),
+        migrations.AddField(
+            model_name='washingmachine',
+            name='kind',
+            field=models.CharField(choices=[('washer', 'Washing Machine'), ('dryer', 'Dryer')], default='washer', max_length=10),
+        ),
+        migrations.AddField(
+            model_name='washingmachine',
+            name='room',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='machines', to='wasch.Room'),
+        ),
+        migrations.RunPython(
+            put_machines_in_default_room, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='washingmachine',
+            name='room',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='machines', to='wasch.Room'),
+        ),
+    ]
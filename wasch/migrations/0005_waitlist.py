@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-19 18:02
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('wasch', '0004_rooms'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WaitlistEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('earliest', models.DateTimeField()),
+                ('latest', models.DateTimeField()),
+                ('kind', models.CharField(blank=True, choices=[('washer', 'Washing Machine'), ('dryer', 'Dryer')], max_length=10)),
+                ('machine', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='wasch.WashingMachine')),
+                ('room', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='wasch.Room')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'db_table': 'waitlist',
+            },
+        ),
+        migrations.CreateModel(
+            name='WaitlistSlot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('time', models.DateTimeField()),
+                ('entry', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='slots', to='wasch.WaitlistEntry')),
+            ],
+            options={
+                'db_table': 'waitlist_slots',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='waitlistslot',
+            index=models.Index(fields=['time', 'entry'], name='waitlist_sl_time_cffb0f_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='waitlistentry',
+            index=models.Index(fields=['user', 'latest'], name='waitlist_user_id_e3f05a_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='waitlistentry',
+            index=models.Index(fields=['latest'], name='waitlist_latest_9367c9_idx'),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-19 18:07
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wasch', '0005_waitlist'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboxTask',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(max_length=20)),
+                ('state', models.CharField(choices=[('pending', 'Pending'), ('done', 'Done'), ('failed', 'Failed')], default='pending', max_length=10)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('run_after', models.DateTimeField(default=django.utils.timezone.now)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('last_error', models.CharField(blank=True, max_length=159)),
+                ('transaction', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='outbox_tasks', to='wasch.Transaction')),
+            ],
+            options={
+                'db_table': 'outbox',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='outboxtask',
+            index=models.Index(fields=['state', 'run_after'], name='outbox_state_25338b_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='outboxtask',
+            unique_together=set([('kind', 'transaction')]),
+        ),
+    ]
@@ -2,16 +2,22 @@ import struct
 import operator
 import datetime
 import math
+import threading
 from functools import reduce
-from django.db import models, transaction
+from django.db import IntegrityError, models
 from django.dispatch import receiver
 from django.utils import timezone
 from django.conf import settings
 from django.contrib.auth.models import User, Group
-from wasch import payment
+from wasch import bookgrid, metrics, payment, stamps
+from wasch.db import immediate_atomic
+from wasch.instrumentation import record_cache
+from wasch.profiling import profiled, span
 
 WASCH_EPOCH = datetime.date(1980, 1, 1)
 
+_loading = threading.local()
+
 STATUS_CHOICES = (
     (1, 'enduser'),
     (3, 'exWaschag'),
@@ -22,6 +28,7 @@ STATUS_CHOICES = (
 
 GOD_NAME = 'WaschRoss'
 SERVICE_USER_NAME = 'WaschService'
+ANONYMOUS_USER_NAME = 'WaschAnonymous'
 
 WASCH_GROUP_NAMES = ['enduser', 'waschag']
 
@@ -83,12 +90,23 @@ class WashUserManager(models.Manager):
             user_or_username, status=1, isActivated=isActivated, **kwargs)
         return washuser
 
+    def clear_cache(self):
+        """Forget cached god, service and anonymous user, e. g. when the
+        database was reset"""
+        for name in (
+                'cached_god', 'cached_service_washuser',
+                'cached_anonymous_washuser'):
+            self.__dict__.pop(name, None)
+
     def get_or_create_god(self):
         try:
-            self.cached_god.activate()
-            return self.cached_god, False
+            cached = self.cached_god
         except AttributeError:
-            pass  # expected
+            record_cache('washuser', False)
+        else:
+            record_cache('washuser', True)
+            cached.activate()
+            return cached, False
         god, was_created, user_was_created = self._get_or_create_with_user(
             GOD_NAME, status=9, isActivated=True)
         self.cached_god = god
@@ -96,14 +114,32 @@ class WashUserManager(models.Manager):
 
     def get_or_create_service_user(self):
         try:
-            return self.cached_service_washuser, False
+            cached = self.cached_service_washuser
         except AttributeError:
-            pass  # expected
+            record_cache('washuser', False)
+        else:
+            record_cache('washuser', True)
+            return cached, False
         service, was_created, user_was_created = self._get_or_create_with_user(
             SERVICE_USER_NAME, status=5, isActivated=False)
         self.cached_service_washuser = service
         return service, was_created or user_was_created
 
+    def get_or_create_anonymous_user(self):
+        """stands in for users whose data is past retention time"""
+        try:
+            cached = self.cached_anonymous_washuser
+        except AttributeError:
+            record_cache('washuser', False)
+        else:
+            record_cache('washuser', True)
+            return cached, False
+        anonymous, was_created, user_was_created = \
+            self._get_or_create_with_user(
+                ANONYMOUS_USER_NAME, status=1, isActivated=False)
+        self.cached_anonymous_washuser = anonymous
+        return anonymous, was_created or user_was_created
+
 
 class WashUser(models.Model):
 
@@ -167,14 +203,104 @@ def user_is_washuser(user):
         return False
 
 
+DEFAULT_ROOM_NAME = 'Laundry'
+
+
+class RoomManager(models.Manager):
+    def get_default(self):
+        """The room of machines of a single room setup, created if need
+        be"""
+        room, _ = self.get_or_create(name=DEFAULT_ROOM_NAME)
+        return room
+
+
+class Room(models.Model):
+    """Partition of the machines, e. g. a laundry room; the book page
+    shows one room at a time"""
+
+    name = models.CharField(max_length=100, unique=True)
+    objects = RoomManager()
+
+    def __str__(self):
+        return self.name
+
+    class Meta:
+        db_table = 'rooms'
+
+
+MACHINE_KINDS = (
+    ('washer', 'Washing Machine'),
+    ('dryer', 'Dryer'),
+)
+
+MAX_MACHINE_NUMBER = 255
+"""largest machine number appointment references support"""
+
+
+class MachineStatus:
+    """Snapshot of all machines with their rooms; don't change them"""
+
+    def __init__(self, machines):
+        self.machines = tuple(machines)
+        self.by_number = {machine.number: machine for machine in machines}
+        self.available = tuple(m for m in self.machines if m.isAvailable)
+        self.unavailable = tuple(
+            m for m in self.machines if not m.isAvailable)
+        rooms = {machine.room_id: machine.room for machine in self.machines}
+        self.rooms = tuple(rooms[pk] for pk in sorted(rooms))
+
+    def available_in(self, room_id):
+        return tuple(m for m in self.available if m.room_id == room_id)
+
+    def get(self, number):
+        try:
+            return self.by_number[number]
+        except KeyError:
+            raise WashingMachine.DoesNotExist(
+                'no machine {}'.format(number)) from None
+
+    def is_available(self, number):
+        machine = self.by_number.get(number)
+        return machine is not None and machine.isAvailable
+
+
+class WashingMachineManager(models.Manager):
+    STAMP = 'machines'
+
+    def status(self):
+        """MachineStatus of this process, reloaded once a machine was
+        saved (see stamps)"""
+        stamp = stamps.get(self.STAMP)
+        cached = getattr(self, 'cached_status', None)
+        if cached is not None and cached[0] == stamp:
+            record_cache('machines', True)
+            return cached[1]
+        record_cache('machines', False)
+        # never from a replica, which may lag behind the stamp
+        status = MachineStatus(
+            self.using('default').select_related('room').order_by('number'))
+        self.cached_status = stamp, status
+        return status
+
+    def clear_cache(self):
+        """Forget the status, e. g. after changing machines without
+        saving them one by one"""
+        self.__dict__.pop('cached_status', None)
+        stamps.bump(self.STAMP)
+
+
 class WashingMachine(models.Model):
 
     number = models.SmallIntegerField(primary_key=True)
+    room = models.ForeignKey(Room, related_name='machines')
+    kind = models.CharField(
+        max_length=10, choices=MACHINE_KINDS, default='washer')
     isAvailable = models.BooleanField(verbose_name='available')
     notes = models.CharField(max_length=500)
+    objects = WashingMachineManager()
 
     def __str__(self):
-        return 'Washing Machine {:d}'.format(self.number)
+        return '{} {:d}'.format(self.get_kind_display(), self.number)
 
     class Meta:
         db_table = 'washingmachines'
@@ -186,6 +312,7 @@ APPOINTMENT_ERROR_REASONS = {
     31: 'User not active',
     32: 'Monthly ration of user is used up',
     41: 'Appointment taken',
+    42: 'No appointment free in the time window',
     51: 'Appointment canceled',  # for use
     61: 'Appointment already used',  # for use or cancellation
 }
@@ -268,17 +395,25 @@ class AppointmentManager(models.Manager):
     def next_appointment_time(cls, start_time=None):
         if start_time is None:
             start_time = datetime.datetime.now()
+        return timezone.make_aware(cls._next_naive_time(start_time))
+
+    @classmethod
+    def _next_naive_time(cls, start_time):
         day_begin = datetime.datetime(
             start_time.year, start_time.month, start_time.day)
-        return timezone.make_aware(day_begin + datetime.timedelta(minutes=(
+        return day_begin + datetime.timedelta(minutes=(
             cls.next_appointment_number(start_time.time())
-            * cls.interval_minutes)))
+            * cls.interval_minutes))
 
     @classmethod
     def scheduled_appointment_times(cls, start_time=None):
-        begin = cls.next_appointment_time(start_time)
+        if start_time is None:
+            start_time = datetime.datetime.now()
+        # add in local time, appointments keep their time of day over DST
+        begin = cls._next_naive_time(start_time)
         return [
-            begin + datetime.timedelta(minutes=i*cls.interval_minutes)
+            timezone.make_aware(
+                begin + datetime.timedelta(minutes=i*cls.interval_minutes))
             for i in range(cls.appointments_number)]
 
     def filter_for_reference(self, reference):
@@ -292,37 +427,56 @@ class AppointmentManager(models.Manager):
         if hasattr(self, 'bookable_cache'):
             why = self.bookable_cache[machine.number]
             if isinstance(why, int):
+                record_cache('bookable', True)
                 return why
             try:
                 why = why[user.username]
                 if isinstance(why, int):
+                    record_cache('bookable', True)
                     return why
-                return why[time]
+                why = why[time]
+                record_cache('bookable', True)
+                return why
             except KeyError:
                 pass  # just not using cache
-        if not machine.isAvailable:
+        record_cache('bookable', False)
+        if not WashingMachine.objects.status().is_available(machine.number):
             return 21
+        why = self.why_user_cannot_book(user)
+        if why is not None:
+            return why
+        if self.appointment_exists(time, machine):
+            return 41
+        if time not in self.scheduled_appointment_times():
+            return 11
+
+    def why_user_cannot_book(self, user):
+        """Reason of why the user can not book any appointment. Return
+        None if they can."""
         if not user.groups.filter(name='enduser').exists():
             return 31
         try:
             washuser = WashUser.objects.get(pk=user)
-            if not washuser.isActivated:
-                return 31
-            if washuser.remaining_ration < 1:
-                return 32
         except WashUser.DoesNotExist:
             return 31
-        if self.appointment_exists(time, machine):
-            return 41
-        if time not in self.scheduled_appointment_times():
-            return 11
+        if not washuser.isActivated:
+            return 31
+        if washuser.remaining_ration < 1:
+            return 32
+
+    def clear_cache(self):
+        """Forget prefetched bookability, cached book grids and machine
+        status, e. g. when the database was reset"""
+        self.__dict__.pop('bookable_cache', None)
+        bookgrid.invalidate()
+        WashingMachine.objects.clear_cache()
 
     def prefetch_bookable(self, users, times=None, machines=None):
         scheduledTimes = self.scheduled_appointment_times()
         if times is None:
             times = scheduledTimes
         if machines is None:
-            machines = WashingMachine.objects.all()
+            machines = WashingMachine.objects.status().machines
         # bookable_cache is nested dict over machine, user, time
         # when a machine is not available, it's not a dict, but just
         # this value; same for user not active etc.
@@ -340,17 +494,7 @@ class AppointmentManager(models.Manager):
             return
         usersWhoCanBook = []
         for user in users:
-            why = None
-            if not user.groups.filter(name='enduser').exists():
-                why = 31
-            try:
-                washuser = WashUser.objects.get(pk=user)
-                if not washuser.isActivated:
-                    why = 31
-                elif washuser.remaining_ration < 1:
-                    why = 32
-            except WashUser.DoesNotExist:
-                why = 31
+            why = self.why_user_cannot_book(user)
             if why is not None:
                 for machine in availableMachines:
                     self.bookable_cache[machine.number][user.username] = why
@@ -358,53 +502,159 @@ class AppointmentManager(models.Manager):
                 usersWhoCanBook.append(user)
         if not usersWhoCanBook:
             return
+        times = [time for time in times if time in scheduledTimes]
+        booked = set(self.filter(
+            time__in=times, machine__in=availableMachines, canceled=False,
+        ).values_list('time', 'machine'))
         for machine in availableMachines:
             for user in usersWhoCanBook:
                 self.bookable_cache[machine.number].setdefault(
                     user.username, {})
                 for time in times:
-                    if time not in scheduledTimes:
-                        continue  # not worthy of caching
                     (
                         self.bookable_cache[machine.number][user.username]
                     )[time] = (
-                        41 if self.appointment_exists(time, machine) else None)
+                        41 if (time, machine.number) in booked else None)
 
     def bookable(self, time, machine, user):
         """Return whether an appointment for the machine at this time
         can be booked by the user. (this makes no reservation)"""
         return self.why_not_bookable(time, machine, user) is None
 
-    @transaction.atomic
-    def make_appointment(self, time, machine, user):
-        """Creates an appointment for the user at the specified time."""
-        error_reason = self.why_not_bookable(time, machine, user)
+    wear_days = 28
+    """days in the past whose appointments count as wear, besides the
+    upcoming ones"""
+
+    def _counted(self, book, *args):
+        outcome = 'ok'
+        try:
+            with metrics.MAKE_APPOINTMENT_SECONDS.time():
+                return book(*args)
+        except AppointmentError as error:
+            outcome = str(error.reason)
+            raise
+        except payment.PaymentError:
+            outcome = 'payment_error'
+            raise
+        finally:
+            metrics.MAKE_APPOINTMENT.inc(outcome=outcome)
+
+    @profiled('make_appointment')
+    def make_appointment(self, time, machine, user, idempotency_key=None):
+        """Creates an appointment for the user at the specified time.
+
+        :param idempotency_key str: unique key of the booking; booking
+            again with it returns the appointment booked first
+        """
+        return self._counted(
+            self._make_appointment, time, machine, user, idempotency_key)
+
+    @immediate_atomic()
+    def _make_appointment(self, time, machine, user, idempotency_key):
+        booked = self._booked_with(idempotency_key, user)
+        if booked is not None:
+            return booked
+        with span('why_not_bookable'):
+            error_reason = self.why_not_bookable(time, machine, user)
         if error_reason is not None:
             raise AppointmentError(error_reason, time, machine, user)
+        return self._book(time, machine, user, idempotency_key)
+
+    def _booked_with(self, idempotency_key, user):
+        """Appointment whose payment was made with idempotency_key, if any"""
+        if idempotency_key is None:
+            return None
+        paid = IdempotencyKey.objects.transaction_for(idempotency_key, user)
+        if paid is None:
+            return None
+        return self.filter(transactions=paid).first()
+
+    def _book(self, time, machine, user, idempotency_key=None):
+        """Book the free appointment, rebooking a canceled one of the
+        user"""
         try:
             my_canceled_appointment = self.get(
                 time=time, machine=machine, user=user)
-            my_canceled_appointment.rebook()
+            my_canceled_appointment.rebook(idempotency_key)
             return my_canceled_appointment
         except Appointment.DoesNotExist:  # normal case
             appointment = self.create(
                 time=time, machine=machine, user=user, wasUsed=False)
             try:
-                appointment.pay()
+                appointment.pay(idempotency_key=idempotency_key)
             except payment.PaymentError:
                 appointment.delete()
                 raise
             return appointment
 
+    @profiled('book_window')
+    def book_window(self, user, earliest, latest, kind=None, room=None,
+                    idempotency_key=None):
+        """Creates an appointment for the user on any machine, beginning
+        between earliest and latest (inclusive).
+
+        The earliest free time wins; at that time the available machine
+        (of kind and in room, if given) with the fewest appointments in
+        the last wear_days days and the future, then the one with the
+        lowest number.
+        :param idempotency_key str: as for make_appointment
+        """
+        return self._counted(
+            self._book_window, user, earliest, latest, kind, room,
+            idempotency_key)
+
+    @immediate_atomic()
+    def _book_window(self, user, earliest, latest, kind, room,
+                     idempotency_key):
+        booked = self._booked_with(idempotency_key, user)
+        if booked is not None:
+            return booked
+        error_reason = self.why_user_cannot_book(user)
+        if error_reason is not None:
+            raise AppointmentError(error_reason, earliest, None, user)
+        times = [
+            time for time in self.scheduled_appointment_times()
+            if earliest <= time <= latest]
+        machines = [
+            machine for machine in WashingMachine.objects.status().available
+            if (kind is None or machine.kind == kind)
+            and (room is None or machine.room_id == room.pk)]
+        if not times or not machines:
+            raise AppointmentError(42, earliest, None, user)
+        with span('occupancy'):
+            booked = set(self.filter(
+                time__in=times, machine__in=machines, canceled=False,
+            ).values_list('time', 'machine'))
+            wear = dict(self.filter(
+                time__gte=times[0] - datetime.timedelta(days=self.wear_days),
+                machine__in=machines, canceled=False,
+            ).values_list('machine').annotate(models.Count('pk')))
+        machines.sort(key=lambda machine: (
+            wear.get(machine.number, 0), machine.number))
+        for time in times:
+            for machine in machines:
+                if (time, machine.number) not in booked:
+                    return self._book(time, machine, user, idempotency_key)
+        raise AppointmentError(42, earliest, None, user)
+
 
 GOD_RATION = 31 * AppointmentManager.appointments_per_day
 
 
 class TransactionManager(models.Manager):
-    def pay(self, value, fromUser, toUser, bonusAllowed=True, notes=''):
+    @profiled('TransactionManager.pay')
+    def pay(self, value, fromUser, toUser, bonusAllowed=True, notes='',
+            idempotency_key=None):
         '''
+        :param idempotency_key str: unique key of the payment; paying again
+            with it returns the Transaction of the first payment
         :raises PaymentError: when full payment wasn't achieved
         '''
+        if idempotency_key is not None:
+            paid = IdempotencyKey.objects.transaction_for(
+                idempotency_key, fromUser)
+            if paid is not None:
+                return paid
         paid = 0
         reference = ''
         if bonusAllowed:
@@ -412,15 +662,19 @@ class TransactionManager(models.Manager):
             bonusCoverage = payment.coverage(value, fromUser, method)
             if bonusCoverage == value:  # only "all or nothing" implemented
                 paid, reference = payment.pay(
-                    value, fromUser, toUser, method, notes=notes)
+                    value, fromUser, toUser, method, notes=notes,
+                    idempotency_key=payment.derived_key(
+                        idempotency_key, 'bonus'))
         if paid > 0:
             isBonus = True
         else:
             isBonus = False
             method = WashParameters.objects.get_value('payment-method')
             _, reference = payment.pay(
-                value, fromUser, toUser, method, notes=notes)
-        return self.create(
+                value, fromUser, toUser, method, notes=notes,
+                idempotency_key=idempotency_key)
+        return self._create_once(
+            idempotency_key,
             fromUser=fromUser,
             toUser=toUser,
             value=value,
@@ -430,11 +684,24 @@ class TransactionManager(models.Manager):
             methodReference=reference,
         )
 
-    def refund(self, transaction):
+    def refund(self, transaction, idempotency_key=None):
+        """:param idempotency_key str: as for pay"""
+        if idempotency_key is not None:
+            refund = IdempotencyKey.objects.transaction_for(
+                idempotency_key, transaction.toUser)
+            if refund is not None:
+                return refund
         # only full refund implemented
         _, reference = payment.refund(
-            transaction.method, transaction.methodReference)
-        return self.create(
+            transaction.method, transaction.methodReference,
+            idempotency_key=idempotency_key)
+        return self.record_refund(transaction, reference, idempotency_key)
+
+    def record_refund(self, transaction, reference, idempotency_key=None):
+        """Transaction of the full refund of transaction, done by its
+        method with reference"""
+        return self._create_once(
+            idempotency_key,
             fromUser=transaction.toUser,
             toUser=transaction.fromUser,
             value=transaction.value,
@@ -444,6 +711,19 @@ class TransactionManager(models.Manager):
             methodReference=reference,
         )
 
+    def _create_once(self, idempotency_key, **fields):
+        if idempotency_key is None:
+            return self.create(**fields)
+        try:
+            with immediate_atomic():
+                transaction = self.create(**fields)
+                IdempotencyKey.objects.create(
+                    key=idempotency_key, transaction=transaction)
+                return transaction
+        except IntegrityError:  # a concurrent retry was first
+            return IdempotencyKey.objects.transaction_for(
+                idempotency_key, fields['fromUser'])
+
 
 class Transaction(models.Model):
     '''to be considered atomic, so use only for one appointment
@@ -467,9 +747,51 @@ class Transaction(models.Model):
     class Meta:
         db_table = 'transaction'
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        # rows passed post_init_transaction when they were created
+        _loading.transaction = True
+        try:
+            return super().from_db(db, field_names, values)
+        finally:
+            _loading.transaction = False
+
+
+class IdempotencyKeyManager(models.Manager):
+    def transaction_for(self, key, fromUser):
+        """Transaction recorded with key, None if there is none
+
+        :raises ValueError: if it was paid by another user than fromUser
+        """
+        try:
+            transaction = self.select_related('transaction').get(
+                key=key).transaction
+        except IdempotencyKey.DoesNotExist:
+            return None
+        if transaction.fromUser_id != fromUser.pk:
+            raise ValueError('idempotency key {} is used by another user'
+                             .format(key))
+        return transaction
+
+
+class IdempotencyKey(models.Model):
+    """Key of a payment or refund that may be retried, with its
+    Transaction"""
+
+    key = models.CharField(max_length=100, unique=True)
+    transaction = models.OneToOneField(
+        Transaction, related_name='idempotency_key')
+    created = models.DateTimeField(auto_now_add=True)
+    objects = IdempotencyKeyManager()
+
+    class Meta:
+        db_table = 'idempotency_keys'
+
 
 @receiver(models.signals.post_init, sender=Transaction)
 def post_init_transaction(sender, **kwargs):
+    if getattr(_loading, 'transaction', False):
+        return
     if not user_is_washuser(kwargs['instance'].fromUser):
         raise ValueError('Given fromUser is not a WashUser!')
     if not user_is_washuser(kwargs['instance'].toUser):
@@ -508,46 +830,71 @@ class Appointment(models.Model):
 
     class Meta:
         db_table = 'appointments'
+        indexes = [
+            # appointment_exists, time ranges
+            models.Index(fields=['time', 'machine', 'canceled']),
+            # remaining_ration, own appointments
+            models.Index(fields=['user', 'canceled']),
+            # last used appointment of a machine
+            models.Index(fields=['machine', 'wasUsed', 'time']),
+            # personal history
+            models.Index(fields=['user', 'time']),
+        ]
 
-    def pay(self, bonusAllowed=True):
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        # rows passed post_init_appointment when they were created
+        _loading.appointment = True
+        try:
+            return super().from_db(db, field_names, values)
+        finally:
+            _loading.appointment = False
+
+    @profiled('Appointment.pay')
+    def pay(self, bonusAllowed=True, idempotency_key=None):
+        """:param idempotency_key str: see TransactionManager.pay"""
         price = int(WashParameters.objects.get_value('price'))
         notes = 'make appointment {}'.format(self.reference)
         service_washuser, _ = WashUser.objects.get_or_create_service_user()
         transaction = Transaction.objects.pay(
-            price, self.user, service_washuser.user, bonusAllowed, notes)
+            price, self.user, service_washuser.user, bonusAllowed, notes,
+            idempotency_key)
         self.transactions.add(transaction)
         self.refundableTransaction = transaction
         self.save()
 
-    @transaction.atomic
+    @profiled('Appointment.cancel')
+    @immediate_atomic()
     def cancel(self):
         if self.wasUsed:
             raise AppointmentError(61, self.time, self.machine, self.user)
         try:
             refundableTransaction = Transaction.objects.get(
                 refundable_appointment=self)
-            # may raise payment.PaymentError
-            transaction = Transaction.objects.refund(refundableTransaction)
-            self.transactions.add(transaction)
+            # refunded after commit, see wasch.outbox
+            OutboxTask.objects.create(
+                kind='refund', transaction=refundableTransaction)
             self.refundableTransaction = None
         except Transaction.DoesNotExist:
             pass  # nothing to refund
         self.canceled = True
         self.save()
+        WaitlistEntry.objects.promote(self)
 
-    @transaction.atomic
-    def rebook(self):
+    @immediate_atomic()
+    def rebook(self, idempotency_key=None):
         error_reason = Appointment.manager.why_not_bookable(
             self.time, self.machine, self.user)
         if error_reason is not None:
             raise AppointmentError(
                 error_reason, self.time, self.machine, self.user)
-        self.pay()  # may raise payment.PaymentError
+        # may raise payment.PaymentError
+        self.pay(idempotency_key=idempotency_key)
         self.canceled = False
         self.save()
 
     def why_not_usable(self):
-        if not self.machine.isAvailable:
+        if not WashingMachine.objects.status().is_available(self.machine_id):
             return 21
         if not self.user.groups.filter(name='enduser').exists():
             return 31
@@ -561,7 +908,7 @@ class Appointment(models.Model):
         if self.wasUsed:
             return 61
 
-    @transaction.atomic
+    @immediate_atomic()
     def use(self):
         error_reason = self.why_not_usable()
         if error_reason is not None:
@@ -576,39 +923,64 @@ class Appointment(models.Model):
 
     @property
     def reference(self):
-        """reference is 0 to 2**31 - 1, consisting of binary fields
+        """reference is 0 to 2**28 - 1 for machines 0 to 3, consisting of
+        binary fields
         18 for days since epoch (enough till year 2696!),
         5 for appointment number,
-        2 for machine number (only 4 machines supported!),
-        3 for checksum
+        2 for machine number,
+        3 for checksum;
+        for machines 4 to MAX_MACHINE_NUMBER, it's
+        EXTENDED_REFERENCE_FLAG plus the same with 8 bits for machine number
 
         note: using datetime.timestamp, even without seconds, requires
         far more space!
         """
-        short_days = (timezone.make_naive(self.time).date() - WASCH_EPOCH).days
+        return Appointment.reference_for(self.time, self.machine.number)
+
+    EXTENDED_REFERENCE_FLAG = 1 << 34
+
+    @staticmethod
+    def reference_for(time, machine_number):
+        """reference of an appointment at time with the machine of
+        machine_number, without any model instance (see reference)"""
+        time = timezone.make_naive(time)  # as from_reference assumes
+        short_days = (time.date() - WASCH_EPOCH).days
         if short_days < 0 or short_days >= 2**18:
             raise ValueError('only years between 1980 and 2696 supported!')
+        if not 0 <= machine_number <= MAX_MACHINE_NUMBER:
+            raise ValueError('only machines 0 to {} supported!'.format(
+                MAX_MACHINE_NUMBER))
+        extended = machine_number >= 4
         reference = short_days << 5
-        reference += self.appointment_number
-        reference <<= 2
-        reference += self.machine.number % 4
+        reference += AppointmentManager.appointment_number_at(time)
+        reference <<= 8 if extended else 2
+        reference += machine_number
         checksum = ref_checksum(reference)
         reference <<= 3
-        return reference + checksum
+        reference += checksum
+        if extended:
+            reference += Appointment.EXTENDED_REFERENCE_FLAG
+        return reference
 
-    @classmethod
-    def from_reference(cls, reference, user, allow_unsaved_machine=False):
+    @staticmethod
+    def slot_from_reference(reference):
+        """Inverse of reference_for without database access
+
+        :return: time, machine number
+        :raises ValueError: if the checksum does not match
+        """
+        extended = reference >= Appointment.EXTENDED_REFERENCE_FLAG
+        if extended:
+            reference -= Appointment.EXTENDED_REFERENCE_FLAG
+        machine_bits = 8 if extended else 2
         checksum = reference % 8
         reference >>= 3
+        if reference >= 2**(23 + machine_bits):
+            raise ValueError('reference too large!')
         if ref_checksum(reference) != checksum:
             raise ValueError('checksum does not match!')
-        try:
-            machine = WashingMachine.objects.get(number=reference % 4)
-        except WashingMachine.DoesNotExist:
-            if not allow_unsaved_machine:
-                raise
-            machine = WashingMachine(number=reference % 4)
-        reference >>= 2
+        machine_number = reference % 2**machine_bits
+        reference >>= machine_bits
         time_of_day = AppointmentManager.time_of_appointment_number(
             reference % 32)
         reference >>= 5
@@ -616,6 +988,17 @@ class Appointment(models.Model):
         time = timezone.make_aware(datetime.datetime.combine(
             WASCH_EPOCH + datetime.timedelta(days=reference),
             time_of_day))
+        return time, machine_number
+
+    @classmethod
+    def from_reference(cls, reference, user, allow_unsaved_machine=False):
+        time, machine_number = cls.slot_from_reference(reference)
+        try:
+            machine = WashingMachine.objects.status().get(machine_number)
+        except WashingMachine.DoesNotExist:
+            if not allow_unsaved_machine:
+                raise
+            machine = WashingMachine(number=machine_number)
         if user is None:
             return AnonymousAppointment(time=time, machine=machine)
         return cls(time=time, machine=machine, user=user)
@@ -623,10 +1006,263 @@ class Appointment(models.Model):
 
 @receiver(models.signals.post_init, sender=Appointment)
 def post_init_appointment(sender, **kwargs):
+    if getattr(_loading, 'appointment', False):
+        return
     if not user_is_washuser(kwargs['instance'].user):
         raise ValueError('Given user is not a WashUser!')
 
 
+@receiver(models.signals.post_save, sender=Appointment)
+@receiver(models.signals.post_delete, sender=Appointment)
+def invalidate_book_grid_of_room(sender, instance, **kwargs):
+    machine = WashingMachine.objects.status().by_number.get(
+        instance.machine_id)
+    bookgrid.invalidate(None if machine is None else machine.room_id)
+
+
+@receiver(models.signals.post_save, sender=WashingMachine)
+@receiver(models.signals.post_delete, sender=WashingMachine)
+def invalidate_book_grid(sender, **kwargs):
+    bookgrid.invalidate()
+
+
+@receiver(models.signals.post_save, sender=WashingMachine)
+@receiver(models.signals.post_delete, sender=WashingMachine)
+def invalidate_machine_status(sender, **kwargs):
+    stamps.bump(WashingMachineManager.STAMP)
+
+
+class UpcomingAppointmentManager(models.Manager):
+    def sync(self, appointment, now=None):
+        """Add, update or remove the row of appointment"""
+        if now is None:
+            now = timezone.now()
+        if appointment.canceled or appointment.time < now:
+            self.filter(appointment=appointment).delete()
+            return
+        values = {
+            'user_id': appointment.user_id,
+            'time': appointment.time,
+            'machine_id': appointment.machine_id,
+        }
+        if not self.filter(appointment=appointment).update(**values):
+            self.create(appointment=appointment, **values)
+
+    def for_user(self, user, now=None):
+        if now is None:
+            now = timezone.now()
+        return self.filter(user=user, time__gte=now).order_by('time')
+
+    def add_missing(self, now=None):
+        """Add the rows missing for appointments which have not begun, e. g.
+        after Appointment.objects.bulk_create, which sends no signals
+
+        :return int: number of added rows
+        """
+        if now is None:
+            now = timezone.now()
+        missing = Appointment.objects.filter(
+            time__gte=now, canceled=False, upcoming__isnull=True,
+        ).values_list('pk', 'user_id', 'time', 'machine_id')
+        rows = self.bulk_create([
+            UpcomingAppointment(
+                appointment_id=pk, user_id=user_id, time=time,
+                machine_id=machine_id)
+            for pk, user_id, time, machine_id in missing])
+        return len(rows)
+
+    def prune(self, now=None):
+        """Remove rows of appointments which have begun
+
+        :return int: number of removed rows
+        """
+        if now is None:
+            now = timezone.now()
+        return self.filter(time__lt=now)._raw_delete(self.db)
+
+
+class UpcomingAppointment(models.Model):
+    """Summary of the booked appointments which have not begun yet, for
+    the index page; kept up to date when appointments are saved"""
+
+    appointment = models.OneToOneField(
+        Appointment, primary_key=True, related_name='upcoming')
+    user = models.ForeignKey(settings.AUTH_USER_MODEL)
+    time = models.DateTimeField()
+    machine = models.ForeignKey(WashingMachine)
+    objects = UpcomingAppointmentManager()
+
+    class Meta:
+        db_table = 'upcoming_appointments'
+        indexes = [
+            models.Index(fields=['user', 'time']),
+            models.Index(fields=['time']),  # prune
+        ]
+
+
+@receiver(models.signals.post_save, sender=Appointment)
+def sync_upcoming_appointment(sender, instance, **kwargs):
+    UpcomingAppointment.objects.sync(instance)
+
+
+class WaitlistEntryManager(models.Manager):
+    @immediate_atomic()
+    def join(self, user, earliest, latest, machine=None, kind='', room=None):
+        """Wait for an appointment beginning between earliest and latest
+        (inclusive) to be canceled; for one appointment, pass its time as
+        both and its machine.
+
+        :raises AppointmentError: if the user can't book or no time is
+            scheduled in the window (11)
+        """
+        error_reason = Appointment.manager.why_user_cannot_book(user)
+        if error_reason is not None:
+            raise AppointmentError(error_reason, earliest, machine, user)
+        times = [
+            time for time in Appointment.manager.scheduled_appointment_times()
+            if earliest <= time <= latest]
+        if not times:
+            raise AppointmentError(11, earliest, machine, user)
+        entry = self.create(
+            user=user, earliest=times[0], latest=times[-1], machine=machine,
+            kind=kind or '', room=room)
+        WaitlistSlot.objects.bulk_create(
+            WaitlistSlot(entry=entry, time=time) for time in times)
+        return entry
+
+    def promote(self, appointment):
+        """Book the time and machine of the canceled appointment for the
+        first waiter who may book it and whose payment succeeds, in the
+        current transaction.
+
+        :return Appointment: of the waiter, None if nobody got it
+        """
+        machine = WashingMachine.objects.status().by_number.get(
+            appointment.machine_id)
+        if (
+                machine is None or not machine.isAvailable
+                or appointment.time < timezone.now()):
+            return None
+        slots = WaitlistSlot.objects.filter(
+            time=appointment.time,
+        ).select_related('entry__user').order_by('entry_id')
+        for slot in slots:
+            entry = slot.entry
+            if entry.user_id == appointment.user_id or not entry.accepts(
+                    machine):
+                continue
+            if Appointment.manager.why_user_cannot_book(
+                    entry.user) is not None:
+                continue
+            try:
+                with immediate_atomic():
+                    promoted = Appointment.manager._book(
+                        appointment.time, machine, entry.user)
+            except (AppointmentError, payment.PaymentError):
+                continue
+            entry.delete()
+            metrics.WAITLIST_PROMOTIONS.inc()
+            return promoted
+
+    def for_user(self, user, now=None):
+        if now is None:
+            now = timezone.now()
+        return self.filter(user=user, latest__gte=now).order_by('earliest')
+
+    def prune(self, now=None):
+        """Remove entries whose window has begun completely
+
+        :return int: number of removed entries
+        """
+        if now is None:
+            now = timezone.now()
+        expired = self.filter(latest__lt=now)
+        WaitlistSlot.objects.filter(entry__in=expired)._raw_delete(
+            WaitlistSlot.objects.db)
+        return expired._raw_delete(self.db)
+
+
+class WaitlistEntry(models.Model):
+    """A user waiting for a canceled appointment in a time window,
+    optionally of one machine, kind of machine or room"""
+
+    user = models.ForeignKey(settings.AUTH_USER_MODEL)
+    earliest = models.DateTimeField()
+    latest = models.DateTimeField()
+    machine = models.ForeignKey(WashingMachine, null=True, blank=True)
+    kind = models.CharField(max_length=10, choices=MACHINE_KINDS, blank=True)
+    room = models.ForeignKey(Room, null=True, blank=True)
+    objects = WaitlistEntryManager()
+
+    def accepts(self, machine):
+        return (
+            (self.machine_id is None or self.machine_id == machine.number)
+            and (not self.kind or self.kind == machine.kind)
+            and (self.room_id is None or self.room_id == machine.room_id))
+
+    class Meta:
+        db_table = 'waitlist'
+        indexes = [
+            models.Index(fields=['user', 'latest']),
+            models.Index(fields=['latest']),  # prune
+        ]
+
+
+class WaitlistSlot(models.Model):
+    """One scheduled time of a waitlist entry, so the waiters for a time
+    are found by index however long the waitlist is"""
+
+    entry = models.ForeignKey(WaitlistEntry, related_name='slots')
+    time = models.DateTimeField()
+
+    class Meta:
+        db_table = 'waitlist_slots'
+        indexes = [
+            # promote, in the order of joining
+            models.Index(fields=['time', 'entry']),
+        ]
+
+
+OUTBOX_STATES = (
+    ('pending', 'Pending'),
+    ('done', 'Done'),
+    ('failed', 'Failed'),
+)
+
+
+class OutboxTaskManager(models.Manager):
+    def due(self, now=None):
+        if now is None:
+            now = timezone.now()
+        return self.filter(
+            state='pending', run_after__lte=now).order_by('run_after')
+
+
+class OutboxTask(models.Model):
+    """Work with outside effects, e. g. a refund by a payment method,
+    written in the transaction of the state change needing it and done
+    after commit (see wasch.outbox)"""
+
+    kind = models.CharField(max_length=20)
+    transaction = models.ForeignKey(
+        Transaction, null=True, related_name='outbox_tasks')
+    state = models.CharField(
+        max_length=10, choices=OUTBOX_STATES, default='pending')
+    attempts = models.PositiveSmallIntegerField(default=0)
+    run_after = models.DateTimeField(default=timezone.now)
+    created = models.DateTimeField(auto_now_add=True)
+    last_error = models.CharField(max_length=159, blank=True)
+    objects = OutboxTaskManager()
+
+    class Meta:
+        db_table = 'outbox'
+        # e. g. a transaction is refunded once
+        unique_together = [('kind', 'transaction')]
+        indexes = [
+            models.Index(fields=['state', 'run_after']),  # due
+        ]
+
+
 class WashParametersManager(models.Manager):
     def get_value(self, name):
         return self.get(name=name).value
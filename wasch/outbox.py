@@ -0,0 +1,131 @@
+"""Transactional outbox for work with outside effects
+
+A state change needing e. g. a refund by a payment method doesn't call the
+method in its transaction, keeping the user and the database waiting, but
+creates an OutboxTask in it. The run_outbox command runs due tasks. With
+settings.WASCH_OUTBOX_WORKERS > 0, a thread pool of that many threads in
+this process also runs each task right after commit, leaving the command
+tasks of e. g. a stopped process.
+
+A run claims its task by an UPDATE pushing run_after LEASE seconds ahead,
+so no one else runs it meanwhile, and calls the handler of its kind
+outside of any transaction. The handler returns a function writing the
+result, which is called in one transaction with marking the task done, so
+results are written once. Failing tasks are retried with backoff until
+MAX_ATTEMPTS.
+"""
+import concurrent.futures
+import datetime
+import threading
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from django.utils import timezone
+from wasch import metrics, payment
+from wasch.db import immediate_atomic
+from wasch.models import OutboxTask, Transaction
+
+LEASE = datetime.timedelta(minutes=5)
+MAX_ATTEMPTS = 8
+
+HANDLERS = {}
+
+
+def handler(kind):
+    """Register function(task) -> apply() for tasks of kind"""
+    def register(function):
+        HANDLERS[kind] = function
+        return function
+    return register
+
+
+@handler('refund')
+def _refund(task):
+    refunded = task.transaction
+    # a retry after the refund but before its commit must not refund again
+    key = 'outbox:{}'.format(task.pk)
+    _, reference = payment.refund(
+        refunded.method, refunded.methodReference, idempotency_key=key)
+
+    def apply():
+        refund = Transaction.objects.record_refund(refunded, reference, key)
+        for appointment in refunded.appointment_set.all():
+            appointment.transactions.add(refund)
+    return apply
+
+
+def _backoff(attempts):
+    return datetime.timedelta(seconds=min(3600, 10 * 2 ** attempts))
+
+
+def run_task(pk, now=None):
+    """Run the task of pk if it is due and nobody else runs it
+
+    :return bool: whether it was run, successfully or not
+    """
+    if now is None:
+        now = timezone.now()
+    claimed = OutboxTask.objects.filter(
+        pk=pk, state='pending', run_after__lte=now,
+    ).update(run_after=now + LEASE, attempts=F('attempts') + 1)
+    if not claimed:
+        return False
+    task = OutboxTask.objects.select_related('transaction').get(pk=pk)
+    try:
+        apply = HANDLERS[task.kind](task)
+        with immediate_atomic():
+            apply()
+            OutboxTask.objects.filter(pk=pk).update(
+                state='done', last_error='')
+    except Exception as error:
+        failed = task.attempts >= MAX_ATTEMPTS
+        OutboxTask.objects.filter(pk=pk).update(
+            state='failed' if failed else 'pending',
+            run_after=now + _backoff(task.attempts),
+            last_error=repr(error)[:159])
+        metrics.OUTBOX_TASKS.inc(kind=task.kind, result='error')
+        return True
+    metrics.OUTBOX_TASKS.inc(kind=task.kind, result='done')
+    return True
+
+
+def run_due(now=None):
+    """Run all due tasks in the current thread
+
+    :return int: number of tasks run
+    """
+    return sum(
+        run_task(pk, now)
+        for pk in list(OutboxTask.objects.due(now).values_list(
+            'pk', flat=True)))
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _run_in_worker(pk):
+    try:
+        run_task(pk)
+    finally:
+        connection.close()
+
+
+def dispatch(pk):
+    """Run the task of pk in the thread pool, if there is one"""
+    global _executor
+    if not settings.WASCH_OUTBOX_WORKERS:
+        return
+    with _executor_lock:
+        if _executor is None:
+            _executor = concurrent.futures.ThreadPoolExecutor(
+                settings.WASCH_OUTBOX_WORKERS)
+    _executor.submit(_run_in_worker, pk)
+
+
+@receiver(post_save, sender=OutboxTask)
+def dispatch_after_commit(sender, instance, created, **kwargs):
+    if created:
+        transaction.on_commit(lambda: dispatch(instance.pk))
@@ -1,3 +1,7 @@
+from wasch import metrics
+from wasch.profiling import profiled
+
+
 class PaymentError(RuntimeError):
     pass
 
@@ -9,15 +13,20 @@ class InfinitePayment:
         return value
 
     @staticmethod
-    def pay(value, fromUser, toUser, notes=''):
+    def pay(value, fromUser, toUser, notes='', idempotency_key=None):
+        '''
+        :param idempotency_key str: if given, a repeated call with the same
+            key must not pay again, but return the same result
+        '''
         return value, '0000000000'  # reference
 
     @staticmethod
-    def refund(reference, value=None):
+    def refund(reference, value=None, idempotency_key=None):
         '''
         :param reference str: reference of original payment
         :param value int: value to be refunded (<= original value);
             defaults to None, meaning the whole original amount
+        :param idempotency_key str: as for pay
         '''
         return value, '0000000001'  # reference
 
@@ -29,11 +38,11 @@ class EmptyPayment:
         return 0
 
     @staticmethod
-    def pay(value, fromUser, toUser, notes=''):
+    def pay(value, fromUser, toUser, notes='', idempotency_key=None):
         raise PaymentError('Account is empty!')
 
     @staticmethod
-    def refund(reference, value=None):
+    def refund(reference, value=None, idempotency_key=None):
         '''
         :param reference str: reference of original payment
         :param value int: value to be refunded (<= original value);
@@ -49,6 +58,13 @@ METHODS = {
 
 
 def register_method(name, method, no_clobber=False, do_update=True):
+    """Make method available by name
+
+    method implements coverage(value, user), pay(value, fromUser, toUser,
+    notes='') and refund(reference, value=None) like InfinitePayment; pay
+    and refund get the keyword argument idempotency_key only when one is
+    used, so it's optional for methods which are never used with keys.
+    """
     if name in METHODS:
         if no_clobber:
             return
@@ -61,6 +77,19 @@ def register_method(name, method, no_clobber=False, do_update=True):
     METHODS[name] = method
 
 
+def _call(methodName, operation, function, *args, idempotency_key=None):
+    kwargs = {}
+    if idempotency_key is not None:
+        kwargs['idempotency_key'] = idempotency_key
+    with metrics.PAYMENT_SECONDS.time(method=methodName, operation=operation):
+        try:
+            return function(*args, **kwargs)
+        except PaymentError:
+            metrics.PAYMENT_FAILURES.inc(
+                method=methodName, operation=operation)
+            raise
+
+
 def coverage(value, user, method, bonusMethod=None):
     remaining = value
     methodP = METHODS[method]
@@ -72,34 +101,53 @@ def coverage(value, user, method, bonusMethod=None):
     return value - remaining
 
 
-def pay(value, fromUser, toUser, method, bonusMethod=None, notes=''):
+def derived_key(idempotency_key, part):
+    """key for one call of a payment made of several calls"""
+    if idempotency_key is None:
+        return None
+    return '{}:{}'.format(idempotency_key, part)
+
+
+@profiled('payment.pay')
+def pay(value, fromUser, toUser, method, bonusMethod=None, notes='',
+        idempotency_key=None):
     remaining = value
     reference = ''
     bonusReference = ''
     methodP = METHODS[method]
-    bonusMethodP = METHODS['empty' if bonusMethod is None else bonusMethod]
+    bonusMethodName = 'empty' if bonusMethod is None else bonusMethod
+    bonusMethodP = METHODS[bonusMethodName]
     if bonusMethod is not None:
         bonusCoverage = bonusMethodP.coverage(value, fromUser)
         if bonusCoverage > 0:
-            bonusCoverage, bonusReference = bonusMethodP.pay(
-                bonusCoverage, fromUser, toUser, notes)
+            bonusCoverage, bonusReference = _call(
+                bonusMethodName, 'pay', bonusMethodP.pay,
+                bonusCoverage, fromUser, toUser, notes,
+                idempotency_key=derived_key(idempotency_key, 'bonus'))
             remaining -= bonusCoverage
     else:
         bonusCoverage = 0
     if remaining > 0:
-        methodCoverage, reference = methodP.pay(
-            remaining, fromUser, toUser, notes)
+        methodCoverage, reference = _call(
+            method, 'pay', methodP.pay, remaining, fromUser, toUser, notes,
+            idempotency_key=derived_key(idempotency_key, 'pay'))
         remaining -= methodCoverage
     else:
         methodCoverage = bonusCoverage if methodP == bonusMethodP else 0
     if remaining == 0:
         return methodCoverage, reference  # XXX discarding bonusReference
     if bonusCoverage > 0:
-        bonusMethodP.refund(bonusReference)
+        _call(
+            bonusMethodName, 'refund', bonusMethodP.refund, bonusReference,
+            idempotency_key=derived_key(idempotency_key, 'bonus-rollback'))
     if methodCoverage > 0:
-        methodP.refund(methodCoverage)
+        _call(
+            method, 'refund', methodP.refund, reference,
+            idempotency_key=derived_key(idempotency_key, 'rollback'))
     raise PaymentError("Full payment wasn't achieved")
 
 
-def refund(method, reference, value=None):
-    return METHODS[method].refund(reference, value)
+def refund(method, reference, value=None, idempotency_key=None):
+    return _call(
+        method, 'refund', METHODS[method].refund, reference, value,
+        idempotency_key=idempotency_key)
@@ -0,0 +1,164 @@
+"""Opt-in profiling of booking and payment
+
+Functions on the hot path are wrapped in spans (@profiled or span()). They
+cost next to nothing unless a profiling session is active in the thread;
+then every span records its time, database time and queries.
+ProfilingMiddleware starts a session for requests of staff with the header
+X-Wasch-Profile (value 'cprofile' to run cProfile as well) and for a
+random share settings.WASCH_PROFILE_SAMPLE_RATE of all requests.
+
+Sessions are written to settings.WASCH_PROFILE_DIR as
+- NAME.json: tree of spans with timings,
+- NAME.collapsed: collapsed stacks for flame graphs (flamegraph.pl,
+  speedscope), in microseconds, database time as [db] frames,
+- NAME.prof: with cProfile, pstats for snakeviz, gprof2dot etc.
+"""
+import contextlib
+import cProfile
+import datetime
+import functools
+import json
+import os
+import random
+import re
+import threading
+import uuid
+from django.conf import settings
+from wasch import instrumentation
+
+HEADER = 'HTTP_X_WASCH_PROFILE'
+
+_state = threading.local()
+
+
+def _new_span(name):
+    return {'name': name, 'ms': 0.0, 'db_ms': 0.0, 'queries': 0,
+            'children': []}
+
+
+@contextlib.contextmanager
+def span(name):
+    """Record the block as span name if profiling"""
+    stack = getattr(_state, 'stack', None)
+    if not stack:
+        yield
+        return
+    record = _new_span(name)
+    stack[-1]['children'].append(record)
+    stack.append(record)
+    try:
+        with instrumentation.measure() as measurement:
+            yield
+    finally:
+        stack.pop()
+        record['ms'] = measurement.total_time * 1000
+        record['db_ms'] = measurement.db_time * 1000
+        record['queries'] = measurement.queries
+
+
+def profiled(name):
+    """Decorator recording calls as span name"""
+    def decorator(function):
+        @functools.wraps(function)
+        def profiled_function(*args, **kwargs):
+            if not getattr(_state, 'stack', None):
+                return function(*args, **kwargs)
+            with span(name):
+                return function(*args, **kwargs)
+        return profiled_function
+    return decorator
+
+
+class Session:
+    def __init__(self, name, cprofile=False):
+        self.root = _new_span(name)
+        self.profile = cProfile.Profile() if cprofile else None
+        self.started = datetime.datetime.now()
+
+    def collapsed(self):
+        """Lines 'root;span;child self-microseconds'"""
+        lines = []
+
+        def walk(record, prefix):
+            path = prefix + [record['name'].replace(';', ',')]
+            children = record['children']
+            db_ms = record['db_ms'] - sum(c['db_ms'] for c in children)
+            own_ms = record['ms'] - sum(c['ms'] for c in children) - db_ms
+            for frame, ms in ((path, own_ms), (path + ['[db]'], db_ms)):
+                if ms > 0:
+                    lines.append('{} {}'.format(
+                        ';'.join(frame), int(round(ms * 1000))))
+            for child in children:
+                walk(child, path)
+
+        walk(self.root, [])
+        return lines
+
+    def dump(self, directory, name=None):
+        """Write the files of this session, return their path without
+        extension"""
+        os.makedirs(directory, exist_ok=True)
+        name = re.sub(r'[^\w.-]+', '_', name or self.root['name']).strip('_')
+        path = os.path.join(directory, '{:%Y%m%dT%H%M%S}-{}-{}'.format(
+            self.started, name or 'session', uuid.uuid4().hex[:8]))
+        with open(path + '.json', 'w') as f:
+            json.dump(self.root, f, indent=1)
+        with open(path + '.collapsed', 'w') as f:
+            f.write('\n'.join(self.collapsed()) + '\n')
+        if self.profile is not None:
+            self.profile.dump_stats(path + '.prof')
+        return path
+
+
+@contextlib.contextmanager
+def session(name, cprofile=False):
+    """Profile the block; yields the Session to dump afterwards
+
+    Nested sessions just record spans into the outer one.
+    """
+    if getattr(_state, 'stack', None):
+        with span(name):
+            yield None
+        return
+    profile = Session(name, cprofile)
+    _state.stack = [profile.root]
+    if profile.profile is not None:
+        profile.profile.enable()
+    try:
+        with instrumentation.measure() as measurement:
+            yield profile
+    finally:
+        if profile.profile is not None:
+            profile.profile.disable()
+        _state.stack = None
+        profile.root['ms'] = measurement.total_time * 1000
+        profile.root['db_ms'] = measurement.db_time * 1000
+        profile.root['queries'] = measurement.queries
+
+
+class ProfilingMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def mode(self, request):
+        """None, 'spans' or 'cprofile'"""
+        header = request.META.get(HEADER)
+        if header and request.user.is_staff:
+            return 'cprofile' if header == 'cprofile' else 'spans'
+        rate = settings.WASCH_PROFILE_SAMPLE_RATE
+        if rate and random.random() < rate:
+            return 'spans'
+        return None
+
+    def __call__(self, request):
+        mode = self.mode(request)
+        if mode is None:
+            return self.get_response(request)
+        with session(request.path, mode == 'cprofile') as profile:
+            response = self.get_response(request)
+        match = getattr(request, 'resolver_match', None)
+        path = profile.dump(
+            settings.WASCH_PROFILE_DIR,
+            match.view_name if match is not None else None)
+        response['X-Wasch-Profile'] = os.path.basename(path)
+        return response
@@ -0,0 +1,107 @@
+"""Enforcement of the retention-time parameters
+
+Appointments older than retention-time days (retention-time-waschag for
+waschag members) are deleted; their transactions are kept for accounting,
+but the user is replaced by the anonymous user and notes are removed.
+This happens in batches, each in a short transaction of its own, so
+booking isn't blocked for long and an interrupted purge just continues
+with the next run.
+"""
+import datetime
+import time
+from django.db.models import Q
+from django.utils import timezone
+from wasch.db import immediate_atomic
+from wasch.models import (
+    Appointment, Transaction, UpcomingAppointment, WaitlistEntry,
+    WashParameters, WashUser,
+)
+
+BATCH_SIZE = 500
+
+WASCHAG_STATUS = 5
+"""users with at least this status are kept for retention-time-waschag"""
+
+
+def cutoffs(now=None):
+    """:return: times before which appointments of end users and of waschag
+        members expire"""
+    if now is None:
+        now = timezone.now()
+    cutoff = now - datetime.timedelta(
+        days=int(WashParameters.objects.get_value('retention-time')))
+    waschag_cutoff = now - datetime.timedelta(
+        days=int(WashParameters.objects.get_value('retention-time-waschag')))
+    return cutoff, waschag_cutoff
+
+
+def expired_appointments(now=None):
+    cutoff, waschag_cutoff = cutoffs(now)
+    return Appointment.objects.filter(
+        Q(time__lt=waschag_cutoff, user__washuser__status__gte=WASCHAG_STATUS)
+        | Q(time__lt=cutoff, user__washuser__status__lt=WASCHAG_STATUS)
+    )
+
+
+def _anonymize_transactions(transaction_ids, user_ids):
+    anonymous, _ = WashUser.objects.get_or_create_anonymous_user()
+    transactions = Transaction.objects.filter(pk__in=transaction_ids)
+    transactions.filter(fromUser_id__in=user_ids).update(
+        fromUser=anonymous.user, notes='')
+    transactions.filter(toUser_id__in=user_ids).update(
+        toUser=anonymous.user, notes='')
+
+
+def purge_batch(now=None, batch_size=BATCH_SIZE):
+    """Purge up to batch_size expired appointments in one transaction
+
+    :return int: number of purged appointments
+    """
+    with immediate_atomic():
+        batch = list(
+            expired_appointments(now).order_by('pk')
+            .values_list('pk', 'user_id', 'refundableTransaction_id')
+            [:batch_size])
+        if not batch:
+            return 0
+        appointment_ids = [pk for pk, _, _ in batch]
+        user_ids = {user_id for _, user_id, _ in batch}
+        links = Appointment.transactions.through.objects.filter(
+            appointment_id__in=appointment_ids)
+        transaction_ids = set(links.values_list('transaction_id', flat=True))
+        transaction_ids.update(
+            pk for _, _, pk in batch if pk is not None)
+        _anonymize_transactions(transaction_ids, user_ids)
+        links.delete()
+        # no need for cascading in Python, which would create (and check)
+        # every Appointment instance
+        UpcomingAppointment.objects.filter(
+            appointment_id__in=appointment_ids)._raw_delete(
+                UpcomingAppointment.objects.db)
+        Appointment.objects.filter(pk__in=appointment_ids)._raw_delete(
+            Appointment.objects.db)
+    return len(batch)
+
+
+def purge(now=None, batch_size=BATCH_SIZE, pause=0, report=None):
+    """Purge all expired appointments
+
+    :param pause float: seconds to sleep between batches, leaving the
+        database to others
+    :param report callable: called with a progress message after each batch
+    :return int: number of purged appointments
+    """
+    if now is None:
+        now = timezone.now()
+    UpcomingAppointment.objects.prune(now)
+    WaitlistEntry.objects.prune(now)
+    purged = 0
+    while True:
+        count = purge_batch(now, batch_size)
+        if not count:
+            return purged
+        purged += count
+        if report is not None:
+            report('purged {} appointments'.format(purged))
+        if pause:
+            time.sleep(pause)
@@ -0,0 +1,194 @@
+"""Read replica for read-only pages (see settings.WASCH_READ_REPLICA)
+
+The replica is a copy of the default SQLite database, refreshed
+periodically by snapshot() (manage.py snapshot_replica --interval ...), so
+reading stats, status and the availability grid from it doesn't contend
+with bookings for the lock of the default database.
+
+Reads only go to the replica within reading_replica() (or views decorated
+with replica_reads), and never
+- after a write in the same block, so a view sees its own writes,
+- for a request, after a write earlier in the request,
+- within a transaction begun in the block, e. g. make_appointment,
+- for a while after a user's own write (ReadReplicaMiddleware pins the
+  session to the default database), as the replica may lag behind.
+Writes always go to the default database.
+"""
+import contextlib
+import functools
+import os
+import sqlite3
+import threading
+import time
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured, MiddlewareNotUsed
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.transaction import TransactionManagementError
+
+PIN_SESSION_KEY = '_wasch_primary_until'
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+PRIMARY_ONLY_APPS = ('sessions', )
+
+_state = threading.local()
+
+
+def replica_alias():
+    """Return the alias of the configured read replica or None"""
+    alias = getattr(settings, 'WASCH_READ_REPLICA', None)
+    if alias is None or alias not in connections.databases:
+        return None
+    return alias
+
+
+def _atomic_depth():
+    connection = connections[DEFAULT_DB_ALIAS]
+    if not connection.in_atomic_block:
+        return 0
+    return 1 + len(connection.savepoint_ids)
+
+
+def pinned(request):
+    """Whether reads for the session of request must use the default
+    database because of a recent write"""
+    session = getattr(request, 'session', None)
+    if session is None:
+        return False
+    return session.get(PIN_SESSION_KEY, 0) > time.time()
+
+
+def pin(request, seconds=None):
+    """Read from the default database for this session for a while"""
+    session = getattr(request, 'session', None)
+    if session is None:
+        return
+    if seconds is None:
+        seconds = settings.WASCH_READ_REPLICA_PIN
+    session[PIN_SESSION_KEY] = time.time() + seconds
+
+
+@contextlib.contextmanager
+def reading_replica(request=None):
+    """Read from the replica within this block, as far as consistent
+
+    :param request: don't use the replica if the session is pinned or the
+        request wrote already (see ReadReplicaMiddleware)
+    """
+    previous = getattr(_state, 'reading', None)
+    use = replica_alias() is not None and not (
+        request is not None and (
+            pinned(request) or getattr(_state, 'wrote', False)))
+    _state.reading = {
+        'depth': _atomic_depth(), 'wrote': False} if use else None
+    try:
+        yield
+    finally:
+        if previous is not None and _state.reading is not None:
+            previous['wrote'] |= _state.reading['wrote']
+        _state.reading = previous
+
+
+def replica_reads(view):
+    """View decorator: safe requests read from the replica"""
+    @functools.wraps(view)
+    def replica_view(request, *args, **kwargs):
+        if request.method not in SAFE_METHODS:
+            return view(request, *args, **kwargs)
+        with reading_replica(request):
+            return view(request, *args, **kwargs)
+    return replica_view
+
+
+class ReadReplicaRouter:
+    def db_for_read(self, model, **hints):
+        reading = getattr(_state, 'reading', None)
+        if (reading is not None
+                and not reading['wrote']
+                and model._meta.app_label not in PRIMARY_ONLY_APPS
+                and _atomic_depth() <= reading['depth']):
+            alias = replica_alias()
+            if alias is not None:
+                return alias
+        return DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        _state.wrote = True
+        reading = getattr(_state, 'reading', None)
+        if reading is not None:
+            reading['wrote'] = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db == getattr(settings, 'WASCH_READ_REPLICA', None):
+            return False  # gets a snapshot instead
+        return None
+
+
+class ReadReplicaMiddleware:
+    """Pin the session to the default database after a write"""
+
+    def __init__(self, get_response):
+        if getattr(settings, 'WASCH_READ_REPLICA', None) is None:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        _state.wrote = False
+        try:
+            response = self.get_response(request)
+            if _state.wrote:
+                pin(request)
+            return response
+        finally:
+            _state.reading = None
+            _state.wrote = False
+
+
+def snapshot(alias=None, source=DEFAULT_DB_ALIAS):
+    """Replace the replica database file with a copy of source
+
+    Both must be SQLite databases. The copy is written next to the replica
+    and then moved over it, so readers always see a complete database;
+    connections opened before keep reading the previous copy until closed
+    (this thread's connection is closed here). The copy is read by a
+    connection of its own, so it has what was committed.
+
+    :raises TransactionManagementError: in an atomic block, whose writes
+        would block reading the source
+    """
+    if alias is None:
+        alias = replica_alias()
+    if alias is None:
+        raise ImproperlyConfigured('No read replica configured')
+    for name in (alias, source):
+        if connections[name].vendor != 'sqlite':
+            raise ImproperlyConfigured(
+                'Snapshots need SQLite, but {} is {}'.format(
+                    name, connections[name].vendor))
+    if connections[source].in_atomic_block:
+        raise TransactionManagementError(
+            'Snapshots can not be taken in an atomic block')
+    path = connections.databases[alias]['NAME']
+    partial = path + '.partial'
+    if os.path.exists(partial):
+        os.remove(partial)
+    # the test database is e. g. file:memorydb_default?mode=memory&cache=...
+    source_name = connections[source].settings_dict['NAME']
+    source_connection = sqlite3.connect(
+        source_name, uri=source_name.startswith('file:'))
+    try:
+        target = sqlite3.connect(partial)
+        try:
+            if hasattr(source_connection, 'backup'):  # Python 3.7+
+                source_connection.backup(target)
+            else:
+                target.executescript(
+                    '\n'.join(source_connection.iterdump()))
+        finally:
+            target.close()
+    finally:
+        source_connection.close()
+    os.replace(partial, path)
+    connections[alias].close()
@@ -1,8 +1,23 @@
 from rest_framework import serializers
-from .models import Appointment
+from .models import Appointment, MACHINE_KINDS, Room, WaitlistEntry
 
 
 class AppointmentSerializer(serializers.ModelSerializer):
     class Meta:
         model = Appointment
         fields = ('pk', 'time', 'machine', 'reference')
+
+
+class BookingWindowSerializer(serializers.Serializer):
+    """Parameters of AppointmentManager.book_window"""
+    earliest = serializers.DateTimeField()
+    latest = serializers.DateTimeField()
+    kind = serializers.ChoiceField(MACHINE_KINDS, required=False)
+    room = serializers.PrimaryKeyRelatedField(
+        queryset=Room.objects.all(), required=False)
+
+
+class WaitlistEntrySerializer(serializers.ModelSerializer):
+    class Meta:
+        model = WaitlistEntry
+        fields = ('pk', 'earliest', 'latest', 'machine', 'kind', 'room')
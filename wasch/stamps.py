@@ -0,0 +1,39 @@
+"""Version stamps for data derived from the database
+
+Derived data (a rendered grid, a snapshot of a small table) is kept with
+the stamp of its name it was derived at and is stale once the stamp
+differs; writers bump() the stamp. Stamps live in django.core.cache, so
+with a cache shared by all processes (settings.CACHES) a bump reaches
+every process.
+"""
+import time
+from django.core.cache import cache
+from django.db import transaction
+
+
+def _key(name):
+    return 'wasch:stamp:' + name
+
+
+def get(name):
+    key = _key(name)
+    stamp = cache.get(key)
+    if stamp is None:
+        # not a small number: data of an evicted stamp may still exist
+        cache.add(key, int(time.time() * 1000), None)
+        stamp = cache.get(key)
+    return stamp
+
+
+def _bump(name):
+    try:
+        cache.incr(_key(name))
+    except ValueError:  # evicted
+        get(name)
+
+
+def bump(name):
+    """Make data derived for name stale, now and after the current
+    transaction commits (data derived meanwhile would miss the change)"""
+    _bump(name)
+    transaction.on_commit(lambda: _bump(name))
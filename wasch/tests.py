@@ -1,18 +1,70 @@
+import collections
 import datetime
+import json
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+import numpy
+import peewee
+from django.urls import reverse
 from django.utils import timezone
-from django.test import TestCase
+from django.db import connection, connections, transaction
+from django.conf import settings
+from django.test import (
+    SimpleTestCase, TestCase, TransactionTestCase, override_settings,
+)
+from django.test.utils import CaptureQueriesContext
 from django.contrib.auth.models import (
     User,
 )
+import legacymodels
 from wasch.models import (
     Appointment,
+    IdempotencyKey,
+    OutboxTask,
+    Room,
+    Transaction,
+    UpcomingAppointment,
+    WaitlistEntry,
+    WashingMachine,
     WashUser,
     WashParameters,
     # not models:
+    ANONYMOUS_USER_NAME,
     AppointmentError,
     StatusRights,
 )
-from wasch import tvkutils, payment
+from wasch import archive, instrumentation, metrics, tvkutils, payment, views
+from wasch import bookingqueue, outbox, profiling, tokens
+from wasch import export as wasch_export
+from wasch import legacydb, legacyimport, retention, routers
+from wasch.db import immediate_atomic
+
+
+@override_settings(
+    WASCH_INSTRUMENTATION_QUERIES=True, WASCH_QUERY_BUDGETS_STRICT=True)
+class WaschTestCase(TestCase):
+    """Set up by tvkutils.setup with available machines; requests fail
+    when they exceed their query budget"""
+
+    def setUp(self):
+        WashUser.objects.clear_cache()
+        Appointment.manager.clear_cache()
+        tvkutils.setup()
+        self.machines, _ = tvkutils.get_or_create_machines()
+        for machine in self.machines:
+            machine.isAvailable = True
+            machine.save()
+        self.machine = self.machines[0]
+        self.time = Appointment.manager.scheduled_appointment_times()[-1]
+
+    def create_users(self, *usernames):
+        """activated end users of usernames"""
+        return [
+            WashUser.objects.create_enduser(name, isActivated=True).user
+            for name in usernames]
 
 
 class WashUserTestCase(TestCase):
@@ -26,6 +78,8 @@ class WashUserTestCase(TestCase):
             self.assertIn(expected_group, group_names)
 
 
+@override_settings(
+    WASCH_INSTRUMENTATION_QUERIES=True, WASCH_QUERY_BUDGETS_STRICT=True)
 class AppointmentTestCase(TestCase):
     exampleUserName = 'waschexample'
     examplePoorUserName = 'poor'
@@ -36,6 +90,8 @@ class AppointmentTestCase(TestCase):
         tvkutils.get_or_create_machines()[0]
 
     def setUp(self):
+        WashUser.objects.clear_cache()
+        Appointment.manager.clear_cache()
         tvkutils.setup()
         self.exampleMachine.isAvailable = True  # though this is default
         self.exampleMachine.save()
@@ -104,6 +160,20 @@ class AppointmentTestCase(TestCase):
             21,  # Machine out of service
         )
 
+    def test_extended_reference(self):
+        for number in (0, 3, 4, 17, 255):
+            reference = Appointment.reference_for(self.exampleTime, number)
+            self.assertEqual(
+                reference >= Appointment.EXTENDED_REFERENCE_FLAG, number >= 4)
+            self.assertEqual(
+                Appointment.slot_from_reference(reference),
+                (self.exampleTime, number))
+        with self.assertRaises(ValueError):
+            Appointment.reference_for(self.exampleTime, 256)
+        with self.assertRaises(ValueError):
+            Appointment.slot_from_reference(
+                Appointment.reference_for(self.exampleTime, 17) ^ 8)
+
     def test_make_appointment(self):
         user = User.objects.get(username=self.exampleUserName)
         god, _ = WashUser.objects.get_or_create_god()
@@ -145,3 +215,1283 @@ class AppointmentTestCase(TestCase):
             appointment.cancel()
         self.assertEqual(ae.exception.reason, 61)  # Appointment already used
         self.assertTrue(appointment.wasUsed)
+
+    def test_booking_token(self):
+        token = tokens.booking_token(
+            self.exampleTime, self.exampleMachine.number)
+        self.assertEqual(
+            tokens.parse_booking_token(token),
+            (self.exampleTime, self.exampleMachine.number))
+        reference, signature = token.split(':')
+        self.assertEqual(int(reference, 36), Appointment.reference_for(
+            self.exampleTime, self.exampleMachine.number))
+        other_reference = Appointment.reference_for(
+            self.exampleTooOldTime, self.exampleMachine.number)
+        for invalid in (
+                reference, '{}:{}'.format(
+                    numpy.base_repr(other_reference, 36).lower(), signature),
+                'x' + token):
+            with self.assertRaises(tokens.InvalidToken):
+                tokens.parse_booking_token(invalid)
+
+    def test_book_view(self):
+        user = User.objects.get(username=self.exampleUserName)
+        self.client.force_login(user)
+        response = self.client.get(reverse('wasch:book'))
+        token = tokens.booking_token(
+            self.exampleTime, self.exampleMachine.number)
+        self.assertContains(
+            response, reverse('wasch:do_book', args=[token]) + '?confirm')
+        response = self.client.get(
+            reverse('wasch:do_book', args=[token]) + '?confirm')
+        self.assertTemplateUsed(response, 'wasch/book-confirm.html')
+        self.assertContains(response, str(self.exampleTime))
+        response = self.client.get(
+            reverse('wasch:do_book', args=['x' + token]))
+        self.assertContains(response, 'Something went wrong!')
+        self.assertFalse(Appointment.objects.filter(user=user).exists())
+
+    def test_machine_status(self):
+        status = WashingMachine.objects.status()
+        self.assertTrue(status.is_available(self.exampleMachine.number))
+        with self.assertNumQueries(0):
+            self.assertIs(WashingMachine.objects.status(), status)
+            self.assertIn(
+                self.exampleBrokenMachine,
+                WashingMachine.objects.status().unavailable)
+        self.exampleMachine.isAvailable = False
+        self.exampleMachine.save()
+        self.assertFalse(WashingMachine.objects.status().is_available(
+            self.exampleMachine.number))
+        user = User.objects.get(username=self.exampleUserName)
+        self.assertEqual(
+            Appointment.manager.why_not_bookable(
+                self.exampleTime, self.exampleMachine, user),
+            21,  # Machine out of service
+        )
+        with self.assertRaises(WashingMachine.DoesNotExist):
+            WashingMachine.objects.status().get(99)
+
+    def test_book_grid(self):
+        user = User.objects.get(username=self.exampleUserName)
+        god, _ = WashUser.objects.get_or_create_god()
+        book_link = reverse('wasch:do_book', args=[tokens.booking_token(
+            self.exampleTime, self.exampleMachine.number)])
+        self.client.force_login(user)
+        with instrumentation.measure() as miss:
+            response = self.client.get(reverse('wasch:book'))
+        self.assertContains(response, book_link)
+        with instrumentation.measure() as hit:
+            response = self.client.get(reverse('wasch:book'))
+        self.assertContains(response, book_link)
+        self.assertEqual(hit.cache['bookgrid'], [1, 0])
+        self.assertLess(hit.queries, miss.queries)
+        appointment = Appointment.objects.create(
+            time=self.exampleTime, machine=self.exampleMachine,
+            user=god.user, wasUsed=False)
+        response = self.client.get(reverse('wasch:book'))
+        self.assertNotContains(response, book_link)
+        self.assertNotContains(response, 'You booked this!')
+        self.client.force_login(god.user)
+        response = self.client.get(reverse('wasch:book'))
+        self.assertContains(response, reverse(
+            'wasch:do_cancel', args=[appointment.pk]))
+        appointment.canceled = True
+        appointment.save()
+        response = self.client.get(reverse('wasch:book'))
+        self.assertContains(response, book_link)
+        self.exampleMachine.isAvailable = False
+        self.exampleMachine.save()
+        response = self.client.get(reverse('wasch:book'))
+        self.assertNotContains(response, book_link)
+        self.client.force_login(
+            User.objects.get(username=self.examplePoorUserName))
+        response = self.client.get(reverse('wasch:book'))
+        self.assertNotContains(response, 'Book now')
+
+
+class IndexTestCase(WaschTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user, = self.create_users('indexexample')
+        self.client.force_login(self.user)
+
+    def _create_history(self, count):
+        begin = timezone.now() - datetime.timedelta(days=count)
+        Appointment.objects.bulk_create([
+            Appointment(
+                time=begin + datetime.timedelta(days=i),
+                machine=self.machines[i % 3], user=self.user,
+                wasUsed=True)
+            for i in range(count)])
+
+    def test_history_pages(self):
+        self._create_history(views.HISTORY_PAGE_SIZE * 2 + 1)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('wasch:index'))
+        first_queries = len(queries)
+        pages = [response.context['my_appointments_table'].data.data]
+        while response.context['older_appointments_url']:
+            response = self.client.get(
+                response.context['older_appointments_url'])
+            pages.append(response.context['my_appointments_table'].data.data)
+        self.assertEqual(
+            [len(page) for page in pages],
+            [views.HISTORY_PAGE_SIZE, views.HISTORY_PAGE_SIZE, 1])
+        times = [a.time for page in pages for a in page]
+        self.assertEqual(times, sorted(times, reverse=True))
+        self._create_history(views.HISTORY_PAGE_SIZE * 3)
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('wasch:index'))
+        self.assertLessEqual(len(queries), first_queries)
+        response = self.client.get(reverse('wasch:index') + '?before=x')
+        self.assertEqual(response.status_code, 404)
+
+    def test_upcoming(self):
+        times = Appointment.manager.scheduled_appointment_times()
+        appointment = Appointment.manager.make_appointment(
+            times[1], self.machines[0], self.user)
+        Appointment.manager.make_appointment(
+            times[0], self.machines[0], self.user)
+        self.assertEqual(
+            [u.appointment_id for u in
+             UpcomingAppointment.objects.for_user(self.user)],
+            [appointment.pk + 1, appointment.pk])
+        appointment.cancel()
+        response = self.client.get(reverse('wasch:index'))
+        self.assertEqual(
+            [u.time for u in
+             response.context['upcoming_appointments_table'].data.data],
+            [times[0]])
+        self.assertEqual(
+            UpcomingAppointment.objects.prune(times[0] + datetime.timedelta(
+                minutes=1)), 1)
+        self.assertFalse(UpcomingAppointment.objects.exists())
+
+
+class RoomTestCase(WaschTestCase):
+    def setUp(self):
+        super().setUp()
+        self.washers = self.machines
+        self.laundry = self.washers[0].room
+        self.cellar = Room.objects.create(name='Cellar')
+        self.dryer = WashingMachine.objects.create(
+            number=12, room=self.cellar, kind='dryer', isAvailable=True)
+        self.user, = self.create_users('roomexample')
+        self.client.force_login(self.user)
+
+    def _book_link(self, machine):
+        return reverse('wasch:do_book', args=[
+            tokens.booking_token(self.time, machine.number)])
+
+    def test_book_page(self):
+        self.assertEqual(str(self.dryer), 'Dryer 12')
+        response = self.client.get(reverse('wasch:book'))
+        self.assertEqual(response.context['room'], self.laundry)
+        self.assertContains(response, self._book_link(self.washers[0]))
+        self.assertNotContains(response, self._book_link(self.dryer))
+        self.assertContains(
+            response, '?room={}'.format(self.cellar.pk))
+        response = self.client.get(
+            reverse('wasch:book') + '?room={}'.format(self.cellar.pk))
+        self.assertContains(response, 'Dryer 12')
+        self.assertContains(response, self._book_link(self.dryer))
+        self.assertNotContains(response, self._book_link(self.washers[0]))
+        response = self.client.get(self._book_link(self.dryer))
+        self.assertEqual(response.context['room'], self.cellar)
+        self.assertContains(response, 'You booked this!')
+        appointment = Appointment.objects.get(user=self.user)
+        self.assertEqual(
+            Appointment.from_reference(
+                appointment.reference, self.user).machine,
+            self.dryer)
+
+    def test_invalidation_per_room(self):
+        self.client.get(reverse('wasch:book'))
+        Appointment.manager.make_appointment(
+            self.time, self.dryer, self.user)
+        with instrumentation.measure() as measurement:
+            self.client.get(reverse('wasch:book'))
+        self.assertEqual(measurement.cache['bookgrid'], [1, 0])
+
+    def test_book_window(self):
+        times = Appointment.manager.scheduled_appointment_times()
+        first, washer, third = sorted(
+            self.washers, key=lambda machine: machine.number)
+        god, _ = WashUser.objects.get_or_create_god()
+        Appointment.manager.make_appointment(self.time, first, god.user)
+        # the earliest time, where the least worn machine wins
+        appointment = Appointment.manager.book_window(
+            self.user, times[-2], times[-1], room=self.laundry)
+        self.assertEqual(
+            (appointment.time, appointment.machine), (times[-2], washer))
+        appointment = Appointment.manager.book_window(
+            god.user, times[-2], times[-2])
+        self.assertEqual(appointment.machine, third)
+        appointment = Appointment.manager.book_window(
+            self.user, times[-2], times[-1], kind='dryer')
+        self.assertEqual(
+            (appointment.time, appointment.machine), (times[-2], self.dryer))
+        with self.assertRaises(AppointmentError) as ae:
+            Appointment.manager.book_window(
+                self.user, times[-2], times[-2], kind='dryer')
+        self.assertEqual(ae.exception.reason, 42)
+        response = self.client.post(
+            reverse('wasch:do_book_window')
+            + '?room={}'.format(self.laundry.pk), {
+                'earliest': times[-2].isoformat(),
+                'latest': times[-1].isoformat(),
+            })
+        self.assertContains(response, 'You just booked')
+        self.assertEqual(response.context['room'], self.laundry)
+        self.assertTrue(Appointment.objects.filter(
+            user=self.user, time=times[-2], machine=first).exists())
+        response = self.client.post(reverse('wasch:do_book_window'), {
+            'earliest': 'soon', 'latest': times[-1].isoformat()})
+        self.assertContains(response, 'Something went wrong!')
+        naive = timezone.make_naive(times[-3]).isoformat()
+        response = self.client.post(reverse('wasch:do_book_window'), {
+            'earliest': naive, 'latest': naive})
+        self.assertContains(response, 'You just booked')
+        self.assertTrue(Appointment.objects.filter(
+            user=self.user, time=times[-3]).exists())
+
+
+class WaitlistTestCase(WaschTestCase):
+    def setUp(self):
+        super().setUp()
+        self.booker, self.first, self.second = (
+            WashUser.objects.create_enduser(name, isActivated=True)
+            for name in ('booker', 'firstwaiter', 'secondwaiter'))
+        self.times = Appointment.manager.scheduled_appointment_times()[-2:]
+
+    def test_promote(self):
+        appointment = Appointment.manager.make_appointment(
+            self.times[-1], self.machine, self.booker.user)
+        WaitlistEntry.objects.join(
+            self.first.user, self.times[-1], self.times[-1], self.machine)
+        WaitlistEntry.objects.join(
+            self.second.user, self.times[0], self.times[-1], kind='washer')
+        WaitlistEntry.objects.join(
+            self.second.user, self.times[-1], self.times[-1], kind='dryer')
+        self.first.deactivate()
+        appointment.cancel()
+        promoted = Appointment.objects.get(
+            time=self.times[-1], machine=self.machine, canceled=False)
+        self.assertEqual(promoted.user, self.second.user)
+        self.assertIsNotNone(promoted.refundableTransaction)
+        self.assertEqual(
+            [entry.kind for entry in WaitlistEntry.objects.for_user(
+                self.second.user)],
+            ['dryer'])
+        self.first.activate()
+        promoted.cancel()
+        self.assertEqual(
+            Appointment.objects.get(
+                time=self.times[-1], machine=self.machine, canceled=False,
+            ).user,
+            self.first.user)
+        self.assertFalse(
+            WaitlistEntry.objects.for_user(self.first.user).exists())
+        self.assertEqual(
+            WaitlistEntry.objects.prune(
+                self.times[-1] + datetime.timedelta(minutes=1)),
+            1)
+        self.assertFalse(WaitlistEntry.objects.exists())
+
+    def test_book_view(self):
+        self.client.force_login(self.first.user)
+        response = self.client.post(reverse('wasch:do_book_window'), {
+            'earliest': self.times[0].isoformat(),
+            'latest': self.times[-1].isoformat(),
+            'waitlist': '',
+        })
+        self.assertContains(response, 'You are on the waitlist')
+        self.assertEqual(len(response.context['waitlist']), 1)
+        self.assertFalse(Appointment.objects.exists())
+
+
+class RecordingPayment:
+    """Pays everything, remembering refunds"""
+
+    def __init__(self):
+        self.refunds = []
+
+    def coverage(self, value, user):
+        return value
+
+    def pay(self, value, fromUser, toUser, notes='', idempotency_key=None):
+        return value, 'recorded-reference'
+
+    def refund(self, reference, value=None, idempotency_key=None):
+        self.refunds.append((reference, idempotency_key))
+        return value, 'recorded-refund'
+
+
+class Abort(BaseException):
+    pass
+
+
+class BookingQueueTestCase(WaschTestCase):
+    def setUp(self):
+        super().setUp()
+        self.users = self.create_users(
+            *('queueexample{}'.format(i) for i in range(3)))
+
+    def test_group(self):
+        queue = bookingqueue.BookingQueue(batch_size=2, start=False)
+        futures = [
+            queue.submit(
+                Appointment.manager.make_appointment, self.time,
+                self.machine, user)
+            for user in self.users[:2]]
+        futures.append(queue.submit(
+            Appointment.manager.book_window, self.users[2], self.time,
+            self.time))
+        batches = metrics.BOOKING_QUEUE_BATCH.count()
+        self.assertFalse(any(future.done() for future in futures))
+        queue.run_pending()
+        self.assertEqual(metrics.BOOKING_QUEUE_BATCH.count(), batches + 2)
+        appointment = futures[0].result(0)
+        self.assertEqual(appointment.user, self.users[0])
+        with self.assertRaises(AppointmentError) as ae:
+            futures[1].result(0)
+        self.assertEqual(ae.exception.reason, 41)
+        self.assertNotEqual(futures[2].result(0).machine, self.machine)
+        future = queue.submit(appointment.cancel)
+        future.cancel()
+        queue.run_pending()
+        self.assertFalse(
+            Appointment.objects.get(pk=appointment.pk).canceled)
+
+    def test_rolled_back_group(self):
+        method = RecordingPayment()
+        payment.register_method('recording', method)
+        WashParameters.objects.update_value('bonus-method', 'recording')
+
+        def abort():
+            raise Abort()
+
+        queue = bookingqueue.BookingQueue(start=False)
+        futures = [
+            queue.submit(
+                Appointment.manager.make_appointment, self.time,
+                self.machine, self.users[0]),
+            queue.submit(abort),
+            queue.submit(
+                Appointment.manager.make_appointment, self.time,
+                self.machine, self.users[1]),
+        ]
+        try:
+            with self.assertRaises(Abort):
+                queue.run_pending()
+        finally:
+            del payment.METHODS['recording']
+        for future in futures:
+            with self.assertRaises(Abort):
+                future.result(0)
+        self.assertFalse(Appointment.objects.exists())
+        self.assertEqual(len(method.refunds), 1)
+        self.assertEqual(method.refunds[0][0], 'recorded-reference')
+
+    @override_settings(WASCH_BOOKING_QUEUE=False)
+    def test_direct(self):
+        appointment = bookingqueue.make_appointment(
+            self.time, self.machine, self.users[0])
+        bookingqueue.cancel(appointment)
+        self.assertTrue(Appointment.objects.get(pk=appointment.pk).canceled)
+
+
+class OutboxTestCase(WaschTestCase):
+    def setUp(self):
+        super().setUp()
+        user, = self.create_users('outboxexample')
+        self.appointment = Appointment.manager.make_appointment(
+            self.time, self.machine, user)
+
+    def test_refund(self):
+        paid = self.appointment.refundableTransaction
+        self.appointment.cancel()
+        self.assertIsNone(self.appointment.refundableTransaction)
+        task = OutboxTask.objects.get()
+        self.assertEqual((task.kind, task.transaction), ('refund', paid))
+        self.assertEqual(Transaction.objects.count(), 1)
+        Transaction.objects.filter(pk=paid.pk).update(method='empty')
+        now = timezone.now()
+        self.assertEqual(outbox.run_due(now), 1)
+        task.refresh_from_db()
+        self.assertEqual((task.state, task.attempts), ('pending', 1))
+        self.assertIn('Account is empty', task.last_error)
+        self.assertEqual(outbox.run_due(now), 0)  # backing off
+        Transaction.objects.filter(pk=paid.pk).update(method='infinite')
+        later = now + datetime.timedelta(hours=1)
+        self.assertEqual(outbox.run_due(later), 1)
+        task.refresh_from_db()
+        self.assertEqual(task.state, 'done')
+        self.assertEqual(self.appointment.transactions.count(), 2)
+        self.assertFalse(outbox.run_task(task.pk, later))
+        self.assertEqual(Transaction.objects.count(), 2)
+
+
+class PartialPayment(RecordingPayment):
+    """Pays one cent less than asked"""
+
+    def pay(self, value, fromUser, toUser, notes='', idempotency_key=None):
+        return value - 1, 'partial-reference'
+
+
+class UnkeyedPayment:
+    """A method of the interface before idempotency keys"""
+
+    def coverage(self, value, user):
+        return value
+
+    def pay(self, value, fromUser, toUser, notes=''):
+        return value, 'unkeyed-reference'
+
+    def refund(self, reference, value=None):
+        return value, 'unkeyed-refund'
+
+
+class IdempotencyTestCase(WaschTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user, self.other = self.create_users(
+            'idempotentexample', 'otherexample')
+        self.service = WashUser.objects.get_or_create_service_user()[0].user
+
+    def test_pay(self):
+        paid = Transaction.objects.pay(
+            100, self.user, self.service, idempotency_key='k1')
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                Transaction.objects.pay(
+                    100, self.user, self.service, idempotency_key='k1'),
+                paid)
+        self.assertEqual(Transaction.objects.count(), 1)
+        with self.assertRaises(ValueError):
+            Transaction.objects.pay(
+                100, self.other, self.service, idempotency_key='k1')
+        refund = Transaction.objects.refund(paid, idempotency_key='k2')
+        self.assertEqual(
+            Transaction.objects.refund(paid, idempotency_key='k2'), refund)
+        self.assertEqual(Transaction.objects.count(), 2)
+
+    def test_make_appointment(self):
+        appointment = Appointment.manager.make_appointment(
+            self.time, self.machine, self.user, idempotency_key='booking')
+        self.assertEqual(
+            Appointment.manager.make_appointment(
+                self.time, self.machine, self.user,
+                idempotency_key='booking'),
+            appointment)
+        self.assertEqual(
+            Appointment.manager.book_window(
+                self.user, self.time, self.time, idempotency_key='booking'),
+            appointment)
+        self.assertEqual(Transaction.objects.count(), 1)
+
+    def test_unkeyed_method(self):
+        payment.register_method('unkeyed', UnkeyedPayment())
+        try:
+            self.assertEqual(
+                payment.pay(100, self.user, self.service, 'unkeyed'),
+                (100, 'unkeyed-reference'))
+            self.assertEqual(
+                payment.refund('unkeyed', 'unkeyed-reference'),
+                (None, 'unkeyed-refund'))
+        finally:
+            del payment.METHODS['unkeyed']
+
+    def test_rollback_refunds_reference(self):
+        method = PartialPayment()
+        payment.register_method('partial', method)
+        try:
+            with self.assertRaises(payment.PaymentError):
+                payment.pay(
+                    100, self.user, self.service, 'partial',
+                    idempotency_key='k3')
+        finally:
+            del payment.METHODS['partial']
+        self.assertEqual(
+            method.refunds, [('partial-reference', 'k3:rollback')])
+
+
+@override_settings(
+    WASCH_INSTRUMENTATION_QUERIES=True, WASCH_QUERY_BUDGETS_STRICT=True)
+class StatsTestCase(TestCase):
+    exampleMonday = datetime.date(2018, 1, 1)
+
+    def setUp(self):
+        WashUser.objects.clear_cache()
+        tvkutils.setup()
+        self.user = WashUser.objects.create_enduser(
+            'statsexample', isActivated=True).user
+        self.machines, _ = tvkutils.get_or_create_machines()
+
+    def _create(self, day, slot, machine, **kwargs):
+        time = timezone.make_aware(datetime.datetime.combine(
+            self.exampleMonday + datetime.timedelta(days=day),
+            Appointment.manager.time_of_appointment_number(slot)))
+        kwargs.setdefault('wasUsed', False)
+        return Appointment.objects.create(
+            time=time, machine=machine, user=self.user, **kwargs)
+
+    def test_heatmap(self):
+        self._create(0, 5, self.machines[0], wasUsed=True)
+        self._create(1, 0, self.machines[1], canceled=True)
+        self._create(2, 15, self.machines[2])
+        self._create(7, 5, self.machines[0])  # outside of window
+        numbers = [machine.number for machine in self.machines]
+        rates = views._appointments_heatmap(
+            self.exampleMonday,
+            self.exampleMonday + datetime.timedelta(days=6),
+            numbers)
+        self.assertEqual(rates['booked'].shape, (7, 16, len(numbers)))
+        self.assertEqual(rates['booked'][0, 5, 0], 1)
+        self.assertEqual(rates['used'][0, 5, 0], 1)
+        self.assertEqual(rates['canceled'][1, 0, 1], 1)
+        self.assertEqual(rates['booked'][1, 0, 1], 0)
+        self.assertEqual(rates['noShow'][2, 15, 2], 1)
+        self.assertEqual(rates['booked'].sum(), 2)
+        rates = views._appointments_heatmap(
+            self.exampleMonday,
+            self.exampleMonday + datetime.timedelta(days=13),
+            numbers)
+        self.assertEqual(rates['booked'][0, 5, 0], 1)
+        self.assertEqual(rates['used'][0, 5, 0], 0.5)
+
+    def test_heatmap_view(self):
+        self.client.force_login(self.user)
+        self._create(0, 5, self.machines[0])
+        response = self.client.get(
+            reverse('wasch:statsapi_appointments_heatmap'),
+            {'start': '2018-01-01', 'end': '2018-01-07'})
+        data = json.loads(response.content.decode())
+        self.assertEqual(data['start'], '2018-01-01')
+        self.assertEqual(data['booked'][0][5][0], 1)
+        response = self.client.get(
+            reverse('wasch:statsapi_appointments_heatmap'),
+            {'end': '2018-02-30'})
+        self.assertEqual(response.status_code, 400)
+
+
+class ExportTestCase(WaschTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user, = self.create_users('exportexample')
+        self.appointments = [
+            Appointment.manager.make_appointment(time, self.machine, self.user)
+            for time in Appointment.manager.scheduled_appointment_times()[:3]]
+
+    def test_export_appointments(self):
+        rows = list(wasch_export.iter_appointments(chunk_size=2))
+        self.assertEqual(
+            [row['id'] for row in rows],
+            [appointment.pk for appointment in self.appointments])
+        self.assertEqual(rows[0]['user'], self.user.username)
+        self.assertEqual(rows[0]['machine'], self.machine.number)
+        self.assertEqual(
+            rows[0]['transactions'],
+            [self.appointments[0].refundableTransaction.pk])
+        rows = list(wasch_export.iter_appointments(
+            since_id=self.appointments[0].pk, chunk_size=1))
+        self.assertEqual(len(rows), 2)
+        lines = list(wasch_export.export('appointments', 'csv'))
+        self.assertEqual(len(lines), 4)  # with header
+        self.assertTrue(lines[0].startswith('id,time,user'))
+
+    def test_export_transactions_view(self):
+        god, _ = WashUser.objects.get_or_create_god()
+        self.client.force_login(god.user)
+        response = self.client.get(
+            reverse('wasch:export', args=['transactions']),
+            {'format': 'jsonl'})
+        rows = [
+            json.loads(line)
+            for line in b''.join(response.streaming_content).splitlines()]
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(rows[0]['fromUser'], self.user.username)
+        today = datetime.date.today()
+        self.assertEqual(len(list(wasch_export.iter_transactions(
+            start=today - datetime.timedelta(days=30),
+            end=today - datetime.timedelta(days=1)))), 0)
+        response = self.client.get(
+            reverse('wasch:export', args=['transactions']),
+            {'start': '2018-02-30'})
+        self.assertEqual(response.status_code, 400)
+        self.client.force_login(self.user)
+        response = self.client.get(
+            reverse('wasch:export', args=['transactions']))
+        self.assertEqual(response.status_code, 302)  # to login
+
+
+class LegacyImportTestCase(TestCase):
+    def setUp(self):
+        WashUser.objects.clear_cache()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.legacy_database = peewee.SqliteDatabase(
+            os.path.join(self.tmpdir.name, 'legacy.sqlite3'))
+        self.bound = self.legacy_database.bind_ctx(
+            legacyimport.legacy_models())
+        self.bound.__enter__()
+        self.legacy_database.create_tables(legacyimport.legacy_models())
+        for number, status in ((1, 1), (2, 0)):
+            legacymodels.Waschmaschinen.create(
+                id=number, status=status, von=0, bemerkung=None)
+        for login, status, gesperrt in (
+                ('alice', 1, 0), ('bob', 5, 0), ('carol', 1, 1),
+                ('alice', 1, 0)):
+            legacymodels.Users.create(
+                login=login, status=status, gesperrt=gesperrt, bemerkung='',
+                gotfreimarken=0, ip='', lastlogin=datetime.date(2017, 1, 1),
+                message='', nachname='', name=login, pw='', termine=0,
+                von=0, zimmer=1001)
+        tomorrow = timezone.localdate() + datetime.timedelta(days=1)
+        for datum, zeit, maschine, user, wochentag in (
+                (datetime.date(2017, 3, 1), 3, 1, 1, 8),
+                (datetime.date(2017, 3, 1), 3, 2, 2, 2),
+                (datetime.date(2017, 3, 1), 15, 1, 3, 2),
+                (datetime.date(2017, 3, 2), 0, 1, 1, 3),
+                (datetime.date(2017, 3, 2), 0, 7, 1, 3),  # unknown machine
+                (datetime.date(2017, 3, 1), 3, 2, 1, 2),  # same slot
+                (datetime.date(2017, 3, 1), 15, 1, 3, 2),  # duplicate
+                (tomorrow, 0, 1, 2, 2)):
+            legacymodels.Termine.create(
+                datum=datum, zeit=zeit, maschine=maschine, user=user,
+                wochentag=wochentag, bonus=0)
+        for user, aktion, bestand, datum in (
+                (2, 10.5, 10.5, datetime.datetime(2017, 3, 1, 12)),
+                (2, -2, 8.5, datetime.datetime(2017, 3, 1, 12)),
+                (2, 3, 11.5, None)):
+            legacymodels.Waschagtransaktionen.create(
+                user=user, aktion=aktion, bestand=bestand, bemerkung='cash',
+                datum=datum)
+
+    def tearDown(self):
+        self.bound.__exit__(None, None, None)
+        self.tmpdir.cleanup()
+
+    def test_import(self):
+        checkpoint_path = os.path.join(self.tmpdir.name, 'checkpoint.json')
+        legacyimport.import_legacy(
+            legacyimport.Checkpoint(checkpoint_path),
+            tables=['waschmaschinen', 'users'], chunk_size=2)
+        self.assertEqual(WashUser.objects.filter(
+            user__username__in=['alice', 'bob', 'carol']).count(), 3)
+        bob = User.objects.get(username='bob')
+        self.assertTrue(bob.is_staff)
+        self.assertTrue(bob.groups.filter(name='waschag').exists())
+        self.assertFalse(WashUser.objects.get(
+            user__username='carol').isActivated)
+        checkpoint = legacyimport.import_legacy(
+            legacyimport.Checkpoint(checkpoint_path), chunk_size=2)
+        self.assertEqual(checkpoint.get('termine')['read'], 8)
+        self.assertEqual(checkpoint.get('termine')['written'], 5)
+        # bob's appointment in alice's slot would be a double booking
+        self.assertEqual(checkpoint.get('termine')['duplicates'], 1)
+        slot, = Appointment.objects.filter(machine_id=2, canceled=False)
+        self.assertEqual(slot.user.username, 'alice')
+        self.assertEqual(UpcomingAppointment.objects.filter(
+            user=bob).count(), 1)
+        used = Appointment.objects.get(wasUsed=True)
+        self.assertEqual(used.user.username, 'alice')
+        self.assertEqual(
+            timezone.localtime(used.time),
+            timezone.make_aware(datetime.datetime(2017, 3, 1, 4, 30)))
+        self.assertEqual(Transaction.objects.filter(
+            method=legacyimport.LEGACY_METHOD, toUser=bob).count(), 2)
+        # resuming from a stale checkpoint doesn't import twice
+        del checkpoint.tables['termine']
+        checkpoint.save()
+        legacyimport.import_legacy(
+            legacyimport.Checkpoint(checkpoint_path), chunk_size=3)
+        self.assertEqual(Appointment.objects.count(), 5)
+
+
+class LegacyDatabaseTestCase(SimpleTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.database = legacydb.configure({
+            'ENGINE': 'sqlite',
+            'NAME': os.path.join(self.tmpdir.name, 'legacy.sqlite3'),
+        })
+        legacymodels.Waschmaschinen.create_table()
+        legacymodels.Waschmaschinen.create(id=1, status=1, von=0)
+
+    def tearDown(self):
+        self.database.close_all()
+        legacymodels.database.initialize(None)
+        self.tmpdir.cleanup()
+
+    def test_retry_on_disconnect(self):
+        calls = []
+
+        @legacydb.retry_on_disconnect
+        def read():
+            calls.append(self.database.connection())
+            if len(calls) == 1:
+                raise peewee.OperationalError('connection lost')
+            return legacymodels.Waschmaschinen.select().count()
+
+        self.assertEqual(read(), 1)
+        self.assertEqual(len(calls), 2)
+        self.assertIsNot(calls[0], calls[1])  # not reusing the broken one
+
+        @legacydb.retry_on_disconnect
+        def broken():
+            raise peewee.OperationalError('connection lost')
+
+        with self.assertRaises(peewee.OperationalError):
+            broken()
+
+    def test_middleware(self):
+        def get_response(request):
+            return legacymodels.Waschmaschinen.select().count()
+
+        with self.settings(WASCH_USE_LEGACY=True):
+            middleware = legacydb.LegacyConnectionMiddleware(get_response)
+        self.database.close()
+        self.assertEqual(middleware(None), 1)
+        self.assertTrue(self.database.is_closed())
+        self.assertEqual(len(self.database._connections), 1)  # pooled
+
+
+class RetentionTestCase(TestCase):
+    def setUp(self):
+        WashUser.objects.clear_cache()
+        tvkutils.setup()  # retention-time 100, retention-time-waschag 250
+        self.machine = tvkutils.get_or_create_machines()[0][0]
+        self.enduser = WashUser.objects.create_enduser(
+            'retentionexample', isActivated=True).user
+        self.waschag, _, _ = WashUser.objects._get_or_create_with_user(
+            'retentionwaschag', isActivated=True, status=5)
+
+    def _create(self, user, days_ago):
+        appointment = Appointment.objects.create(
+            time=timezone.now() - datetime.timedelta(days=days_ago),
+            machine=self.machine, user=user, wasUsed=True)
+        appointment.pay()
+        return appointment
+
+    def test_purge(self):
+        expired = self._create(self.enduser, 150)
+        kept = [
+            self._create(self.enduser, 50),
+            self._create(self.waschag.user, 150),
+        ]
+        expired_waschag = self._create(self.waschag.user, 300)
+        expired_transaction = expired.refundableTransaction
+        self.assertEqual(retention.expired_appointments().count(), 2)
+        self.assertEqual(retention.purge(batch_size=1), 2)
+        self.assertEqual(
+            set(Appointment.objects.all()), set(kept))
+        anonymous, _ = WashUser.objects.get_or_create_anonymous_user()
+        expired_transaction.refresh_from_db()
+        self.assertEqual(expired_transaction.fromUser, anonymous.user)
+        self.assertEqual(expired_transaction.notes, '')
+        self.assertEqual(Transaction.objects.filter(
+            fromUser=self.waschag.user).count(), 1)
+        self.assertFalse(Appointment.transactions.through.objects.filter(
+            appointment_id=expired_waschag.pk).exists())
+        self.assertEqual(retention.purge(), 0)
+
+
+class ArchiveTestCase(TestCase):
+    oldDay = datetime.date(2018, 1, 1)
+
+    def setUp(self):
+        WashUser.objects.clear_cache()
+        tvkutils.setup()
+        self.machine = tvkutils.get_or_create_machines()[0][0]
+        self.user = WashUser.objects.create_enduser(
+            'archiveexample', isActivated=True).user
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.archive_settings = self.settings(
+            WASCH_ARCHIVE_DIR=self.tmpdir.name)
+        self.archive_settings.enable()
+
+    def tearDown(self):
+        self.archive_settings.disable()
+        self.tmpdir.cleanup()
+
+    def _create(self, time, **kwargs):
+        appointment = Appointment.objects.create(
+            time=time, machine=self.machine, user=self.user, **kwargs)
+        appointment.pay()
+        return appointment
+
+    def test_archive(self):
+        old_time = timezone.make_aware(
+            datetime.datetime.combine(self.oldDay, datetime.time(12)))
+        old = [
+            self._create(old_time, wasUsed=True),
+            self._create(old_time + datetime.timedelta(days=40),
+                         wasUsed=False),
+        ]
+        recent = self._create(timezone.now(), wasUsed=False)
+        self.assertEqual(archive.archive(months=1, batch_size=1), 2)
+        self.assertEqual(list(Appointment.objects.all()), [recent])
+        self.assertEqual(
+            list(Transaction.objects.all()), [recent.refundableTransaction])
+        records = list(archive.iter_archived())
+        self.assertEqual(
+            [record['id'] for record in records], [a.pk for a in old])
+        self.assertEqual(records[0]['time'], old_time)
+        # expired when archived
+        self.assertEqual(records[0]['user'], ANONYMOUS_USER_NAME)
+        self.assertEqual(
+            records[0]['transactions'][0]['fromUser'], ANONYMOUS_USER_NAME)
+        self.assertEqual(records[0]['transactions'][0]['notes'], '')
+        self.assertEqual(
+            records[0]['transactions'][0]['value'],
+            int(WashParameters.objects.get_value('price')))
+        self.assertEqual(len(list(archive.iter_archived(
+            self.oldDay, self.oldDay))), 1)
+        self.assertEqual(views._appointments_per_day(self.oldDay), 1)
+        self.assertEqual(
+            views._appointments_per_day(self.oldDay, used=False), 0)
+        self.assertEqual(views._appointments_per_floor(0, used=True), 1)
+        rates = views._appointments_heatmap(
+            self.oldDay, self.oldDay, [self.machine.number])
+        self.assertEqual(rates['used'][0, 8, 0], 1)
+        self.assertEqual(archive.archive(months=1), 0)
+        # counted again from the archive files if the summary is stale
+        summary_path = os.path.join(self.tmpdir.name, archive.SUMMARY_NAME)
+        os.remove(summary_path)
+        archive._summary_cache.clear()
+        self.assertEqual(archive.appointments_count(), 2)
+        self.assertTrue(os.path.exists(summary_path))
+
+    def test_anonymize_expired(self):
+        waschag, _, _ = WashUser.objects._get_or_create_with_user(
+            'archivewaschag', isActivated=True, status=5)
+        # retention-time-waschag is 250 days
+        time = timezone.now() - datetime.timedelta(days=240)
+        archived = self._create(time, wasUsed=True)
+        archived.user = waschag.user
+        archived.save()
+        self.assertEqual(archive.archive(months=6), 1)
+        record, = archive.iter_archived()
+        self.assertEqual(record['user'], waschag.user.username)
+        self.assertEqual(archive.anonymize_expired(), 0)
+        later = timezone.now() + datetime.timedelta(days=20)
+        self.assertEqual(archive.anonymize_expired(later), 1)
+        record, = archive.iter_archived()
+        self.assertEqual(record['user'], ANONYMOUS_USER_NAME)
+        self.assertEqual(archive.appointments_count(used=True), 1)
+        self.assertEqual(archive.anonymize_expired(later), 0)
+
+    def test_unfinished(self):
+        old_time = timezone.make_aware(
+            datetime.datetime.combine(self.oldDay, datetime.time(12)))
+        refunding = self._create(old_time, wasUsed=False)
+        refunding.cancel()  # refund task pending
+        retried = Appointment.objects.create(
+            time=old_time, machine=self.machine, user=self.user,
+            wasUsed=False)
+        retried.pay(idempotency_key='archive-retry')
+        self.assertEqual(archive.archive(months=1), 0)
+        self.assertEqual(Appointment.objects.count(), 2)
+        self.assertEqual(archive.appointments_count(), 0)
+        OutboxTask.objects.update(state='done')
+        IdempotencyKey.objects.update(
+            created=timezone.now() - archive.KEY_LIFETIME)
+        self.assertEqual(archive.archive(months=1), 2)
+        self.assertEqual(archive.appointments_count(canceled=True), 1)
+
+
+class QueryPlanTestCase(TestCase):
+    """Hot queries on appointments must use an index, not scan the table"""
+
+    def setUp(self):
+        WashUser.objects.clear_cache()
+        tvkutils.setup()
+        self.machines, _ = tvkutils.get_or_create_machines()
+        self.users = [
+            WashUser.objects.create_enduser(
+                'planexample{}'.format(i), isActivated=True).user
+            for i in range(5)]
+        begin = timezone.now() - datetime.timedelta(days=30)
+        Appointment.objects.bulk_create([
+            Appointment(
+                time=begin + datetime.timedelta(hours=3 * i),
+                machine=self.machines[i % 3], user=self.users[i % 5],
+                wasUsed=i % 2 == 0, canceled=i % 7 == 0)
+            for i in range(300)])
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+    def assertIndexed(self, queries, table='appointments'):
+        table_queries = [
+            query['sql'] for query in queries
+            if '"{}"'.format(table) in query['sql']]
+        self.assertTrue(table_queries)
+        for sql in table_queries:
+            with connection.cursor() as cursor:
+                cursor.execute('EXPLAIN QUERY PLAN ' + sql)
+                plan = [row[-1] for row in cursor.fetchall()]
+            for detail in plan:
+                if re.match(r'SCAN (TABLE )?{}\b'.format(table), detail):
+                    self.assertIn(
+                        'USING', detail,
+                        'full scan for {}\n{}'.format(sql, plan))
+
+    def test_hot_queries(self):
+        machine, user = self.machines[0], self.users[0]
+        time = Appointment.manager.scheduled_appointment_times()[0]
+        with CaptureQueriesContext(connection) as queries:
+            Appointment.manager.appointment_exists(time, machine)
+        self.assertIndexed(queries)
+        with CaptureQueriesContext(connection) as queries:
+            WashUser.objects.get(pk=user).remaining_ration
+        self.assertIndexed(queries)
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get('/enteapi/v1/appointment/')
+            self.client.get(
+                '/enteapi/v1/appointment/last_used_for_each_machine/')
+        self.assertIndexed(queries)
+        with CaptureQueriesContext(connection) as queries:
+            views._appointments_per_day(datetime.date.today())
+            views._slot_columns(
+                datetime.date.today() - datetime.timedelta(days=7),
+                datetime.date.today())
+        self.assertIndexed(queries)
+        self.client.force_login(user)
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('wasch:index'))
+        self.assertIndexed(queries)
+        times = Appointment.manager.scheduled_appointment_times()
+        booker, *waiters = (
+            WashUser.objects.create_enduser(
+                'planwaiter{}'.format(i), isActivated=True).user
+            for i in range(4))
+        for waiter in waiters:
+            WaitlistEntry.objects.join(waiter, times[0], times[-1])
+        machine.isAvailable = True
+        machine.save()
+        appointment = Appointment.manager.make_appointment(
+            times[-1], machine, booker)
+        with CaptureQueriesContext(connection) as queries:
+            appointment.cancel()
+        self.assertIndexed(queries, 'waitlist_slots')
+
+
+class SqliteBackendTestCase(SimpleTestCase):
+    alias = 'immediate'
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'immediate.sqlite3')
+        connections.databases[self.alias] = {
+            'ENGINE': 'wasch.backends.sqlite3',
+            'NAME': self.path,
+            'OPTIONS': {'pragmas': {'journal_mode': 'WAL'}},
+        }
+        connections.ensure_defaults(self.alias)
+
+    def tearDown(self):
+        connections[self.alias].close()
+        delattr(connections._connections, self.alias)
+        del connections.databases[self.alias]
+        self.tmpdir.cleanup()
+
+    def test_immediate_atomic(self):
+        with connections[self.alias].cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode')
+            self.assertEqual(cursor.fetchone()[0], 'wal')
+        other = sqlite3.connect(self.path, timeout=0, isolation_level=None)
+        with immediate_atomic(using=self.alias):
+            with self.assertRaises(sqlite3.OperationalError):
+                other.execute('BEGIN IMMEDIATE')  # locked already
+            with immediate_atomic(using=self.alias):
+                pass  # nested is just a savepoint
+        with transaction.atomic(using=self.alias):
+            other.execute('BEGIN IMMEDIATE')  # still free
+            other.execute('ROLLBACK')
+        other.close()
+
+
+class ReadReplicaTestCase(TransactionTestCase):
+    """Snapshots read what was committed, so tests commit"""
+
+    alias = 'replica'
+
+    def setUp(self):
+        WashUser.objects.clear_cache()
+        Appointment.manager.clear_cache()
+        tvkutils.setup()
+        self.machines, _ = tvkutils.get_or_create_machines()
+        self.user = WashUser.objects.create_enduser(
+            'replicaexample', isActivated=True).user
+        self.tmpdir = tempfile.TemporaryDirectory()
+        connections.databases[self.alias] = {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.path.join(self.tmpdir.name, 'replica.sqlite3'),
+        }
+        connections.ensure_defaults(self.alias)
+        connections.prepare_test_settings(self.alias)
+        self.settings = self.settings(WASCH_READ_REPLICA=self.alias)
+        self.settings.enable()
+        routers.snapshot()
+
+    def tearDown(self):
+        self.settings.disable()
+        connections[self.alias].close()
+        if hasattr(connections._connections, self.alias):
+            delattr(connections._connections, self.alias)
+        del connections.databases[self.alias]
+        self.tmpdir.cleanup()
+
+    def test_router(self):
+        count = WashingMachine.objects.count()
+        WashingMachine.objects.create(
+            number=99, room=self.machines[0].room, isAvailable=True)
+        with routers.reading_replica():
+            self.assertEqual(WashingMachine.objects.count(), count)
+            with transaction.atomic():
+                self.assertEqual(WashingMachine.objects.count(), count + 1)
+            self.assertEqual(WashingMachine.objects.count(), count)
+            WashingMachine.objects.filter(number=99).update(
+                isAvailable=False)
+            self.assertEqual(WashingMachine.objects.count(), count + 1)
+        self.assertEqual(WashingMachine.objects.count(), count + 1)
+        routers.snapshot()
+        with routers.reading_replica():
+            self.assertEqual(WashingMachine.objects.count(), count + 1)
+        with transaction.atomic():
+            with self.assertRaises(transaction.TransactionManagementError):
+                routers.snapshot()
+
+    def test_own_write_in_response(self):
+        self.machines[0].isAvailable = True
+        self.machines[0].save()
+        time = Appointment.manager.scheduled_appointment_times()[-1]
+        routers.snapshot()
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('wasch:do_book', args=[
+            tokens.booking_token(time, self.machines[0].number)]))
+        self.assertContains(response, 'You just booked')
+        self.assertContains(response, 'You booked this!')
+
+    def test_pinned_after_write(self):
+        self.machines[0].isAvailable = True
+        self.machines[0].save()
+        appointment = Appointment.manager.make_appointment(
+            Appointment.manager.scheduled_appointment_times()[-1],
+            self.machines[0], self.user)
+        routers.snapshot()
+        self.client.force_login(self.user)
+        with CaptureQueriesContext(connections[self.alias]) as queries:
+            self.client.get(reverse('wasch:stats'))
+        self.assertTrue(queries)
+        response = self.client.get(
+            reverse('wasch:do_cancel', args=[appointment.pk]))
+        self.assertContains(response, 'has been canceled')
+        self.assertIn(routers.PIN_SESSION_KEY, self.client.session)
+        with CaptureQueriesContext(connections[self.alias]) as queries:
+            self.client.get(reverse('wasch:stats'))
+            self.client.get(reverse('wasch:status'))
+        self.assertFalse(queries)
+
+
+class QueryBudgetTestCase(WaschTestCase):
+    def setUp(self):
+        super().setUp()
+        self.users = self.create_users(
+            *('budgetexample{}'.format(i) for i in range(3)))
+        times = Appointment.manager.scheduled_appointment_times()
+        for i, user in enumerate(self.users):
+            Appointment.manager.make_appointment(
+                times[i], self.machines[i], user)
+        past = timezone.now() - datetime.timedelta(minutes=5)
+        Appointment.objects.create(
+            time=past, machine=self.machines[0], user=self.users[0],
+            wasUsed=True)
+
+    def test_budgets(self):
+        self.client.force_login(self.users[0])
+        actions = {'wasch:do_book', 'wasch:do_book_window', 'wasch:do_cancel'}
+        for name in set(settings.WASCH_QUERY_BUDGETS) - actions:
+            url = reverse(name)
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200, url)
+            self.assertIn('X-Wasch-Queries', response)
+        times = Appointment.manager.scheduled_appointment_times()
+        response = self.client.get(reverse('wasch:do_book', args=[
+            tokens.booking_token(times[-1], self.machines[0].number)]))
+        self.assertContains(response, 'You just booked')
+        response = self.client.post(reverse('wasch:do_book_window'), {
+            'earliest': times[-2].isoformat(),
+            'latest': times[-2].isoformat(),
+        })
+        self.assertContains(response, 'You just booked')
+        appointment = Appointment.objects.get(
+            user=self.users[0], time=times[-1])
+        response = self.client.get(
+            reverse('wasch:do_cancel', args=[appointment.pk]))
+        self.assertContains(response, 'has been canceled')
+        response = self.client.get(reverse('wasch:book'))
+        self.assertEqual(response['X-Wasch-Cache-Hit-Rate'], '1.00')
+        with override_settings(WASCH_QUERY_BUDGETS={'wasch:book': 1}):
+            with self.assertRaises(instrumentation.QueryBudgetExceeded):
+                self.client.get(reverse('wasch:book'))
+
+    def test_measure(self):
+        with instrumentation.measure() as outer:
+            with instrumentation.query_budget(2) as inner:
+                list(WashingMachine.objects.all())
+                instrumentation.record_cache('example', True)
+            instrumentation.record_cache('example', False)
+            with self.assertRaises(instrumentation.QueryBudgetExceeded):
+                with instrumentation.query_budget(0):
+                    WashingMachine.objects.count()
+        self.assertEqual(inner.queries, 1)
+        self.assertEqual(inner.cache_hit_rate, 1)
+        self.assertEqual(outer.queries, 2)
+        self.assertEqual(outer.cache_hit_rate, 0.5)
+
+    def test_measure_full_log(self):
+        queries_log = connection.queries_log
+        connection.queries_log = collections.deque(maxlen=2)
+        try:
+            with instrumentation.measure() as measurement:
+                for _ in range(3):
+                    WashingMachine.objects.count()
+        finally:
+            connection.queries_log = queries_log
+        self.assertEqual(measurement.queries, 3)
+
+    @override_settings(WASCH_INSTRUMENTATION_QUERIES=False)
+    def test_queries_not_counted(self):
+        self.client.force_login(self.users[0])
+        response = self.client.get(reverse('wasch:book'))
+        self.assertNotIn('X-Wasch-Queries', response)
+        self.assertIn('X-Wasch-Time', response)
+
+
+class MetricsTestCase(WaschTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user, = self.create_users('metricsexample')
+
+    def test_make_appointment(self):
+        ok = metrics.MAKE_APPOINTMENT.value(outcome='ok')
+        taken = metrics.MAKE_APPOINTMENT.value(outcome='41')
+        failed = metrics.MAKE_APPOINTMENT.value(outcome='payment_error')
+        pay_failures = metrics.PAYMENT_FAILURES.value(
+            method='empty', operation='pay')
+        payments = metrics.PAYMENT_SECONDS.count(
+            method='infinite', operation='pay')
+        appointment = Appointment.manager.make_appointment(
+            self.time, self.machine, self.user)
+        with self.assertRaises(AppointmentError):
+            Appointment.manager.make_appointment(
+                self.time, self.machine, self.user)
+        appointment.cancel()
+        WashParameters.objects.update_value('bonus-method', 'empty')
+        with self.assertRaises(payment.PaymentError):
+            Appointment.manager.make_appointment(
+                self.time, self.machine, self.user)
+        self.assertEqual(metrics.MAKE_APPOINTMENT.value(outcome='ok'), ok + 1)
+        self.assertEqual(
+            metrics.MAKE_APPOINTMENT.value(outcome='41'), taken + 1)
+        self.assertEqual(
+            metrics.MAKE_APPOINTMENT.value(outcome='payment_error'),
+            failed + 1)
+        self.assertEqual(metrics.PAYMENT_FAILURES.value(
+            method='empty', operation='pay'), pay_failures + 1)
+        self.assertEqual(metrics.PAYMENT_SECONDS.count(
+            method='infinite', operation='pay'), payments + 1)
+
+    def test_threads(self):
+        counter = metrics.Counter('example_total', 'example', ('kind', ))
+        histogram = metrics.Histogram(
+            'example_seconds', 'example', buckets=(1, 2))
+        metrics.REGISTRY.remove(counter)
+        metrics.REGISTRY.remove(histogram)
+
+        def work():
+            for i in range(1000):
+                counter.inc(kind='a')
+                histogram.observe(i % 3)
+
+        threads = [threading.Thread(target=work) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(counter.value(kind='a'), 8000)
+        self.assertEqual(histogram.count(), 8000)
+        self.assertIn('example_total{kind="a"} 8000', counter.render())
+        self.assertIn(
+            'example_seconds_bucket{le="1.0"} 5336', histogram.render())
+        self.assertIn(
+            'example_seconds_bucket{le="+Inf"} 8000', histogram.render())
+
+    def test_view(self):
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('wasch:metrics'))
+        self.assertEqual(response.status_code, 302)  # staff only
+        self.user.is_staff = True
+        self.user.save()
+        Appointment.manager.prefetch_bookable([self.user])
+        Appointment.manager.bookable(self.time, self.machine, self.user)
+        response = self.client.get(reverse('wasch:metrics'))
+        self.assertEqual(response['Content-Type'], metrics.CONTENT_TYPE)
+        self.assertIn(
+            'wasch_cache_lookups_total{cache="bookable",result="hit"}',
+            response.content.decode())
+
+
+class ProfilingTestCase(WaschTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user, = self.create_users('profilingexample')
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_session(self):
+        with profiling.session('booking') as session:
+            appointment = Appointment.manager.make_appointment(
+                self.time, self.machine, self.user)
+            appointment.cancel()
+        make, cancel = session.root['children']
+        self.assertEqual(make['name'], 'make_appointment')
+        self.assertEqual(
+            [child['name'] for child in make['children']],
+            ['why_not_bookable', 'Appointment.pay'])
+        pay = make['children'][1]
+        self.assertEqual(
+            pay['children'][0]['name'], 'TransactionManager.pay')
+        self.assertEqual(
+            pay['children'][0]['children'][0]['name'], 'payment.pay')
+        self.assertEqual(cancel['name'], 'Appointment.cancel')
+        self.assertGreater(make['queries'], 0)
+        self.assertGreaterEqual(session.root['queries'], make['queries'])
+        path = session.dump(self.tmpdir.name)
+        with open(path + '.collapsed') as f:
+            lines = f.read().splitlines()
+        self.assertIn('booking;make_appointment;why_not_bookable', [
+            line.rsplit(' ', 1)[0] for line in lines])
+        for line in lines:
+            self.assertRegex(line, r'^[^ ]+ \d+$')
+
+    def test_middleware(self):
+        appointment = Appointment.manager.make_appointment(
+            self.time, self.machine, self.user)
+        url = reverse('wasch:do_cancel', args=[appointment.pk])
+        self.client.force_login(self.user)
+        with self.settings(WASCH_PROFILE_DIR=self.tmpdir.name):
+            response = self.client.get(url, HTTP_X_WASCH_PROFILE='cprofile')
+            self.assertNotIn('X-Wasch-Profile', response)  # not staff
+            self.user.is_staff = True
+            self.user.save()
+            response = self.client.get(url, HTTP_X_WASCH_PROFILE='cprofile')
+        path = os.path.join(self.tmpdir.name, response['X-Wasch-Profile'])
+        self.assertTrue(os.path.exists(path + '.prof'))
+        with open(path + '.json') as f:
+            root = json.load(f)
+        self.assertEqual(root['children'][0]['name'], 'Appointment.cancel')
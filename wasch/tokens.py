@@ -0,0 +1,32 @@
+"""Compact signed tokens for booking links
+
+A token is the reference (see Appointment.reference) of a slot in base 36,
+signed with the SECRET_KEY, e. g. '2pf0xk:CtR4...'. Making one needs
+neither a model instance nor a database query.
+"""
+from django.core import signing
+from django.utils.http import base36_to_int, int_to_base36
+from wasch.models import Appointment
+
+_signer = signing.Signer(salt='wasch.tokens.booking')
+
+
+class InvalidToken(ValueError):
+    pass
+
+
+def booking_token(time, machine_number):
+    """Token for booking the machine of machine_number at time"""
+    return _signer.sign(
+        int_to_base36(Appointment.reference_for(time, machine_number)))
+
+
+def parse_booking_token(token):
+    """:return: time, machine number
+    :raises InvalidToken: if the token is malformed or not signed by us
+    """
+    try:
+        reference = base36_to_int(_signer.unsign(token))
+        return Appointment.slot_from_reference(reference)
+    except (signing.BadSignature, ValueError) as error:
+        raise InvalidToken(token) from error
@@ -1,4 +1,4 @@
-from wasch.models import WashingMachine, WashUser, WashParameters
+from wasch.models import Room, WashingMachine, WashUser, WashParameters
 
 DEFAULT_MACHINE_CREATE_KWARGS = {
     'isAvailable': False,
@@ -11,7 +11,8 @@ def get_or_create_machines(
     """Create default TvK washing machines 1, 2, 3
 
     :param create_kwargs dict: keyword arguments for creating
-        WashingMachine (apart of number)
+        WashingMachine (apart of number); without room, they are put in
+        the default room
     :param amend bool: whether to ignore existing ones and just add ones
         not yet existing; defaults to False, meaning, only the existing
         ones will be returned
@@ -38,8 +39,10 @@ def get_or_create_machines(
         except WashingMachine.DoesNotExist:  # most likely case
             pass
         if machine is None:
-            machine = WashingMachine.objects.create(
-                number=number, **create_kwargs)
+            kwargs = dict(create_kwargs)
+            if 'room' not in kwargs:
+                kwargs['room'] = Room.objects.get_default()
+            machine = WashingMachine.objects.create(number=number, **kwargs)
             created.append(machine)
         allTvkMachines.append(machine)
     return allTvkMachines, created
@@ -62,7 +65,7 @@ def set_default_settings():
 
 
 def setup():
-    """Create WashUser god, groups enduser, waschag,
+    """Create WashUser god and service, groups enduser, waschag,
     add god to both groups, create machines 1, 2, 3 if not exist
 
     :return list(django.db.models.Model): created objects
@@ -71,6 +74,10 @@ def setup():
     god, was_created = WashUser.objects.get_or_create_god()
     if was_created:
         created.append(god)
+    # receives payments; created here rather than by the first booking
+    service, was_created = WashUser.objects.get_or_create_service_user()
+    if was_created:
+        created.append(service)
     if not WashingMachine.objects.exists():
         _, created_machines = get_or_create_machines()
         created.extend(created_machines)
@@ -3,6 +3,7 @@ from django.contrib.auth import views as auth_views
 from django.contrib.auth.decorators import login_required
 
 from . import views
+from .routers import replica_reads
 
 app_name = 'wasch'
 
@@ -14,19 +15,31 @@ urlpatterns = [
     url(r'^logout/$', auth_views.LogoutView.as_view(next_page='/'), name='logout'),
     url(r'^bonus/$', views.bonus, name='bonus'),
     url(r'^book/$', views.book, name='book'),
-    url(r'^book/(?P<appointment>[\w ,"{}:+-]+)/$', views.book, name='do_book'),
+    url(
+        r'^book/window/$', views.book, {'window': True},
+        name='do_book_window'),
+    url(r'^book/(?P<token>[\w:-]+)/$', views.book, name='do_book'),
     url(
         r'^cancel/(?P<cancel_appointment_pk>\d+)/$', views.book,
         name='do_cancel'),
     url(r'^stats/$', views.stats, name='stats'),
     url(r'^status/$', views.status, name='status'),
     url(r'^setup/$', views.setup, name='setup'),
+    url(r'^export/(?P<table>\w+)/$', views.export, name='export'),
+    url(r'^metrics/$', views.metrics, name='metrics'),
     url(
         r'^statsapi_appointments_per_day/$',
-        login_required(views.AppointmentsPerDayChart.as_view()),
+        login_required(replica_reads(
+            views.AppointmentsPerDayChart.as_view())),
         name='statsapi_appointments_per_day'),
     url(
         r'^statsapi_appointments_per_floor/$',
-        login_required(views.AppointmentsPerFloorChart.as_view()),
+        login_required(replica_reads(
+            views.AppointmentsPerFloorChart.as_view())),
         name='statsapi_appointments_per_floor'),
+    url(
+        r'^statsapi_appointments_heatmap/$',
+        login_required(replica_reads(
+            views.AppointmentsHeatmapChart.as_view())),
+        name='statsapi_appointments_heatmap'),
 ]
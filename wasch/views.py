@@ -1,29 +1,49 @@
+import concurrent.futures
 import datetime
+import numpy
+import pytz
 from django.shortcuts import render
 from django.urls import reverse
-from django.http import HttpResponse, HttpResponseRedirect, JsonResponse
+from django.http import (
+    Http404, HttpResponse, HttpResponseRedirect, JsonResponse,
+    StreamingHttpResponse,
+)
 from django.views.decorators.http import require_http_methods
 from django.utils.html import format_html
+from django.utils.safestring import mark_safe
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from django.db.models import BooleanField, Case, Q, Value, When
+from django.db.models.functions import (
+    ExtractHour, ExtractMinute, ExtractWeekDay,
+)
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth import (
     authenticate, login, logout as auth_logout, models as auth_models,
 )
 from django.contrib.admin.views.decorators import staff_member_required
-from django.utils.six import BytesIO
 from django.conf import settings
-from rest_framework.parsers import JSONParser
-from rest_framework.renderers import JSONRenderer
+from chartjs.views.base import JSONView
 from chartjs.views.lines import BaseLineChartView
 import django_tables2
 from wasch.models import WashingMachine, Appointment, WashUser, WashParameters
+from wasch.models import UpcomingAppointment, WaitlistEntry
+from wasch.models import MACHINE_KINDS
+from wasch.models import AppointmentManager  # not a model
 from wasch.models import AppointmentError  # not models
-from wasch.serializers import AppointmentSerializer
+from wasch import archive
+from wasch import bookgrid
+from wasch import bookingqueue
+from wasch import export as wasch_export
+from wasch import legacydb
+from wasch import metrics as wasch_metrics
 from wasch import tvkutils
 from wasch import payment
+from wasch import routers
+from wasch import tokens
 
 if settings.WASCH_USE_LEGACY:
     from legacymodels import Users, Termine, Waschmaschinen
-    from peewee import OperationalError
 
 
 def _user_alerts(user):
@@ -46,15 +66,68 @@ class PersonalAppointmentsTable(django_tables2.Table):
         template = 'django_tables2/bootstrap.html'
         model = Appointment
         fields = ('time', 'machine', 'wasUsed', 'canceled')
+        orderable = False  # it's a page, see _history_page
+
+
+class UpcomingAppointmentsTable(django_tables2.Table):
+    class Meta:
+        template = 'django_tables2/bootstrap.html'
+        model = UpcomingAppointment
+        fields = ('time', 'machine')
+        orderable = False
+
+
+HISTORY_PAGE_SIZE = 20
+
+
+def _history_cursor(appointment):
+    return '{:d}.{:d}'.format(
+        int(appointment.time.timestamp()), appointment.pk)
+
+
+def _parse_history_cursor(cursor):
+    """:return: time, pk"""
+    try:
+        timestamp, pk = (int(part) for part in cursor.split('.'))
+        return datetime.datetime.fromtimestamp(timestamp, timezone.utc), pk
+    except (ValueError, OverflowError, OSError):
+        raise Http404('Invalid cursor')
+
+
+def _history_page(user, before=None):
+    """Appointments of user, latest first, keyset paginated
+
+    :param before str: cursor, only appointments after it
+    :return: appointments, cursor for the next page or None
+    """
+    appointments = Appointment.objects.filter(
+        user=user).select_related('machine').order_by('-time', '-pk')
+    if before is not None:
+        time, pk = _parse_history_cursor(before)
+        appointments = appointments.filter(
+            Q(time__lt=time) | Q(time=time, pk__lt=pk))
+    page = list(appointments[:HISTORY_PAGE_SIZE + 1])
+    if len(page) <= HISTORY_PAGE_SIZE:
+        return page, None
+    del page[HISTORY_PAGE_SIZE:]
+    return page, _history_cursor(page[-1])
 
 
 @login_required
 def index_view(request):
     """Returns the index view page."""
-    myAppointments = Appointment.objects.filter(user=request.user)
+    history, next_cursor = _history_page(
+        request.user, request.GET.get('before'))
+    upcoming = UpcomingAppointment.objects.for_user(
+        request.user).select_related('machine')
+    older_url = None
+    if next_cursor is not None:
+        older_url = '{}?before={}'.format(reverse('wasch:index'), next_cursor)
     context = {
         'waschAlerts': _status_alerts() + _user_alerts(request.user),
-        'my_appointments_table': PersonalAppointmentsTable(myAppointments)
+        'upcoming_appointments_table': UpcomingAppointmentsTable(upcoming),
+        'my_appointments_table': PersonalAppointmentsTable(history),
+        'older_appointments_url': older_url,
     }
     return render(request, 'wasch/index.html', context)
 
@@ -80,17 +153,20 @@ def legacy_method(
         method, retval=HttpResponse('Legacy feature unavailable', status=500)):
     if not settings.WASCH_USE_LEGACY:
         return method
+    method = legacydb.retry_on_disconnect(method)
+
     def quiet_method(*args, **kwargs):
         try:
             return method(*args, **kwargs)
-        except OperationalError:
-            print('legacy_method got OperationalError')
+        except legacydb.DISCONNECT_ERRORS as e:
+            print('legacy_method got {}'.format(type(e).__name__))
             return retval
     return quiet_method
 
 
 @login_required
 @legacy_method
+@routers.replica_reads
 def stats(request):
     """Show usage stats"""
     if settings.WASCH_USE_LEGACY:
@@ -101,7 +177,9 @@ def stats(request):
     else:
         users_count = WashUser.objects.count()
         machines_count = WashingMachine.objects.count()
-        appointents_count = Appointment.objects.filter(canceled=False).count()
+        appointents_count = (
+            Appointment.objects.filter(canceled=False).count()
+            + archive.appointments_count(canceled=False))
     context = {
         'userscount': users_count,
         'machinescount': machines_count,
@@ -117,9 +195,11 @@ class WashingMachineTable(django_tables2.Table):
 
 
 @login_required
+@routers.replica_reads
 def status(request):
     """Show service status"""
-    machines = WashingMachineTable(WashingMachine.objects.all())
+    machines = WashingMachineTable(
+        list(WashingMachine.objects.status().machines))
     django_tables2.RequestConfig(request).configure(machines)
     context = {
         'machines_table': machines,
@@ -133,52 +213,130 @@ APPOINTMENT_ATTR_TEMPLATE = 'appointment_m{:d}'
 class AppointmentColumn(django_tables2.Column):
     def render(self, value):
         """
-        :param value tuple: time, machine, user
+        :param value tuple: time, machine, whether the user may book it
         """
-        time, machine, user = value
-        if Appointment.manager.bookable(time=time, machine=machine, user=user):
-            appointment = Appointment(time=time, user=user, machine=machine)
-            appointment_serial = AppointmentSerializer(appointment)
-            apjson = JSONRenderer().render(appointment_serial.data)
-            book_link = reverse('wasch:do_book', args=[apjson])
+        time, machine, bookable = value
+        if bookable:
+            book_link = reverse(
+                'wasch:do_book',
+                args=[tokens.booking_token(time, machine.number)])
             return format_html(
                 '<a href="{}?confirm">Book now</a>',
                 book_link, machine.number)
-        try:  # if it's my appointment
-            appointment = Appointment.objects.get(
-                time=time, user=user, machine=machine)
-            cancel_link = reverse('wasch:do_cancel', args=[appointment.pk])
-            return format_html(
-                'You booked this! '
-                '<a href="{}" class="btn btn-danger btn-sm">'
-                'Cancel appointment</a>'.format(cancel_link))
-        except Appointment.DoesNotExist:
-            return 'Not available'
+        return _not_available_cell(time, machine.number)
 
 
 class AppointmentTable(django_tables2.Table):
+    """Columns of machines are added with machine_columns"""
     time = django_tables2.Column()
-    appointment_m1 = AppointmentColumn()
-    appointment_m2 = AppointmentColumn()
-    appointment_m3 = AppointmentColumn()
 
     class Meta:
         template = 'django_tables2/bootstrap.html'
+        orderable = False  # the same for every request, see _book_grid
+
+    @staticmethod
+    def machine_columns(machines):
+        return [
+            (APPOINTMENT_ATTR_TEMPLATE.format(machine.number),
+             AppointmentColumn(verbose_name=str(machine)))
+            for machine in machines]
 
 
-def _appointment_table_row(time, machines, user):
+def _appointment_table_row(time, machines, can_book, booked):
     row = {
         'time': time.isoformat(),
     }
     for machine in machines:
         row[APPOINTMENT_ATTR_TEMPLATE.format(machine.number)] = (
-            time, machine, user,
+            time, machine, can_book and (time, machine.number) not in booked,
         )
     return row
 
 
+def _not_available_cell(time, machine_number):
+    """also marks the cell for _my_appointment_cell to replace"""
+    return format_html(
+        '<span data-slot="{}">Not available</span>',
+        Appointment.reference_for(time, machine_number))
+
+
+def _my_appointment_cell(appointment):
+    cancel_link = reverse('wasch:do_cancel', args=[appointment.pk])
+    return format_html(
+        'You booked this! '
+        '<a href="{}" class="btn btn-danger btn-sm">'
+        'Cancel appointment</a>', cancel_link)
+
+
+def _book_grid(request, times, machines, can_book):
+    """HTML of the table of times and machines, the same for all users who
+    can_book"""
+    booked = set(Appointment.objects.filter(
+        time__in=times, machine__in=machines, canceled=False,
+    ).values_list('time', 'machine'))
+    table = AppointmentTable(
+        [
+            _appointment_table_row(time, machines, can_book, booked)
+            for time in times],
+        extra_columns=AppointmentTable.machine_columns(machines))
+    return table.as_html(request)
+
+
+def _my_appointments(user, times, machines):
+    """Appointments of user at times with machines by time and machine
+    number"""
+    return {
+        (appointment.time, appointment.machine_id): appointment
+        for appointment in Appointment.objects.filter(
+            user=user, time__in=times, machine__in=machines,
+            canceled=False)}
+
+
+def _book_room(request, status, machine_number=None):
+    """Room to show: from the parameter room, else the one of the machine
+    of machine_number, else the first; None if there are no machines"""
+    rooms = {room.pk: room for room in status.rooms}
+    try:
+        return rooms[int(request.GET['room'])]
+    except (KeyError, ValueError):
+        pass
+    machine = status.by_number.get(machine_number)
+    if machine is not None:
+        return machine.room
+    return status.rooms[0] if status.rooms else None
+
+
+def _posted_datetime(value):
+    """aware datetime of value, in the current time zone without offset
+
+    :raises ValueError: if it's missing, malformed or doesn't exist there
+    """
+    time = parse_datetime(value)
+    if time is None:
+        raise ValueError('{!r} is no date and time'.format(value))
+    if timezone.is_naive(time):
+        try:
+            time = timezone.make_aware(time)
+        except pytz.InvalidTimeError as error:  # skipped or repeated by DST
+            raise ValueError(str(error)) from error
+    return time
+
+
+def _booking_window(data):
+    """earliest, latest and kind (None for any) posted for booking in a
+    time window
+    :raises ValueError: if they are missing or malformed
+    """
+    earliest = _posted_datetime(data.get('earliest', ''))
+    latest = _posted_datetime(data.get('latest', ''))
+    kind = data.get('kind') or None
+    if kind is not None and kind not in dict(MACHINE_KINDS):
+        raise ValueError('unknown kind of machine {}'.format(kind))
+    return earliest, latest, kind
+
+
 def _status_alerts():
-    unavailableMachines = WashingMachine.objects.filter(isAvailable=False)
+    unavailableMachines = WashingMachine.objects.status().unavailable
     return [{
         'text': '{} is not available!'.format(machine),
         'class': 'warning',
@@ -198,63 +356,121 @@ def bonus(request):
     return render(request, 'wasch/bonus.html', context)
 
 
+BOOKING_BUSY_MESSAGE = (
+    'Booking is busy, please look at your appointments again in a moment!')
+
+
 @login_required
-def book(request, appointment=None, cancel_appointment_pk=None):
+def book(request, token=None, cancel_appointment_pk=None, window=False):
     """Offer appointments for booking"""
     context = {
         'waschAlerts': _status_alerts(),
     }
-    if appointment is not None:
-        with BytesIO(appointment.encode()) as apstream:
-            apdata = JSONParser().parse(apstream)
-        appointment_serial = AppointmentSerializer(data=apdata)
-        if appointment_serial.is_valid():
-            apval = appointment_serial.validated_data
+    machine_number = None  # of the booking or cancellation
+    if token is not None:
+        try:
+            time, machine_number = tokens.parse_booking_token(token)
+            machine = WashingMachine.objects.status().get(machine_number)
+        except (tokens.InvalidToken, WashingMachine.DoesNotExist):
+            context['message'] = 'Something went wrong!'
+        else:
             if 'confirm' in request.GET:
-                context['washer_time'] = str(apval['time'])
+                context['washer_time'] = str(time)
                 context['price'] = '{:.2f} EUR'.format(
                     int(WashParameters.objects.get_value('price')) / 100.)
-                context['appointment_str'] = appointment
+                context['token'] = token
                 return render(request, 'wasch/book-confirm.html', context)
             try:
-                appointment = Appointment.manager.make_appointment(
-                    apval['time'], apval['machine'], request.user)
+                appointment = bookingqueue.make_appointment(
+                    time, machine, request.user)
                 context['message'] = 'You just booked {} for {}!'.format(
                     appointment.machine, appointment.time)
             except AppointmentError:
                 context['message'] = (
                     'Appointment for {} at {} seems no longer available!'
-                    .format(apval['machine'], apval['time']))
+                    .format(machine, time))
             except payment.PaymentError:
                 context['message'] = 'Payment has failed!'
-        else:
-            context['message'] = 'Something went wrong!'
+            except concurrent.futures.TimeoutError:
+                context['message'] = BOOKING_BUSY_MESSAGE
     elif cancel_appointment_pk is not None:
         try:
             appointment = Appointment.objects.get(
                 pk=cancel_appointment_pk, user=request.user)
-            appointment.cancel()
+            machine_number = appointment.machine_id
+            bookingqueue.cancel(appointment)
             context['message'] = (
                 'Appointment for {} at {} has been canceled!'
                 .format(appointment.machine, appointment.time))
-        except PaymentError:
-            context['message'] = 'Payment has failed!'
+        except concurrent.futures.TimeoutError:
+            context['message'] = BOOKING_BUSY_MESSAGE
         except AppointmentError:
             context['message'] = (
                 'Appointment for {} at {} can not be canceled!'
                 .format(appointment.machine, appointment.time))
         except Appointment.DoesNotExist:
             context['message'] = 'Something went wrong!'
-    machines = tuple(WashingMachine.objects.filter(isAvailable=True))
-    table = AppointmentTable([
-        _appointment_table_row(appointment_time, machines, request.user)
-        for appointment_time
-        in Appointment.manager.scheduled_appointment_times()])
-    context['appointments_table'] = table
-    Appointment.manager.prefetch_bookable(users=(request.user, ))
+    elif not window or request.method != 'POST':
+        pass  # just show the page
+    elif 'waitlist' in request.POST:
+        try:
+            earliest, latest, kind = _booking_window(request.POST)
+            entry = WaitlistEntry.objects.join(
+                request.user, earliest, latest, kind=kind,
+                room=_book_room(request, WashingMachine.objects.status()))
+            context['message'] = (
+                'You are on the waitlist from {} to {}!'
+                .format(entry.earliest, entry.latest))
+        except ValueError:
+            context['message'] = 'Something went wrong!'
+        except AppointmentError as error:
+            context['message'] = '{}!'.format(error)
+    else:
+        try:
+            earliest, latest, kind = _booking_window(request.POST)
+            appointment = bookingqueue.book_window(
+                request.user, earliest, latest, kind,
+                _book_room(request, WashingMachine.objects.status()))
+            machine_number = appointment.machine_id
+            context['message'] = 'You just booked {} for {}!'.format(
+                appointment.machine, appointment.time)
+        except ValueError:
+            context['message'] = 'Something went wrong!'
+        except AppointmentError as error:
+            context['message'] = '{}!'.format(error)
+        except payment.PaymentError:
+            context['message'] = 'Payment has failed!'
+        except concurrent.futures.TimeoutError:
+            context['message'] = BOOKING_BUSY_MESSAGE
+    status = WashingMachine.objects.status()
+    room = _book_room(request, status, machine_number)
+    machines = () if room is None else status.available_in(room.pk)
+    times = Appointment.manager.scheduled_appointment_times()
+    with routers.reading_replica(request):
+        can_book = Appointment.manager.why_user_cannot_book(
+            request.user) is None
+        mine = _my_appointments(request.user, times, machines)
+    # rendered from the primary, a lagging replica would be cached
+    grid = bookgrid.grid(
+        room and room.pk, times[0], can_book,
+        lambda: _book_grid(request, times, machines, can_book))
+    for (time, machine_number), appointment in mine.items():
+        grid = grid.replace(
+            _not_available_cell(time, machine_number),
+            _my_appointment_cell(appointment))
+    context['appointments_table'] = mark_safe(grid)
+    context['room'] = room
+    context['rooms'] = status.rooms
+    context['can_book'] = can_book
+    context['waitlist'] = WaitlistEntry.objects.for_user(request.user)
+    context['window_times'] = times
+    kinds = {machine.kind for machine in machines}
+    context['window_kinds'] = [
+        (kind, name) for kind, name in MACHINE_KINDS if kind in kinds]
     return render(request, 'wasch/book.html', context)
 
 
+@legacydb.retry_on_disconnect
 def _appointments_per_day(day, used=None):
     if settings.WASCH_USE_LEGACY:
         query = Termine.select(Termine.datum, Termine.wochentag).where(
@@ -267,9 +483,18 @@ def _appointments_per_day(day, used=None):
                 (Termine.wochentag == 8) == used,
             )
         return len(query.execute())
-    return Appointment.objects.filter(time__date=day).count()
-
-
+    # a range instead of time__date, which can't use the index on time
+    begin = timezone.make_aware(
+        datetime.datetime.combine(day, datetime.time()))
+    end = timezone.make_aware(datetime.datetime.combine(
+        day + datetime.timedelta(days=1), datetime.time()))
+    query = Appointment.objects.filter(time__gte=begin, time__lt=end)
+    if used is not None:
+        query = query.filter(wasUsed=used)
+    return query.count() + archive.appointments_per_day(day, used)
+
+
+@legacydb.retry_on_disconnect
 def _appointments_per_floor(floor, used=None):
     if settings.WASCH_USE_LEGACY:
         users = Users.select(Users.id).where(
@@ -288,8 +513,12 @@ def _appointments_per_floor(floor, used=None):
         return count
     elif floor == 0:  # XXX just show everything here
         if used is not None:
-            return Appointment.objects.filter(wasUsed=used).count()
-        return Appointment.objects.filter(canceled=False).count()
+            return (
+                Appointment.objects.filter(wasUsed=used).count()
+                + archive.appointments_count(used=used))
+        return (
+            Appointment.objects.filter(canceled=False).count()
+            + archive.appointments_count(canceled=False))
     else:
         return 0
 
@@ -319,6 +548,158 @@ class AppointmentsPerDayChart(BaseLineChartView):
         ]
 
 
+WEEKDAY_NAMES = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+
+
+@legacydb.retry_on_disconnect
+def _slot_columns(start, end):
+    """Slim columns of all appointments from start to end (dates,
+    inclusive), loaded in one query (plus archived ones)
+
+    :return tuple(numpy.ndarray): weekday (Monday is 0), slot (appointment
+        number of the day), machine number, used, canceled, past
+    """
+    now = timezone.now()
+    if settings.WASCH_USE_LEGACY:
+        rows = list(Termine.select(
+            Termine.datum, Termine.zeit, Termine.maschine, Termine.wochentag,
+        ).where(Termine.datum.between(start, end)).tuples())
+        if not rows:
+            return tuple(numpy.zeros(0, dtype=int) for _ in range(6))
+        datum, zeit, maschine, wochentag = (
+            numpy.array(column) for column in zip(*rows))
+        days = numpy.array(datum, dtype='datetime64[D]').astype(int)
+        minutes = (
+            days * 24 * 60 + zeit * AppointmentManager.interval_minutes)
+        naive_now = timezone.make_naive(now)
+        now_minutes = (
+            (naive_now.date() - datetime.date(1970, 1, 1)).days * 24 * 60
+            + naive_now.hour * 60 + naive_now.minute)
+        # 1970-01-01 was a Thursday
+        return (
+            (days + 3) % 7, zeit, maschine, wochentag >= 8,
+            numpy.zeros(len(rows), dtype=bool), minutes < now_minutes)
+    begin = timezone.make_aware(
+        datetime.datetime.combine(start, datetime.time()))
+    stop = timezone.make_aware(datetime.datetime.combine(
+        end + datetime.timedelta(days=1), datetime.time()))
+    rows = list(
+        Appointment.objects
+        .filter(time__gte=begin, time__lt=stop)
+        .annotate(
+            weekday=ExtractWeekDay('time'),
+            hour=ExtractHour('time'),
+            minute=ExtractMinute('time'),
+            past=Case(
+                When(time__lt=now, then=Value(True)),
+                default=Value(False), output_field=BooleanField()),
+        )
+        .values_list(
+            'weekday', 'hour', 'minute', 'machine_id', 'wasUsed', 'canceled',
+            'past')
+    )
+    for record in archive.iter_archived(start, end):
+        local = timezone.localtime(record['time'])
+        rows.append((
+            local.isoweekday() % 7 + 1, local.hour, local.minute,
+            record['machine'], record['wasUsed'], record['canceled'],
+            record['time'] < now))
+    if not rows:
+        return tuple(numpy.zeros(0, dtype=int) for _ in range(6))
+    weekday, hour, minute, machine, used, canceled, past = (
+        numpy.array(column) for column in zip(*rows))
+    slot = (60 * hour + minute) // AppointmentManager.interval_minutes
+    # week_day lookup counts from Sunday as 1
+    return (
+        (weekday + 5) % 7, slot, machine, used.astype(bool),
+        canceled.astype(bool), past.astype(bool))
+
+
+def _appointments_heatmap(start, end, machines):
+    """Occupancy rates binned by weekday, slot and machine
+
+    Every rate is the number of matching appointments divided by how often
+    the slot occurred in the window, e. g. a booked rate of 0.5 means that
+    the slot was booked on every second of its weekdays.
+
+    :param machines list(int): machine numbers, defining the last axis
+    :return dict(str, numpy.ndarray): booked, used, canceled and noShow
+        rates, each of shape (7, appointments_per_day, len(machines))
+    """
+    weekday, slot, machine, used, canceled, past = _slot_columns(start, end)
+    machines = numpy.array(sorted(machines), dtype=int)
+    shape = (7, AppointmentManager.appointments_per_day, len(machines))
+    known = numpy.isin(machine, machines)
+    weekday, slot, machine = weekday[known], slot[known], machine[known]
+    used, canceled, past = used[known], canceled[known], past[known]
+    cell = numpy.ravel_multi_index(
+        (weekday, slot, numpy.searchsorted(machines, machine)), shape)
+    window_days = numpy.arange(
+        numpy.datetime64(start), numpy.datetime64(end) + 1).astype(int)
+    occurrences = numpy.bincount((window_days + 3) % 7, minlength=7)
+    occurrences = numpy.maximum(occurrences, 1).reshape(7, 1, 1)
+    booked = ~canceled
+
+    def rate(mask):
+        counts = numpy.bincount(cell[mask], minlength=numpy.prod(shape))
+        return counts.reshape(shape) / occurrences
+
+    return {
+        'booked': rate(booked),
+        'used': rate(used),
+        'canceled': rate(canceled),
+        'noShow': rate(booked & ~used & past),
+    }
+
+
+class AppointmentsHeatmapChart(JSONView):
+    """Slot × weekday occupancy per machine
+
+    The window is given by the GET parameters start and end (ISO dates)
+    and defaults to the last four weeks.
+    """
+    default_duration = 28
+
+    def get(self, request, *args, **kwargs):
+        try:
+            self.window = self.get_window()
+        except ValueError:  # well formed, but e. g. February 30
+            return HttpResponse(
+                'start and end must be valid dates', status=400)
+        return super().get(request, *args, **kwargs)
+
+    def get_window(self):
+        end = parse_date(self.request.GET.get('end', '')) \
+            or datetime.date.today()
+        start = parse_date(self.request.GET.get('start', '')) \
+            or end - datetime.timedelta(days=self.default_duration - 1)
+        if start > end:
+            start, end = end, start
+        return start, end
+
+    def get_machines(self):
+        if settings.WASCH_USE_LEGACY:
+            return [m.id for m in Waschmaschinen.select(Waschmaschinen.id)]
+        return list(WashingMachine.objects.values_list('number', flat=True))
+
+    def get_context_data(self, **kwargs):
+        start, end = self.window
+        machines = self.get_machines()
+        rates = _appointments_heatmap(start, end, machines)
+        context = {
+            'start': str(start),
+            'end': str(end),
+            'weekdays': WEEKDAY_NAMES,
+            'slots': [
+                str(AppointmentManager.time_of_appointment_number(n))
+                for n in range(AppointmentManager.appointments_per_day)],
+            'machines': sorted(machines),
+        }
+        context.update(
+            (name, rate.round(4).tolist()) for name, rate in rates.items())
+        return context
+
+
 class AppointmentsPerFloorChart(BaseLineChartView):
     floors = list(range(0, 17))
 
@@ -348,3 +729,40 @@ def setup(request):
         'contents': message,
     }
     return render(request, 'wasch/info.html', context)
+
+
+@staff_member_required
+def metrics(request):
+    """Metrics of this process in Prometheus exposition format"""
+    return HttpResponse(
+        wasch_metrics.render(), content_type=wasch_metrics.CONTENT_TYPE)
+
+
+@staff_member_required
+def export(request, table):
+    """Stream appointments or transactions as CSV or JSON lines
+
+    GET parameters: format (csv or jsonl), start and end (ISO dates),
+    since_id (only rows after this id)
+    """
+    fmt = request.GET.get('format', 'csv')
+    if table not in wasch_export.TABLES or fmt not in wasch_export.FORMATS:
+        raise Http404('unknown export')
+    try:
+        since_id = int(request.GET['since_id'])
+    except KeyError:
+        since_id = None
+    except ValueError:
+        return HttpResponse('since_id must be an integer', status=400)
+    try:
+        start = parse_date(request.GET.get('start', ''))
+        end = parse_date(request.GET.get('end', ''))
+    except ValueError:  # well formed, but e. g. February 30
+        return HttpResponse('start and end must be valid dates', status=400)
+    response = StreamingHttpResponse(
+        wasch_export.export(
+            table, fmt, start=start, end=end, since_id=since_id),
+        content_type=wasch_export.FORMATS[fmt])
+    response['Content-Disposition'] = (
+        'attachment; filename="{}.{}"'.format(table, fmt))
+    return response